@@ -1,4 +1,5 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request, send_file, stream_with_context
+from werkzeug.local import LocalProxy
 import requests
 import os
 from dotenv import load_dotenv
@@ -9,23 +10,62 @@ from config import (
     CATEGORIES_WITH_FULL_TNVED,
     TNVED_DETAILED_ATTR_ID,
     REQUIRED_CUSTOM_FIELDS,
+    DEFAULT_NK_CATEGORY,
+    ASSORTMENT_FETCH,
+    METADATA_TTL,
+    WEBHOOKS,
+    BATCH_PREVIEW_MAX_ITEMS,
+    FEED_STATUS,
+    PROGRESS,
+    RECONCILE,
+    TENANTS,
+    JOBS,
 )
 from nk_api import (
-    validate_color, validate_product_kind, find_similar_values,
-    get_color_preset, get_kind_preset, determine_category_for_tnved,
-    create_card_data, send_card_to_nk, check_feed_status,
-    format_status_response
+    validate_colors, validate_product_kinds, determine_category_for_tnved,
+    format_status_response, get_category_by_id
 )
+from card_cache import card_cache, card_content_hash
+from card_validator import validate_card
+from card_submission import submit_card as submit_card_to_nk
+from progress_events import (
+    ProgressPoller, outstanding_jobs, EVENT_GTIN_WRITTEN, EVENT_JOB
+)
+from job_queue import JobQueue
+from corrections import BulkCorrections, parse_edits, parse_rules
+from reconciliation import STATUS_MATCHED, link_writes, normalize_gtin, reconcile
+from send_ledger import ledger_status
+from delta_sync import detect_changes
+from json_backend import FastJSONProvider, dumps, dumps_str, iter_page_rows, response_json
+from attribute_registry import AttributeRegistry
+from assortment_mirror import assortment_mirror
+from rate_limiter import scheduler
+from profiling import install_profiling, profile_store, admin_allowed
+from webhooks import WEBHOOK_SECRET, WebhookBatcher, webhooks_enabled, verify_token, parse_events
+from tenants import activate_tenant, current_tenant, deactivate_tenant, tenants, use_tenant
+from collections import defaultdict
+from itertools import chain
 import json
+import time
 # Загружаем переменные из .env файла
 load_dotenv()
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+install_profiling(app, scheduler)
 
 class MoySkladAPI:
-    def __init__(self):
+    """
+    Клиент одного аккаунта МойСклад. Без аргументов — аккаунт из .env;
+    клиенты остальных аккаунтов создает attach_tenant_services.
+    """
+
+    def __init__(self, token=None, scheduler=scheduler, mirror=assortment_mirror, webhook_secret=WEBHOOK_SECRET):
         self.base_url = API_SETTINGS['base_url']
-        self.token = os.getenv('MS_TOKEN')
+        self.token = token or os.getenv('MS_TOKEN')
+        self.scheduler = scheduler
+        self.mirror = mirror
+        self.webhook_secret = webhook_secret
         # МойСклад API использует Bearer авторизацию
         self.headers = {
             'Authorization': f'Bearer {self.token}',
@@ -33,6 +73,9 @@ class MoySkladAPI:
             'Content-Type': 'application/json;charset=utf-8'
         }
         self.timeout = API_SETTINGS['timeout']
+        self._metadata_cache = {}  # ключ -> (время загрузки, данные)
+        self._metadata_errors = {}  # ключ -> ошибка последней загрузки
+        self.attributes = AttributeRegistry(self)
 
     def _is_true(self, value) -> bool:
         """
@@ -51,7 +94,7 @@ class MoySkladAPI:
         """Тестирует соединение с API"""
         try:
             url = f"{self.base_url}/context/employee"  # Простой endpoint для проверки
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.scheduler.get('moysklad', url, headers=self.headers, timeout=10)
             print(f"Тест соединения - статус: {response.status_code}")
             if response.status_code == 200:
                 print("✅ Авторизация успешна")
@@ -77,7 +120,7 @@ class MoySkladAPI:
             print(f"Параметры: {params}")
             print(f"Заголовки авторизации: Authorization: {self.headers['Authorization'][:20]}...")
             
-            response = requests.get(url, headers=self.headers, params=params, timeout=self.timeout)
+            response = self.scheduler.get('moysklad', url, headers=self.headers, params=params, timeout=self.timeout)
             print(f"Статус ответа: {response.status_code}")
             
             if response.status_code == 401:
@@ -86,10 +129,10 @@ class MoySkladAPI:
                 return None
             
             response.raise_for_status()
-            data = response.json()
+            data = response_json(response)
             print(f"Получено товаров: {len(data.get('rows', []))}")
             return data
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             print(f"Ошибка при запросе к API: {e}")
             if hasattr(e, 'response') and e.response is not None:
                 print(f"Ответ сервера: {e.response.text}")
@@ -101,53 +144,253 @@ class MoySkladAPI:
         if not self.test_connection():
             print("Не удалось подключиться к API")
             return None
-            
-        all_items = []
+
+        all_items = list(self.iter_assortment())
+        print(f"Всего загружено товаров: {len(all_items)}")
+        return {'rows': all_items}
+
+    def iter_assortment(self, stats=None, limit=None):
+        """
+        Построчно отдает весь ассортимент, страница за страницей.
+        Тело страницы разбирается json_backend.iter_page_rows (с orjson —
+        целиком, иначе потоково), так что в памяти одновременно находится
+        не больше одной страницы.
+        stats['total_items'] накапливает количество полученных строк,
+        stats['error'] — текст ошибки, если загрузка оборвалась.
+
+        Без expand страницы максимального размера, а названия атрибутов и
+        характеристик подставляются из закешированных метаданных.
+        """
+        expand = ASSORTMENT_FETCH.get('expand')
+        if limit is None:
+            limit = ASSORTMENT_FETCH['expand_page_size'] if expand else ASSORTMENT_FETCH['page_size']
+        attributes = {} if expand else self.get_attribute_metadata('product')
+        characteristics = {} if expand else self.get_characteristic_metadata()
+
         offset = 0
-        limit = 1000
-        
         while True:
-            data = self.get_assortment(limit=limit, offset=offset)
-            if not data or not data.get('rows'):
-                break
-                
-            all_items.extend(data['rows'])
-            
+            page_rows = 0
+            for row in self._iter_assortment_page(limit=limit, offset=offset, expand=expand, stats=stats):
+                page_rows += 1
+                if not expand:
+                    self._resolve_row_metadata(row, attributes, characteristics)
+                yield row
+
+            if stats is not None:
+                stats['total_items'] = stats.get('total_items', 0) + page_rows
+
             # Проверяем, есть ли еще данные
-            if len(data['rows']) < limit:
+            if page_rows < limit:
                 break
-                
+
             offset += limit
-        
-        print(f"Всего загружено товаров: {len(all_items)}")
-        return {'rows': all_items}
+
+    def _iter_assortment_page(self, limit=1000, offset=0, expand='', stats=None):
+        """Одна страница ассортимента, строки разбираются по мере чтения ответа"""
+        url = f"{self.base_url}/entity/assortment"
+        params = {
+            'limit': limit,
+            'offset': offset,
+        }
+        if expand:
+            params['expand'] = expand
+        if ASSORTMENT_FETCH.get('fields'):
+            params['fields'] = ASSORTMENT_FETCH['fields']
+        print(f"Запрос страницы ассортимента: offset={offset}, limit={limit}")
+        try:
+            response = self.scheduler.get('moysklad', url, headers=self.headers, params=params,
+                                    timeout=self.timeout, stream=True)
+            try:
+                if response.status_code == 401:
+                    print("Ошибка авторизации. Проверьте токен в .env файле")
+                    if stats is not None:
+                        stats['error'] = 'Ошибка авторизации'
+                    return
+                response.raise_for_status()
+                yield from iter_page_rows(response)
+            finally:
+                response.close()
+        except requests.exceptions.RequestException as e:
+            print(f"Ошибка при запросе к API: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                print(f"Ответ сервера: {e.response.text}")
+            if stats is not None:
+                stats['error'] = str(e)
+        except ValueError as e:
+            print(f"Ошибка разбора ответа API: {e}")
+            if stats is not None:
+                stats['error'] = str(e)
+
+    def fetch_entities(self, entity_type, ids):
+        """Строки товаров/вариантов по списку id одним запросом (filter=id=...;id=...)"""
+        if not ids:
+            return []
+        url = f"{self.base_url}/entity/{entity_type}"
+        params = {
+            'filter': ';'.join(f'id={entity_id}' for entity_id in ids),
+            'limit': len(ids),
+        }
+        expand = ASSORTMENT_FETCH.get('expand')
+        if expand:
+            params['expand'] = expand
+        resp = self.scheduler.get('moysklad', url, headers=self.headers, params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        rows = response_json(resp).get('rows', [])
+        if not expand:
+            attributes = self.get_attribute_metadata('product')
+            characteristics = self.get_characteristic_metadata()
+            for row in rows:
+                self._resolve_row_metadata(row, attributes, characteristics)
+        return rows
+
+    # ------------------------------------------------------------------
+    # Метаданные (кешируются на METADATA_TTL секунд)
+    # ------------------------------------------------------------------
+
+    def _cached_metadata(self, key, loader):
+        cached = self._metadata_cache.get(key)
+        if cached and time.monotonic() - cached[0] < METADATA_TTL:
+            return cached[1]
+        try:
+            data = loader()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"❌ Ошибка загрузки метаданных {key}: {e}")
+            self._metadata_errors[key] = str(e)
+            # Лучше устаревшие метаданные, чем никаких
+            return cached[1] if cached else {}
+        self._metadata_errors.pop(key, None)
+        self._metadata_cache[key] = (time.monotonic(), data)
+        return data
+
+    def metadata_loaded(self, key):
+        """Метаданные key хоть раз загружены (пустой список атрибутов — тоже загружен)"""
+        return key in self._metadata_cache
+
+    def get_attribute_metadata(self, entity='product'):
+        """Пользовательские атрибуты сущности: {id атрибута: метаданные}"""
+        def load():
+            url = f"{self.base_url}/entity/{entity}/metadata/attributes"
+            resp = self.scheduler.get('moysklad', url, headers=self.headers, timeout=self.timeout)
+            resp.raise_for_status()
+            return {attr.get('id'): attr for attr in response_json(resp).get('rows', [])}
+        return self._cached_metadata(('attributes', entity), load)
+
+    def get_characteristic_metadata(self):
+        """Характеристики вариантов: {id характеристики: метаданные}"""
+        def load():
+            url = f"{self.base_url}/entity/variant/metadata"
+            resp = self.scheduler.get('moysklad', url, headers=self.headers, timeout=self.timeout)
+            resp.raise_for_status()
+            return {char.get('id'): char for char in response_json(resp).get('characteristics', [])}
+        return self._cached_metadata(('characteristics', 'variant'), load)
+
+    @staticmethod
+    def _ref_id(ref):
+        """id из ссылки: явное поле id или хвост meta.href"""
+        return ref.get('id') or ref.get('meta', {}).get('href', '').rstrip('/').split('/')[-1]
+
+    def _resolve_row_metadata(self, row, attributes, characteristics):
+        """Подставляет name/type атрибутов и характеристик, пришедших только ссылками"""
+        for attr in row.get('attributes', ()):
+            if 'name' not in attr:
+                meta = attributes.get(self._ref_id(attr))
+                if meta:
+                    attr['name'] = meta.get('name')
+                    attr.setdefault('type', meta.get('type'))
+        for char in row.get('characteristics', ()):
+            if 'name' not in char:
+                meta = characteristics.get(self._ref_id(char))
+                if meta:
+                    char['name'] = meta.get('name')
+
+    def get_catalog_items(self, stats=None):
+        """
+        Товары с флажком «Для нац.каталога» и их варианты в порядке отображения.
+        Весь ассортимент не накапливается: страницы проходят через фильтр
+        по мере загрузки, в памяти остается только отобранное подмножество.
+        """
+        if webhooks_enabled(self.webhook_secret):
+            rows = self._mirror_rows(stats)
+            if rows is None:
+                return None
+            return list(self.iter_products_and_variants(rows))
+
+        if not self.test_connection():
+            print("Не удалось подключиться к API")
+            return None
+        return list(self.iter_products_and_variants(self.iter_assortment(stats)))
+
+    def catalog_version(self):
+        """
+        Версия снимка ассортимента, из которого будет построен каталог.
+        None — снимка нет: вебхуки выключены или зеркало устарело и будет загружено заново.
+        """
+        if not webhooks_enabled(self.webhook_secret):
+            return None
+        age = self.mirror.age()
+        if age is None or age >= WEBHOOKS['mirror_max_age']:
+            return None
+        return self.mirror.version
+
+    def _mirror_rows(self, stats=None):
+        """
+        Строки из зеркала ассортимента (обновляется вебхуками).
+        Пустое или слишком старое зеркало загружается целиком — одним запросом
+        за раз, остальные ждут его результата; при ошибке загрузки зеркало не
+        сохраняется, чтобы не закрепить неполные данные.
+        """
+        rows = self._fresh_mirror_rows(stats)
+        if rows is not None:
+            return rows
+
+        with self.mirror.reloading():
+            # Пока ждали, зеркало мог загрузить параллельный запрос
+            rows = self._fresh_mirror_rows(stats)
+            if rows is not None:
+                return rows
+            if not self.test_connection():
+                print("Не удалось подключиться к API")
+                return None
+            load_stats = {}
+            rows = list(self.iter_assortment(load_stats))
+            if stats is not None:
+                stats.update(load_stats)
+            if not load_stats.get('error'):
+                self.mirror.load(rows)
+                print(f"🪞 Зеркало ассортимента загружено: {len(rows)} строк, версия {self.mirror.version}")
+        return rows
+
+    def _fresh_mirror_rows(self, stats=None):
+        age = self.mirror.age()
+        if age is None or age >= WEBHOOKS['mirror_max_age']:
+            return None
+        rows = self.mirror.rows()
+        if stats is not None:
+            stats['total_items'] = len(rows)
+        return rows
 
     # ------------------------------------------------------------------
     # Работа с дополнительными полями
     # ------------------------------------------------------------------
 
     def get_product_attributes(self):
-        """Возвращает все пользовательские атрибуты товаров"""
-        url = f"{self.base_url}/entity/product/metadata/attributes"
-        resp = requests.get(url, headers=self.headers, timeout=self.timeout)
-        resp.raise_for_status()
-        return resp.json().get("rows", [])
+        """Возвращает все пользовательские атрибуты товаров (из реестра атрибутов)"""
+        return list(self.get_attribute_metadata('product').values())
 
     def check_missing_custom_fields(self):
         """Список обязательных атрибутов, которых нет в системе"""
-        existing = {attr.get("name") for attr in self.get_product_attributes()}
-        return [name for name in REQUIRED_CUSTOM_FIELDS if name not in existing]
+        return [name for name in REQUIRED_CUSTOM_FIELDS if self.attributes.get(name) is None]
 
     def _create_custom_entity(self, name, values):
         """Создает пользовательский справочник и значения"""
         url = f"{self.base_url}/entity/customentity"
-        resp = requests.post(url, headers=self.headers, json={"name": name}, timeout=self.timeout)
+        resp = self.scheduler.post('moysklad', url, headers=self.headers, json={"name": name}, timeout=self.timeout)
         resp.raise_for_status()
-        entity = resp.json()
+        entity = response_json(resp)
         ce_id = entity.get("id")
         if ce_id and values:
             for val in values:
-                requests.post(f"{url}/{ce_id}", headers=self.headers, json={"name": val}, timeout=self.timeout)
+                self.scheduler.post('moysklad', f"{url}/{ce_id}", headers=self.headers, json={"name": val}, timeout=self.timeout)
 
         return {
             "href": f"{self.base_url}/entity/customentity/{ce_id}/metadata",
@@ -170,9 +413,11 @@ class MoySkladAPI:
                 payload = {"name": name, "type": "string", "required": False}
 
             url = f"{self.base_url}/entity/product/metadata/attributes"
-            resp = requests.post(url, headers=self.headers, json=payload, timeout=self.timeout)
+            resp = self.scheduler.post('moysklad', url, headers=self.headers, json=payload, timeout=self.timeout)
             if resp.status_code in (200, 201):
                 created.append(name)
+        if created:
+            self.attributes.invalidate()
         return created
 
 
@@ -189,8 +434,9 @@ class MoySkladAPI:
         else:
             payload = {"name": name, "type": "string", "required": False}
         url = f"{self.base_url}/entity/product/metadata/attributes"
-        resp = requests.post(url, headers=self.headers, json=payload, timeout=self.timeout)
+        resp = self.scheduler.post('moysklad', url, headers=self.headers, json=payload, timeout=self.timeout)
         if resp.status_code in (200, 201):
+            self.attributes.invalidate()
             return True
         return False
 
@@ -201,17 +447,11 @@ class MoySkladAPI:
         
         print(f"Ищем атрибут: '{national_catalog_attr}'")
         
+        flag = self._national_catalog_flag_key()
+
         for item in items:
-            # Проверяем кастомные атрибуты
-            attributes = item.get('attributes', [])
-            for_national_catalog = False
-            
-            for attr in attributes:
-                if attr.get('name') == national_catalog_attr:
-                    if self._is_true(attr.get('value')):
-                        for_national_catalog = True
-                    break
-            
+            for_national_catalog = self._has_national_catalog_flag(item, flag)
+
             if for_national_catalog:
                 filtered_items.append(item)
                 print(f"✅ Товар '{item.get('name')}' добавлен в каталог")
@@ -220,133 +460,178 @@ class MoySkladAPI:
         return filtered_items
 
 
+    def _attribute_key(self, attr, by_id):
+        return self._ref_id(attr) if by_id else attr.get('name', '')
+
+    def _attribute_values(self, item, by_id=True):
+        """
+        Значения атрибутов строки {id атрибута: строка} (или по названию,
+        если реестр атрибутов недоступен). Считается один раз на строку:
+        атрибуты родительского товара не разбираются заново для каждого варианта.
+        """
+        cached = item.get('_attr_values')
+        if cached is not None and cached[0] == by_id:
+            return cached[1]
+        values = {}
+        for attr in item.get('attributes', ()):
+            attr_value = attr.get('value', '')
+            if isinstance(attr_value, dict):
+                attr_value = attr_value.get('name', '')
+            elif isinstance(attr_value, bool):
+                attr_value = 'Да' if attr_value else 'Нет'
+            values[self._attribute_key(attr, by_id)] = str(attr_value) if attr_value else ''
+        item['_attr_values'] = (by_id, values)
+        return values
+
+    def _national_catalog_flag_key(self):
+        """(by_id, ключ) атрибута «Для нац.каталога» для _has_national_catalog_flag"""
+        by_id, keys = self.attributes.keys({'flag': CUSTOM_ATTRIBUTES['national_catalog']})
+        return by_id, keys['flag']
+
+    def _has_national_catalog_flag(self, item, flag=None):
+        by_id, flag_key = flag or self._national_catalog_flag_key()
+        if flag_key is None:
+            return False
+        for attr in item.get('attributes', ()):
+            if self._attribute_key(attr, by_id) == flag_key:
+                return self._is_true(attr.get('value'))
+        return False
+
     def process_products_and_variants(self, items):
         """Обрабатывает товары и их варианты согласно бизнес-логике"""
-        # Собираем все товары для справки
-        products_dict = {}  # id товара -> данные товара
-        for item in items:
-            if item.get('meta', {}).get('type') == 'product':
-                products_dict[item.get('id')] = item
-        
-        # Фильтруем товары с галочкой
-        products_with_flag = []
-        for item in items:
-            if item.get('meta', {}).get('type') == 'product':
-                has_flag = False
-                for attr in item.get('attributes', []):
-                    if attr.get('name') == CUSTOM_ATTRIBUTES['national_catalog']:
-                        if self._is_true(attr.get('value')):
-                            has_flag = True
-                        break
-                
-                if has_flag:
-                    products_with_flag.append(item)
-                    print(f"✅ Найден товар с галочкой: {item.get('name')}")
-        
-        print(f"Всего товаров с галочкой 'Для нац.каталога': {len(products_with_flag)}")
-        
-        # Результирующий список
-        result_items = []
-
-        # Обрабатываем каждый товар с галочкой
-        for product in products_with_flag:
-            product_id = product.get('id')
-
-            # Ищем варианты этого товара
-            product_variants = []
-            for item in items:
-                if item.get('meta', {}).get('type') == 'variant':
-                    product_ref = item.get('product')
-                    if product_ref:
-                        product_href = product_ref.get('meta', {}).get('href', '')
-                        parent_product_id = product_href.split('/')[-1]
-                        if parent_product_id == product_id:
-                            # Добавляем ссылку на родительский товар
-                            item['_parent_product'] = product
-                            product_variants.append(item)
-
-            if len(product_variants) == 0:
-                # Товар без вариантов - добавляем сам товар
-                result_items.append(product)
-                print(f"  ➜ Добавлен товар без вариантов: {product.get('name')}")
-            else:
-                # Товар с вариантами - сначала добавляем сам товар,
-                # чтобы пользователь мог отправить основную карточку,
-                # затем перечисляем все варианты
-                result_items.append(product)
-                print(f"  ➜ Товар '{product.get('name')}' имеет {len(product_variants)} вариантов")
-                for variant in product_variants:
-                    result_items.append(variant)
-                    print(f"    • Добавлен вариант: {variant.get('name')}")
-        
+        result_items = list(self.iter_products_and_variants(items))
         print(f"Итого для отображения: {len(result_items)} элементов")
         return result_items
 
+    def iter_products_and_variants(self, rows):
+        """
+        Отбирает товары с галочкой и их варианты из потока строк.
+        Порядок результата: товар, затем все его варианты (в порядке появления).
+
+        Хранятся только товары с галочкой, их варианты и варианты, чей
+        товар еще не встречался в потоке (такие отбрасываются, как только
+        выясняется, что у товара нет галочки).
+        """
+        flagged = {}           # id товара с галочкой -> товар
+        variants = {}          # id товара с галочкой -> [варианты]
+        unflagged = set()      # id товаров без галочки
+        orphans = {}           # id еще не встреченного товара -> [варианты]
+
+        flag = self._national_catalog_flag_key()
+
+        for item in rows:
+            item_type = item.get('meta', {}).get('type')
+            if item_type == 'product':
+                product_id = item.get('id')
+                pending = orphans.pop(product_id, [])
+                if self._has_national_catalog_flag(item, flag):
+                    flagged[product_id] = item
+                    variants[product_id] = pending
+                    print(f"✅ Найден товар с галочкой: {item.get('name')}")
+                else:
+                    unflagged.add(product_id)
+            elif item_type == 'variant':
+                product_ref = item.get('product')
+                if not product_ref:
+                    continue
+                parent_product_id = product_ref.get('meta', {}).get('href', '').split('/')[-1]
+                if parent_product_id in flagged:
+                    variants[parent_product_id].append(item)
+                elif parent_product_id not in unflagged:
+                    orphans.setdefault(parent_product_id, []).append(item)
+
+        print(f"Всего товаров с галочкой 'Для нац.каталога': {len(flagged)}")
+
+        for product_id, product in flagged.items():
+            product_variants = variants[product_id]
+            yield product
+            if product_variants:
+                print(f"  ➜ Товар '{product.get('name')}' имеет {len(product_variants)} вариантов")
+            for variant in product_variants:
+                # Добавляем ссылку на родительский товар
+                variant['_parent_product'] = product
+                yield variant
+
     def extract_tnved(self, item, parent_item=None):
         """Извлекает ТН ВЭД в зависимости от категории товара"""
-        
-        # Собираем все атрибуты (текущего товара и родительского)
-        all_attributes = []
-        
-        # Атрибуты текущего товара
-        all_attributes.extend(item.get('attributes', []))
-        
-        # Атрибуты родительского товара (если есть)
+
+        # Атрибуты текущего товара и родительского (если есть)
+        all_attributes = item.get('attributes', [])
         if parent_item and parent_item != item:
-            all_attributes.extend(parent_item.get('attributes', []))
-        
+            all_attributes = chain(all_attributes, parent_item.get('attributes', []))
+
         # Определяем категорию товара
         categories = []
         if item.get('categories'):
             categories.extend(item.get('categories', []))
         if parent_item and parent_item.get('categories'):
             categories.extend(parent_item.get('categories', []))
-        
-        # Ищем категории в атрибутах тоже (на всякий случай)
+
+        # Один проход по атрибутам: категории и кандидаты ТН ВЭД по attr_id
+        detailed_values = []   # 10-значный ТН ВЭД (атрибут 13933)
+        group_values = []      # группа ТН ВЭД (attr_id 3959)
         for attr in all_attributes:
+            attr_id = attr.get('attr_id')
+            if attr_id == TNVED_DETAILED_ATTR_ID:
+                detailed_values.append(attr.get('value') or attr.get('attr_value', ''))
+            elif attr_id == 3959:
+                group_values.append(attr.get('value') or attr.get('attr_value', ''))
+            # Ищем категории в атрибутах тоже (на всякий случай)
             if attr.get('attr_name') == 'Категория' or attr.get('name') == 'Категория':
                 cat_value = attr.get('value') or attr.get('attr_value')
                 if isinstance(cat_value, dict) and cat_value.get('cat_id'):
                     categories.append({'cat_id': cat_value['cat_id']})
-        
+
         # Проверяем, есть ли категории, требующие 10-значный ТН ВЭД
-        requires_full_tnved = False
-        for cat in categories:
-            cat_id = cat.get('cat_id')
-            if cat_id in CATEGORIES_WITH_FULL_TNVED:
-                requires_full_tnved = True
-                break
-        
+        requires_full_tnved = any(cat.get('cat_id') in CATEGORIES_WITH_FULL_TNVED for cat in categories)
+
         if requires_full_tnved:
-            # Ищем 10-значный ТН ВЭД в атрибуте 13933
-            for attr in all_attributes:
-                attr_id = attr.get('attr_id')
-                if attr_id == TNVED_DETAILED_ATTR_ID:
-                    tnved_value = attr.get('value') or attr.get('attr_value', '')
-                    if tnved_value and tnved_value != 'None':
-                        return str(tnved_value)
+            candidates = detailed_values
         else:
             # Ищем 4-значный ТН ВЭД в поле tnved товара
             tnved_4 = item.get('tnved') or (parent_item.get('tnved') if parent_item else None)
             if tnved_4:
                 return str(tnved_4)
-            
-            # Или в атрибутах (attr_id 3959 - группа ТН ВЭД)
-            for attr in all_attributes:
-                attr_id = attr.get('attr_id')
-                if attr_id == 3959:  # Группа ТН ВЭД
-                    tnved_value = attr.get('value') or attr.get('attr_value', '')
-                    if tnved_value and tnved_value != 'None':
-                        return str(tnved_value)
-        
+            # Или в атрибутах (группа ТН ВЭД)
+            candidates = group_values
+
+        for tnved_value in candidates:
+            if tnved_value and tnved_value != 'None':
+                return str(tnved_value)
+
         return ''
 
     def extract_item_data_with_inheritance(self, item):
         """Извлекает данные с наследованием от основной карточки"""
+        return self.validate_items_data([self._extract_item_fields(item)])[0]
+
+    def extract_items_data(self, items):
+        """
+        Извлекает данные для списка товаров/вариантов.
+        Валидация выполняется одним проходом по различным значениям,
+        а не по каждой строке.
+        """
+        rows = [self._extract_item_fields(item) for item in items]
+        return self.validate_items_data(rows)
+
+    def iter_items_data(self, items, batch_size=1000):
+        """Потоковая версия extract_items_data: валидация пачками по batch_size строк"""
+        batch = []
+        for item in items:
+            batch.append(self._extract_item_fields(item))
+            if len(batch) >= batch_size:
+                yield from self.validate_items_data(batch)
+                batch = []
+        if batch:
+            yield from self.validate_items_data(batch)
+
+    def _extract_item_fields(self, item):
+        """Поля товара с наследованием от основной карточки (без валидации НК)"""
         item_type = item.get('meta', {}).get('type', 'unknown')
         
        # Базовые данные
         data = {
+            'id': item.get('id'),
             'name': item.get('name', ''),
             'article': item.get('article', ''),
             'composition': '',
@@ -373,34 +658,15 @@ class MoySkladAPI:
         elif item_type == 'product':
             parent_item = item  # Для обычных товаров родитель = сам товар
         
-        # Извлекаем данные из кастомных атрибутов текущего элемента
-        current_attributes = {}
-        for attr in item.get('attributes', []):
-            attr_name = attr.get('name', '')
-            attr_value = attr.get('value', '')
-            
-            if isinstance(attr_value, dict):
-                attr_value = attr_value.get('name', '')
-            elif isinstance(attr_value, bool):
-                attr_value = 'Да' if attr_value else 'Нет'
-            
-            current_attributes[attr_name] = str(attr_value) if attr_value else ''
-        
-        # Извлекаем данные из родительского товара
+        # Значения атрибутов текущего элемента и родителя по id атрибута
+        by_id, keys = self.attributes.keys(CUSTOM_ATTRIBUTES)
+        current_attributes = self._attribute_values(item, by_id)
         parent_attributes = {}
         if parent_item and parent_item != item:
-            for attr in parent_item.get('attributes', []):
-                attr_name = attr.get('name', '')
-                attr_value = attr.get('value', '')
-                
-                if isinstance(attr_value, dict):
-                    attr_value = attr_value.get('name', '')
-                elif isinstance(attr_value, bool):
-                    attr_value = 'Да' if attr_value else 'Нет'
-                
-                parent_attributes[attr_name] = str(attr_value) if attr_value else ''
+            parent_attributes = self._attribute_values(parent_item, by_id)
+
          # Целевой пол: сначала вариант, потом родитель
-        target_gender_attr = 'Целевой пол'  # Название атрибута в МойСклад
+        target_gender_attr = keys['target_gender']
         if target_gender_attr in current_attributes and current_attributes[target_gender_attr]:
             data['target_gender'] = current_attributes[target_gender_attr]
         elif target_gender_attr in parent_attributes:
@@ -409,7 +675,7 @@ class MoySkladAPI:
             data['target_gender'] = ''
 
         # Вид размера: сначала вариант, потом родитель
-        size_type_attr = 'Вид размера'
+        size_type_attr = keys['size_type']
         if size_type_attr in current_attributes and current_attributes[size_type_attr]:
             data['size_type'] = current_attributes[size_type_attr]
         elif size_type_attr in parent_attributes:
@@ -424,28 +690,28 @@ class MoySkladAPI:
             data['article'] = parent_item.get('article', '')
         
         # Состав: сначала вариант, потом родитель
-        composition_attr = CUSTOM_ATTRIBUTES['composition']
+        composition_attr = keys['composition']
         if composition_attr in current_attributes and current_attributes[composition_attr]:
             data['composition'] = current_attributes[composition_attr]
         elif composition_attr in parent_attributes:
             data['composition'] = parent_attributes[composition_attr]
         
         # Разрешительные документы: сначала вариант, потом родитель
-        permit_attr = CUSTOM_ATTRIBUTES['permit_docs']
+        permit_attr = keys['permit_docs']
         if permit_attr in current_attributes and current_attributes[permit_attr]:
             data['permit_docs'] = current_attributes[permit_attr]
         elif permit_attr in parent_attributes:
             data['permit_docs'] = parent_attributes[permit_attr]
             
         # Бренд НК: сначала вариант, потом родитель
-        brand_nk_attr = CUSTOM_ATTRIBUTES['brand_nk']
+        brand_nk_attr = keys['brand_nk']
         if brand_nk_attr in current_attributes and current_attributes[brand_nk_attr]:
             data['brand_nk'] = current_attributes[brand_nk_attr]
         elif brand_nk_attr in parent_attributes:
             data['brand_nk'] = parent_attributes[brand_nk_attr]
         
         # Вид товара: сначала вариант, потом родитель
-        type_attr = CUSTOM_ATTRIBUTES['product_type']
+        type_attr = keys['product_type']
         if type_attr in current_attributes and current_attributes[type_attr]:
             data['product_type'] = current_attributes[type_attr]
         elif type_attr in parent_attributes:
@@ -455,7 +721,7 @@ class MoySkladAPI:
         data['tnved'] = self.extract_tnved(item, parent_item)
         
         # Цвет: сначала характеристики варианта, потом атрибуты варианта, потом родитель
-        color_attr = CUSTOM_ATTRIBUTES['color']
+        color_attr = keys['color']
         
         # Сначала из характеристик (для вариантов)
         characteristics = item.get('characteristics', [])
@@ -482,7 +748,7 @@ class MoySkladAPI:
             data['color'] = parent_attributes[color_attr]
         
         # Размер: аналогично цвету
-        size_attr = CUSTOM_ATTRIBUTES['size']
+        size_attr = keys['size']
         
         # Сначала из характеристик (для вариантов)
         for char in characteristics:
@@ -512,32 +778,47 @@ class MoySkladAPI:
             if data[key] in ['None', '', 'nan', 'Нет']:
                 data[key] = ''
         
-        # Валидация цвета с национальным каталогом
-        if data['color']:
-            color_valid, color_preset = validate_color(data['color'])
-            data['color_valid'] = color_valid
-            if not color_valid:
-                data['color_suggestions'] = find_similar_values(data['color'], color_preset, 0.6)
-        
-        # Валидация вида товара с определением категории по ТН ВЭД
-        if data['product_type'] and data['tnved']:
-            # Определяем категорию по ТН ВЭД
-            cat_id = determine_category_for_tnved(data['tnved'])
-            print(f"Для ТН ВЭД {data['tnved']} определена категория: {cat_id}")
-            
-            type_valid, type_preset = validate_product_kind(data['product_type'], cat_id)
-            data['product_type_valid'] = type_valid
-            if not type_valid:
-                data['product_type_suggestions'] = find_similar_values(data['product_type'], type_preset, 0.6)
-        elif data['product_type']:
-            # Используем базовую категорию если нет ТН ВЭД
-            DEFAULT_CAT_ID = 31326
-            type_valid, type_preset = validate_product_kind(data['product_type'], DEFAULT_CAT_ID)
-            data['product_type_valid'] = type_valid
-            if not type_valid:
-                data['product_type_suggestions'] = find_similar_values(data['product_type'], type_preset, 0.6)
-        
         return data
+
+    def validate_items_data(self, rows):
+        """
+        Валидация цветов и видов товара с НК.
+        Строки группируются по цвету, ТН ВЭД и (категория, вид): каждое
+        различное значение проверяется один раз, результат раздается строкам.
+        """
+        colors = validate_colors(row['color'] for row in rows)
+
+        # Категория НК по каждому различному ТН ВЭД
+        categories = {}
+        for tnved in {row['tnved'] for row in rows if row['product_type'] and row['tnved']}:
+            categories[tnved] = determine_category_for_tnved(tnved)
+            print(f"Для ТН ВЭД {tnved} определена категория: {categories[tnved]}")
+
+        # Без ТН ВЭД используем базовую категорию
+        kinds_by_category = defaultdict(set)
+        for row in rows:
+            if row['product_type']:
+                cat_id = categories[row['tnved']] if row['tnved'] else DEFAULT_NK_CATEGORY
+                kinds_by_category[cat_id].add(row['product_type'])
+
+        kinds = {
+            cat_id: validate_product_kinds(values, cat_id)
+            for cat_id, values in kinds_by_category.items()
+        }
+
+        for row in rows:
+            if row['color']:
+                valid, suggestions = colors[row['color']]
+                row['color_valid'] = valid
+                row['color_suggestions'] = list(suggestions)
+
+            if row['product_type']:
+                cat_id = categories[row['tnved']] if row['tnved'] else DEFAULT_NK_CATEGORY
+                valid, suggestions = kinds[cat_id][row['product_type']]
+                row['product_type_valid'] = valid
+                row['product_type_suggestions'] = list(suggestions)
+
+        return rows
     
 
     def format_gtin_for_moysklad(self, gtin):
@@ -578,14 +859,14 @@ class MoySkladAPI:
             url = f"{self.base_url}/entity/{entity_type}/{product_id}"
             print(f"   🌐 Запрос URL: {url}")
             
-            response = requests.get(url, headers=self.headers, timeout=self.timeout)
+            response = self.scheduler.get('moysklad', url, headers=self.headers, timeout=self.timeout)
             print(f"   📡 GET Response status: {response.status_code}")
             
             if response.status_code != 200:
                 print(f"   ❌ GET Response text: {response.text}")
                 
             response.raise_for_status()
-            current_data = response.json()
+            current_data = response_json(response)
             
             # ПРОВЕРЯЕМ ЧТО ПОЛУЧИЛИ
             print(f"\n🔍 === АНАЛИЗ ПОЛУЧЕННЫХ ДАННЫХ ===")
@@ -647,8 +928,8 @@ class MoySkladAPI:
             print(f"   PUT Data: {json.dumps(update_data, indent=2, ensure_ascii=False)}")
             
             # Отправляем обновление
-            response = requests.put(
-                url, 
+            response = self.scheduler.put(
+                'moysklad', url, 
                 headers=self.headers, 
                 json=update_data,
                 timeout=self.timeout
@@ -660,7 +941,7 @@ class MoySkladAPI:
                 print(f"   PUT Response text: {response.text}")
             
             response.raise_for_status()
-            updated_product = response.json()
+            updated_product = response_json(response)
             
             # Проверяем результат
             final_barcodes = updated_product.get('barcodes', [])
@@ -693,7 +974,7 @@ class MoySkladAPI:
                 print(f"   Response status: {e.response.status_code}")
                 print(f"   Response text: {e.response.text}")
                 try:
-                    error_details = e.response.json()
+                    error_details = response_json(e.response)
                     print(f"   Error details: {json.dumps(error_details, indent=2, ensure_ascii=False)}")
                     if 'errors' in error_details:
                         error_msg += f" Детали: {error_details['errors']}"
@@ -724,16 +1005,12 @@ class MoySkladAPI:
         try:
             print(f"\n🎯 === ОТЛАДКА ОПРЕДЕЛЕНИЯ ТОВАРА ДЛЯ GTIN (индекс: {product_index}) ===")
             
-            # Получаем все товары
-            assortment_data = self.get_all_assortment()
-            if not assortment_data:
+            # Получаем товары для нац.каталога
+            filtered_items = self.get_catalog_items()
+            if filtered_items is None:
                 print("   ❌ Не удалось получить данные ассортимента")
                 return None, None, None
 
-            items = assortment_data.get('rows', [])
-            print(f"   📦 Всего товаров из API: {len(items)}")
-            
-            filtered_items = self.process_products_and_variants(items)
             print(f"   ✅ Финальный список: {len(filtered_items)}")
             
             # ПРОВЕРЯЕМ ИНДЕКС
@@ -810,16 +1087,12 @@ class MoySkladAPI:
         try:
             print(f"\n🔍 Получаем товар по индексу: {product_index}")
             
-            # Получаем все товары
-            assortment_data = self.get_all_assortment()
-            if not assortment_data:
+            # Получаем товары для нац.каталога
+            filtered_items = self.get_catalog_items()
+            if filtered_items is None:
                 print("   ❌ Не удалось получить данные ассортимента")
                 return None, None
 
-            items = assortment_data.get('rows', [])
-            print(f"   📦 Всего товаров из API: {len(items)}")
-            
-            filtered_items = self.process_products_and_variants(items)
             print(f"   ✅ Финальный список для отображения: {len(filtered_items)}")
 
             if product_index >= len(filtered_items):
@@ -847,15 +1120,230 @@ class MoySkladAPI:
 
 
 
-# Создаем экземпляр API
-api = MoySkladAPI()
+# Клиенты МойСклад аккаунтов (tenants.py)
+def attach_tenant_services(tenant):
+    """Клиент МойСклад аккаунта и службы, которым он нужен"""
+    if tenant.default:
+        tenant.api = MoySkladAPI()
+    else:
+        tenant.api = MoySkladAPI(tenant.ms_token, tenant.scheduler, tenant.mirror, tenant.webhook_secret)
+        tenant.scheduler.observer = scheduler.observer
+    tenant.webhook_batcher = WebhookBatcher(tenant.api, tenant.mirror)
+    tenant.progress_poller = ProgressPoller(tenant.hub, write_gtin=tenant.api.update_product_gtin,
+                                            ledger=tenant.ledger, feed_status=tenant.feed_status)
+    tenant.corrections = BulkCorrections(tenant.api, tenant.mirror)
+
+
+for _tenant in tenants:
+    attach_tenant_services(_tenant)
+
+# Объекты текущего аккаунта (tenants.py): в запросе — выбранного заголовком,
+# параметром или cookie, в фоновой задаче — аккаунта, для которого она поставлена
+api = LocalProxy(lambda: current_tenant().api)
+nk = LocalProxy(lambda: current_tenant().nk)
+send_ledger = LocalProxy(lambda: current_tenant().ledger)
+feed_status_service = LocalProxy(lambda: current_tenant().feed_status)
+nk_product_index = LocalProxy(lambda: current_tenant().nk_index)
+response_cache = LocalProxy(lambda: current_tenant().response_cache)
+progress_hub = LocalProxy(lambda: current_tenant().hub)
+progress_poller = LocalProxy(lambda: current_tenant().progress_poller)
+corrections = LocalProxy(lambda: current_tenant().corrections)
+
+
+def _job_tenant_name(job):
+    return job['params'].get('tenant') or tenants.default.name
+
+
+def _job_tenant(job):
+    """Аккаунт задачи; LookupError — аккаунт убран из TENANTS_FILE"""
+    try:
+        return tenants.get(_job_tenant_name(job))
+    except LookupError:
+        raise LookupError(f"Аккаунт задачи {_job_tenant_name(job)} не найден в TENANTS_FILE") from None
+
+
+def _publish_job(job):
+    try:
+        tenant = _job_tenant(job)
+    except LookupError:
+        return
+    tenant.hub.publish(EVENT_JOB, job)
+
+
+# Задача аккаунта, которого больше нет, завершается с ошибкой (job_context бросает LookupError)
+job_queue = JobQueue(on_progress=_publish_job,
+                     job_context=lambda job: use_tenant(_job_tenant(job)))
+
+
+def submit_job(kind, params):
+    """Ставит задачу в очередь от имени текущего аккаунта"""
+    return job_queue.submit(kind, dict(params, tenant=current_tenant().name))
+
+
+def _tenant_job(job_id):
+    """Задача текущего аккаунта (чужие задачи не видны)"""
+    job = job_queue.get(job_id)
+    return job if job is not None and _job_tenant_name(job) == current_tenant().name else None
+
+
+@app.before_request
+def select_tenant():
+    """Аккаунт запроса: заголовок X-Tenant, параметр ?tenant= или cookie"""
+    name = request.headers.get(TENANTS['header']) or request.args.get(TENANTS['query_arg'])
+    if not name and request.cookies.get(TENANTS['cookie']) in tenants.names():
+        name = request.cookies.get(TENANTS['cookie'])
+    try:
+        tenant = tenants.get(name)
+    except LookupError as e:
+        return jsonify({'error': str(e), 'tenants': tenants.names()}), 404
+    g.tenant_token = activate_tenant(tenant)
+
+
+@app.after_request
+def remember_tenant(response):
+    """Аккаунт из ?tenant= запоминается: запросы страницы к /api/products идут в тот же аккаунт"""
+    name = request.args.get(TENANTS['query_arg'])
+    if name and name in tenants.names() and request.cookies.get(TENANTS['cookie']) != name:
+        response.set_cookie(TENANTS['cookie'], name, samesite='Lax')
+    return response
+
+
+@app.teardown_request
+def release_tenant(exc=None):
+    token = g.pop('tenant_token', None)
+    if token is not None:
+        deactivate_tenant(token)
+
+
+@app.route('/tenants')
+def tenants_route():
+    """Аккаунты приложения и текущий аккаунт запроса"""
+    return jsonify({
+        'current': current_tenant().name,
+        'tenants': [tenant.describe() for tenant in tenants],
+    })
+
+
+@app.route(WEBHOOKS['path'], methods=['POST'])
+@app.route(f"{WEBHOOKS['path']}/<tenant_name>", methods=['POST'])
+def moysklad_webhook(tenant_name=None):
+    """Прием событий МойСклад: изменения применяются к зеркалу аккаунта пачками"""
+    try:
+        tenant = tenants.get(tenant_name)
+    except LookupError:
+        return jsonify({"error": "forbidden"}), 403
+    if tenant.webhook_path != request.path or not verify_token(request.args.get('token'), tenant.webhook_secret):
+        return jsonify({"error": "forbidden"}), 403
+    accepted = tenant.webhook_batcher.add(parse_events(request.get_json(silent=True)))
+    return jsonify({"accepted": accepted})
+
+
+@app.route('/webhooks/status')
+def webhooks_status_route():
+    """Состояние зеркала ассортимента и очереди вебхуков"""
+    tenant = current_tenant()
+    return jsonify({
+        "enabled": webhooks_enabled(tenant.webhook_secret),
+        "path": tenant.webhook_path,
+        "mirror_loaded": tenant.mirror.loaded,
+        "mirror_version": tenant.mirror.version,
+        "mirror_age": tenant.mirror.age(),
+        "pending": tenant.webhook_batcher.pending(),
+        "stats": tenant.webhook_batcher.stats,
+    })
+
+
+@app.route('/rate_limits')
+def rate_limits_route():
+    """Метрики планировщика запросов аккаунта: скорость, очередь по приоритетам, ожидание, 429"""
+    return jsonify(current_tenant().scheduler.metrics())
+
+
+def _admin_request_allowed() -> bool:
+    token = request.headers.get('X-Admin-Token') or request.args.get('token')
+    return admin_allowed(token, request.remote_addr)
+
+
+@app.route('/admin/profiles')
+def admin_profiles_route():
+    """Последние профили запросов (см. profiling.py)"""
+    if not _admin_request_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({"profiles": profile_store.recent(limit)})
+
+
+@app.route('/admin/profiles/<profile_id>')
+def admin_profile_route(profile_id):
+    """Файл профиля: ?format=json (сводка), collapsed или speedscope"""
+    if not _admin_request_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    kind = request.args.get('format', 'speedscope')
+    path = profile_store.path(profile_id, kind)
+    if path is None:
+        return jsonify({"error": "profile not found"}), 404
+    mimetype = 'text/plain' if kind == 'collapsed' else 'application/json'
+    return send_file(path.resolve(), mimetype=mimetype, as_attachment=kind != 'json', download_name=path.name)
+
+
+def _sse(event_id, event_type, data) -> str:
+    return f"id: {event_id}\nevent: {event_type}\ndata: {dumps_str(data)}\n\n"
+
+
+@app.route('/events')
+def events_stream_route():
+    """
+    Server-Sent Events: статусы фидов, GTIN и запись GTIN в МойСклад
+    для всех незавершенных отправок. Первое событие — snapshot.
+    """
+    after = request.headers.get('Last-Event-ID', request.args.get('after', ''))
+    after = int(after) if after.isdigit() else None
+    # Поток читается после выхода из обработчика — аккаунт фиксируется здесь
+    tenant = current_tenant()
+    tenant.progress_poller.ensure_running()
+
+    def generate():
+        with tenant.hub.subscription():
+            last_id = tenant.hub.last_id if after is None else after
+            if after is None:
+                yield _sse(last_id, 'snapshot', {'jobs': outstanding_jobs(tenant.ledger)})
+            while True:
+                events = tenant.hub.wait(last_id, PROGRESS['keepalive'])
+                if not events:
+                    yield ': keepalive\n\n'
+                    continue
+                for event_id, event_type, data in events:
+                    last_id = event_id
+                    yield _sse(event_id, event_type, data)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/events/poll')
+def events_poll_route():
+    """Long-poll вместо SSE: ?after=<последний id>&timeout=<секунд>; без after — снимок"""
+    progress_poller.ensure_running()
+    after = request.args.get('after', type=int)
+    if after is None:
+        return jsonify({'last_id': progress_hub.last_id, 'jobs': outstanding_jobs(current_tenant().ledger)})
+    timeout = min(max(request.args.get('timeout', 25.0, type=float), 0.0), 60.0)
+    with progress_hub.subscription():
+        events = progress_hub.wait(after, timeout)
+    return jsonify({
+        'last_id': events[-1][0] if events else after,
+        'events': [{'id': event_id, 'type': event_type, 'data': data} for event_id, event_type, data in events],
+    })
 
 
 @app.route('/custom_fields/check')
 def check_custom_fields_route():
     """Возвращает существующие и отсутствующие пользовательские атрибуты"""
     try:
-        existing = [attr.get("name") for attr in api.get_product_attributes()]
+        if not api.attributes.loaded:
+            error = api.attributes.load_error
+            return jsonify({"error": "Не удалось загрузить метаданные атрибутов" + (f": {error}" if error else "")})
+        existing = api.attributes.names()
         missing = api.check_missing_custom_fields()
         return jsonify({"existing": existing, "missing": missing})
     except Exception as e:
@@ -872,9 +1360,7 @@ def create_custom_fields_route():
             success = api.create_custom_field(field_name)
             return jsonify({"created": [field_name] if success else []})
 
-    """Создает отсутствующие пользовательские атрибуты"""
-    try:
-
+        # Без имени создаем все отсутствующие пользовательские атрибуты
         created = api.create_missing_custom_fields()
         return jsonify({"created": created})
     except Exception as e:
@@ -882,63 +1368,109 @@ def create_custom_fields_route():
 
 @app.route('/')
 def index():
-    """Главная страница с товарами в табличном виде"""
+    """
+    Главная страница с товарами в табличном виде.
+    HTML не зависит от размера каталога: строки загружаются из /api/products
+    и рисуются на странице только в видимом окне прокрутки.
+    """
+    entry = response_cache.get('table_page', 0)
+    if entry is None:
+        entry = response_cache.put('table_page', render_template('table.html').encode('utf-8'),
+                                   'text/html', version=0)
+    return response_cache.respond(entry)
+
+
+@app.route('/api/products')
+def api_products():
+    """
+    API endpoint для получения данных в JSON.
+    Поддерживает If-None-Match / If-Modified-Since и gzip/br; при зеркале
+    ассортимента тело строится и сжимается один раз на версию снимка.
+    """
     try:
-        print("Начинаем загрузку данных...")
-        # Получаем данные из API
-        assortment_data = api.get_all_assortment()
-        
-        if not assortment_data:
-            print("Не удалось получить данные из API")
-            return render_template('error.html', message="Ошибка при загрузке данных из МойСклад")
-        
-        # Получаем список товаров
-        items = assortment_data.get('rows', [])
-        print(f"Получено товаров из API: {len(items)}")
-        
-        # Обрабатываем товары и варианты с фильтрацией по галочке
-        filtered_items = api.process_products_and_variants(items)
-        print(f"Отфильтровано для отображения: {len(filtered_items)}")
+        version = api.catalog_version()
+        entry = response_cache.get('api_products', version)
+        if entry is not None:
+            return response_cache.respond(entry)
+
+        stats = {}
+        filtered_items = api.get_catalog_items(stats)
         
-        # Извлекаем нужные данные с наследованием
-        products = []
-        for item in filtered_items:
-            product_data = api.extract_item_data_with_inheritance(item)
-            products.append(product_data)
+        if filtered_items is None:
+            return jsonify({'error': 'Ошибка при загрузке данных из МойСклад'}), 500
         
-        print(f"Обработано товаров для отображения: {len(products)}")
-        return render_template('table.html', products=products, total_items=len(items))
         
+        products = api.extract_items_data(filtered_items)
+        body = dumps({
+            'products': products,
+            'total_filtered': len(products),
+            'total_items': stats.get('total_items', 0)
+        })
+
+        # Тело привязывается к версии, только если снимок не менялся, пока оно строилось
+        snapshot = version if version is not None and api.catalog_version() == version else None
+        entry = response_cache.put(
+            'api_products', body, 'application/json', version=snapshot,
+            last_modified=api.mirror.updated_at if snapshot is not None else None
+        )
+        return response_cache.respond(entry)
     except Exception as e:
-        print(f"Ошибка в главной странице: {e}")
-        import traceback
-        traceback.print_exc()
-        return render_template('error.html', message=f"Внутренняя ошибка: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
+@app.route('/send_ledger/needs_resend')
+def needs_resend_route():
+    """Товары, карточки которых изменились с последней принятой отправки"""
+    try:
+        filtered_items = api.get_catalog_items()
+        if filtered_items is None:
+            return jsonify({'error': 'Ошибка при загрузке данных из МойСклад'}), 500
 
+        # Хеш по полям товара без правок из превью; проверка НК на них не влияет
+        hashes = {}
+        indexes = {}
+        for index, item in enumerate(filtered_items):
+            hashes[item.get('id')] = card_content_hash(api._extract_item_fields(item))
+            indexes[item.get('id')] = index
 
+        item_ids = send_ledger.needs_resend(hashes)
+        return jsonify({
+            'items': [{'id': item_id, 'product_index': indexes[item_id]} for item_id in item_ids],
+            'total_changed': len(item_ids),
+            'total_filtered': len(filtered_items)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/api/products')
-def api_products():
-    """API endpoint для получения данных в JSON"""
+@app.route('/sync/changes')
+def sync_changes_route():
+    """
+    Набор изменений для синхронизации с НК: новые товары и товары,
+    у которых NK-значимые поля отличаются от последней принятой отправки.
+    Валидация выполняется только для измененных строк.
+    """
     try:
-        assortment_data = api.get_all_assortment()
-        
-        if not assortment_data:
+        filtered_items = api.get_catalog_items()
+        if filtered_items is None:
             return jsonify({'error': 'Ошибка при загрузке данных из МойСклад'}), 500
-        
-        items = assortment_data.get('rows', [])
-        filtered_items = api.process_products_and_variants(items)
-        
-        products = []
-        for item in filtered_items:
-            product_data = api.extract_item_data_with_inheritance(item)
-            products.append(product_data)
-        
+
+        rows = [api._extract_item_fields(item) for item in filtered_items]
+        delta = detect_changes(rows, send_ledger.accepted_fingerprints())
+        changed_rows = api.validate_items_data([change['row'] for change in delta['changes']])
+
         return jsonify({
-            'products': products,
-            'total_filtered': len(products),
-            'total_items': len(items)
+            'changes': [
+                {
+                    'id': change['id'],
+                    'product_index': change['index'],
+                    'change': change['change'],
+                    'fields': change['fields'],
+                    'product': row
+                }
+                for change, row in zip(delta['changes'], changed_rows)
+            ],
+            'total_changed': len(delta['changes']),
+            'total_unchanged': delta['unchanged'],
+            'total_filtered': len(filtered_items)
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -963,12 +1495,10 @@ def update_gtin():
         print(f"   🔍 Получаем товар тем же способом, что и в send_product_to_nk")
         
         # Получаем все товары (ТОЧНО ТА ЖЕ ЛОГИКА)
-        assortment_data = api.get_all_assortment()
-        if not assortment_data:
+        filtered_items = api.get_catalog_items()
+        if filtered_items is None:
             return jsonify({'success': False, 'message': 'Не удалось загрузить данные'})
 
-        items = assortment_data.get('rows', [])
-        filtered_items = api.process_products_and_variants(items)
 
         if product_index >= len(filtered_items):
             return jsonify({'success': False, 'message': f'Товар с индексом {product_index} не найден'})
@@ -991,6 +1521,8 @@ def update_gtin():
         
         # Обновляем GTIN в МойСклад
         result = api.update_product_gtin(item_id, new_gtin, is_variant=is_variant)
+        if result.get('success'):
+            send_ledger.mark_gtin_written(item_id, result.get('gtin'))
         
         print(f"   📊 Результат update_product_gtin:")
         print(f"     • success: {result.get('success')}")
@@ -1007,48 +1539,51 @@ def update_gtin():
         return jsonify({'success': False, 'message': error_msg})
 
 
+def feed_status_response(feed_id, feed_info):
+    """Ответ о статусе фида для UI; статус и GTIN записываются в журнал отправок"""
+    if not feed_info.get("success"):
+        return feed_info
+
+    # Форматируем ответ
+    formatted_response = format_status_response(feed_info)
+    send_ledger.update_feed(feed_id, ledger_status(formatted_response), formatted_response.get("gtin"))
+    
+    # Добавляем читаемые сообщения об ошибках
+    if formatted_response.get("status") == "Rejected" and formatted_response.get("errors"):
+        error_messages = []
+        for error in formatted_response["errors"]:
+            if error.get("attr_name"):
+                msg = f"• {error['attr_name']}: {error['message']}"
+            else:
+                msg = f"• {error['message']}"
+            
+            if error.get("value"):
+                msg += f" (значение: '{error['value']}')"
+                
+            error_messages.append(msg)
+        
+        formatted_response["error_summary"] = "\n".join(error_messages)
+    
+    # Логируем для отладки
+    if formatted_response.get("status") == "Rejected":
+        print(f"\n❌ Feed {feed_id} отклонен:")
+        print(f"Статус: {formatted_response.get('status')}")
+        if formatted_response.get("error_summary"):
+            print("Ошибки:")
+            print(formatted_response["error_summary"])
+        print("\nПолный ответ API:")
+        print(json.dumps(formatted_response.get("raw_response", {}), indent=2, ensure_ascii=False))
+    
+    return formatted_response
+
+
 @app.route('/check_feed_status/<feed_id>')
 def check_feed_status_route(feed_id):
     """Проверяет статус обработки фида в НК с детальной информацией"""
     try:
-        from nk_api import check_feed_status, format_status_response
-        
-        # Получаем детальную информацию
-        feed_info = check_feed_status(feed_id)
-        
-        if not feed_info.get("success"):
-            return jsonify(feed_info)
-            
-        # Форматируем ответ
-        formatted_response = format_status_response(feed_info)
-        
-        # Добавляем читаемые сообщения об ошибках
-        if formatted_response.get("status") == "Rejected" and formatted_response.get("errors"):
-            error_messages = []
-            for error in formatted_response["errors"]:
-                if error.get("attr_name"):
-                    msg = f"• {error['attr_name']}: {error['message']}"
-                else:
-                    msg = f"• {error['message']}"
-                
-                if error.get("value"):
-                    msg += f" (значение: '{error['value']}')"
-                    
-                error_messages.append(msg)
-            
-            formatted_response["error_summary"] = "\n".join(error_messages)
-        
-        # Логируем для отладки
-        if formatted_response.get("status") == "Rejected":
-            print(f"\n❌ Feed {feed_id} отклонен:")
-            print(f"Статус: {formatted_response.get('status')}")
-            if formatted_response.get("error_summary"):
-                print("Ошибки:")
-                print(formatted_response["error_summary"])
-            print("\nПолный ответ API:")
-            print(json.dumps(formatted_response.get("raw_response", {}), indent=2, ensure_ascii=False))
-        
-        return jsonify(formatted_response)
+        # Одновременные проверки одного фида схлопываются в один запрос к НК
+        feed_info = feed_status_service.lookup(feed_id)
+        return jsonify(feed_status_response(feed_id, feed_info))
         
     except Exception as e:
         import traceback
@@ -1058,6 +1593,28 @@ def check_feed_status_route(feed_id):
             "error": str(e),
             "traceback": traceback.format_exc()
         })
+
+
+@app.route('/feed_status/batch', methods=['GET', 'POST'])
+def feed_status_batch_route():
+    """
+    Статусы многих фидов за один запрос:
+    POST {"feed_ids": [...]} или GET ?feed_ids=1,2,3.
+    """
+    if request.method == 'POST':
+        feed_ids = (request.get_json(silent=True) or {}).get('feed_ids')
+    else:
+        feed_ids = [part for part in request.args.get('feed_ids', '').split(',') if part]
+    if not isinstance(feed_ids, list) or not feed_ids:
+        return jsonify({'error': 'Ожидается непустой список feed_ids'}), 400
+    if len(feed_ids) > FEED_STATUS['max_batch']:
+        return jsonify({'error': f"Не больше {FEED_STATUS['max_batch']} фидов за запрос"}), 400
+
+    infos = feed_status_service.lookup_many(feed_ids)
+    return jsonify({
+        'statuses': {feed_id: feed_status_response(feed_id, info) for feed_id, info in infos.items()},
+        'stats': feed_status_service.stats,
+    })
     
 def apply_user_changes(product_data, user_changes):
     """Применяет пользовательские изменения к данным товара"""
@@ -1078,6 +1635,133 @@ def apply_user_changes(product_data, user_changes):
     
     return modified_data, applied_changes
 
+def _category_info(cat_id):
+    if not cat_id:
+        return None
+    cat_data = get_category_by_id(cat_id)
+    if not cat_data:
+        return None
+    return {'id': cat_id, 'name': cat_data.get('category_name', 'Неизвестная категория')}
+
+
+def prepare_batch_previews(filtered_items, entries):
+    """
+    Находит товары пакетного превью и валидирует их одним проходом.
+    entries — [{'id' или 'product_index', 'user_changes'}].
+    Возвращает (подготовленные строки, ненайденные ключи); строка записи
+    неверного вида содержит только error.
+    """
+    by_id = {item.get('id'): index for index, item in enumerate(filtered_items)}
+    prepared = []
+    missing = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            missing.append(entry)
+            continue
+        error = None
+        if entry.get('id') is not None and not isinstance(entry['id'], str):
+            error = 'id должен быть строкой'
+        elif not isinstance(entry.get('user_changes') or {}, dict):
+            error = 'user_changes должен быть объектом'
+        if error:
+            prepared.append({'id': None, 'product_index': None, 'error': error})
+            continue
+        if entry.get('id') is not None:
+            index = by_id.get(entry['id'])
+        else:
+            index = entry.get('product_index')
+            if not isinstance(index, int) or not 0 <= index < len(filtered_items):
+                index = None
+        if index is None:
+            missing.append(entry.get('id', entry.get('product_index')))
+            continue
+
+        item = filtered_items[index]
+        product_data = api._extract_item_fields(item)
+        user_changes = entry.get('user_changes') or {}
+        modified_data, applied_changes = apply_user_changes(product_data, user_changes)
+        prepared.append({
+            'id': item.get('id'),
+            'product_index': index,
+            'product_data': product_data,
+            'modified_data': modified_data,
+            'user_changes': user_changes,
+            'applied_changes': applied_changes,
+        })
+
+    # Цвета и виды проверяются по различным значениям всего пакета сразу
+    api.validate_items_data([row['modified_data'] for row in prepared if 'error' not in row])
+    return prepared, missing
+
+
+def build_batch_preview(row):
+    """Карточка одного товара пакета в том же виде, что и /nk_preview/<index>"""
+    if 'error' in row:
+        return row
+    try:
+        card_hash, card_data = card_cache.get_or_build(row['product_data'], row['modified_data'], row['user_changes'])
+    except Exception as e:
+        return {'id': row['id'], 'product_index': row['product_index'], 'error': str(e)}
+    cat_id = card_data['categories'][0] if card_data.get('categories') else None
+    result = {
+        'id': row['id'],
+        'product_index': row['product_index'],
+        'product_data': row['modified_data'],
+        'nk_card_data': card_data,
+        'category_id': cat_id,
+        'category_info': _category_info(cat_id),
+        'brand': card_data.get('brand', 'БрендОдежды'),
+        'card_hash': card_hash,
+        'preflight': validate_card(card_data),
+    }
+    if row['applied_changes']:
+        result['applied_changes'] = row['applied_changes']
+    return result
+
+
+@app.route('/nk_preview/batch', methods=['POST'])
+def preview_nk_cards_batch():
+    """
+    Предпросмотр многих карточек за один запрос.
+    Тело: {"items": [{"id": "...", "user_changes": {...}}, {"product_index": 3}]}.
+    С ?stream=1 карточки отдаются построчно (NDJSON) по мере готовности,
+    последней строкой — {"summary": ...}.
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get('items')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'Ожидается непустой список items'}), 400
+    if len(entries) > BATCH_PREVIEW_MAX_ITEMS:
+        return jsonify({'error': f'Не больше {BATCH_PREVIEW_MAX_ITEMS} товаров за запрос'}), 400
+
+    filtered_items = api.get_catalog_items()
+    if filtered_items is None:
+        return jsonify({'error': 'Не удалось загрузить данные'}), 502
+
+    prepared, missing = prepare_batch_previews(filtered_items, entries)
+    print(f"🧾 Пакетное превью: {len(prepared)} товаров, не найдено {len(missing)}")
+
+    def summary(cards):
+        errors = sum('error' in card for card in cards)
+        invalid = sum(not card.get('preflight', {}).get('valid', True) for card in cards)
+        return {'requested': len(entries), 'built': len(cards) - errors, 'errors': errors,
+                'invalid': invalid, 'missing': missing}
+
+    if request.args.get('stream') in ('1', 'true'):
+        def generate():
+            cards = []
+            for row in prepared:
+                result = build_batch_preview(row)
+                cards.append({'error': True} if 'error' in result else {'preflight': result['preflight']})
+                yield dumps_str(result) + '\n'
+            yield dumps_str({'summary': summary(cards)}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    cards = [build_batch_preview(row) for row in prepared]
+    return jsonify({'cards': cards, 'summary': summary(cards)})
+
+
 @app.route('/nk_preview/<int:product_index>', methods=['GET', 'POST'])
 def preview_nk_card(product_index):
     """Предпросмотр карточки для отправки в НК с поддержкой пользовательских изменений"""
@@ -1090,12 +1774,10 @@ def preview_nk_card(product_index):
             print(f"📝 Получены пользовательские изменения для превью: {user_changes}")
         
         # Получаем все товары
-        assortment_data = api.get_all_assortment()
-        if not assortment_data:
+        filtered_items = api.get_catalog_items()
+        if filtered_items is None:
             return jsonify({'error': 'Не удалось загрузить данные'})
         
-        items = assortment_data.get('rows', [])
-        filtered_items = api.process_products_and_variants(items)
         
         if product_index >= len(filtered_items):
             return jsonify({'error': 'Товар не найден'})
@@ -1107,28 +1789,21 @@ def preview_nk_card(product_index):
         # Применяем пользовательские изменения
         modified_data, applied_changes = apply_user_changes(product_data, user_changes)
         
-        # Создаем превью карточки для НК
-        card_data = create_card_data(modified_data)
+        # Создаем превью карточки для НК (или берем готовую из кеша)
+        card_hash, card_data = card_cache.get_or_build(product_data, modified_data, user_changes)
         
         # Получаем информацию о категории
         cat_id = card_data['categories'][0] if card_data.get('categories') else None
-        category_info = None
-        
-        if cat_id:
-            from nk_api import get_category_by_id
-            cat_data = get_category_by_id(cat_id)
-            if cat_data:
-                category_info = {
-                    'id': cat_id,
-                    'name': cat_data.get('category_name', 'Неизвестная категория')
-                }
+        category_info = _category_info(cat_id)
         
         response_data = {
             'product_data': modified_data,  # Используем измененные данные
             'nk_card_data': card_data,
             'category_id': cat_id,
             'category_info': category_info,
-            'brand': card_data.get('brand', 'БрендОдежды')
+            'brand': card_data.get('brand', 'БрендОдежды'),
+            'card_hash': card_hash,
+            'preflight': validate_card(card_data)
         }
         
         # Добавляем информацию о примененных изменениях
@@ -1143,6 +1818,17 @@ def preview_nk_card(product_index):
         traceback.print_exc()
         return jsonify({'error': str(e)})
 
+def submit_card(item, product_data, card_hash, card_data, user_changes=None):
+    """
+    card_submission.submit_card для аккаунта запроса или задачи.
+    Общая часть /send_to_nk и фоновой задачи send (job_queue); после
+    отправки запускается опрос фидов.
+    """
+    submitted = submit_card_to_nk(current_tenant(), item, product_data, card_hash, card_data, user_changes)
+    if submitted['outcome'] == 'sent':
+        progress_poller.ensure_running()
+    return submitted
+
 @app.route('/send_to_nk/<int:product_index>', methods=['POST'])
 def send_product_to_nk(product_index):
     """Отправляет конкретный товар в национальный каталог с поддержкой пользовательских изменений"""
@@ -1150,21 +1836,19 @@ def send_product_to_nk(product_index):
         # Получаем пользовательские изменения из запроса
         request_data = request.get_json() or {}
         user_changes = request_data.get('user_changes', {})
+        previewed_hash = request_data.get('card_hash')
         
         print(f"\n🚀 === НАЧИНАЕМ ОТПРАВКУ ТОВАРА С ИНДЕКСОМ {product_index} ===")
         if user_changes:
             print(f"📝 С пользовательскими изменениями: {user_changes}")
         
         # Получаем все товары (та же логика, что и в главной странице)
-        assortment_data = api.get_all_assortment()
-        if not assortment_data:
+        stats = {}
+        filtered_items = api.get_catalog_items(stats)
+        if filtered_items is None:
             return jsonify({'success': False, 'error': 'Не удалось загрузить данные'})
 
-        items = assortment_data.get('rows', [])
-        print(f"📦 Всего товаров из API: {len(items)}")
-        
-        # Обрабатываем товары и варианты
-        filtered_items = api.process_products_and_variants(items)
+        print(f"📦 Всего товаров из API: {stats.get('total_items', 0)}")
         print(f"✅ Финальный список для отправки: {len(filtered_items)}")
 
         if product_index >= len(filtered_items):
@@ -1203,38 +1887,63 @@ def send_product_to_nk(product_index):
 
         print(f"📋 Создаем карточку для НК...")
 
-        # Создаем карточку с измененными данными
-        card_data = create_card_data(modified_data)
-        print(f"✅ Карточка создана")
+        # Карточка с измененными данными: та же, что была в превью, если данные не менялись
+        card_hash, card_data = card_cache.get_or_build(product_data, modified_data, user_changes)
+        preview_outdated = bool(previewed_hash) and previewed_hash != card_hash
+        if preview_outdated:
+            print(f"⚠️  Данные изменились после превью, карточка пересобрана")
+        print(f"✅ Карточка готова: {card_hash[:12]}")
+
+        submitted = submit_card(item, product_data, card_hash, card_data, user_changes)
+        outcome = submitted['outcome']
+        existing = submitted.get('existing')
+        feed_id = submitted.get('feed_id')
+        duplicate = outcome == 'duplicate'
+        resumed = outcome == 'resumed'
+
+        if outcome == 'invalid':
+            return jsonify({
+                'success': False,
+                'error': 'Карточка не прошла проверку по схеме категории НК',
+                'errors': submitted['errors'],
+                'warnings': submitted['warnings'],
+                'card_hash': card_hash
+            })
 
-        # Отправляем в НК
-        print(f"📤 Отправляем в национальный каталог...")
-        send_result = send_card_to_nk(card_data)
-        
-        if not send_result.get("success"):
-            error_msg = send_result.get('error', 'Ошибка отправки карточки')
-            print(f"❌ Ошибка отправки: {error_msg}")
+        if outcome == 'carded':
             return jsonify({
                 'success': False,
-                'error': error_msg,
-                'status_code': send_result.get('status_code')
+                'carded': True,
+                'gtin': submitted['gtin'],
+                'error': f"Товар уже есть в НК (GTIN {submitted['gtin']}), повторная отправка не нужна",
+                'card_hash': card_hash
             })
 
-        # Проверяем статус по feed_id
-        feed_id = send_result.get("feed_id")
-        if not feed_id:
-            print(f"❌ Не получен feed_id от НК")
+        if outcome == 'in_progress':
             return jsonify({
                 'success': False,
-                'error': 'Не получен feed_id от национального каталога'
+                'in_progress': True,
+                'error': 'Эта карточка уже отправляется, дождитесь результата',
+                'card_hash': card_hash
             })
 
-        print(f"✅ Карточка отправлена в НК, feed_id: {feed_id}")
-        print(f"🔍 Проверяем статус обработки...")
+        if outcome == 'failed':
+            return jsonify({
+                'success': False,
+                'error': submitted['error'],
+                'status_code': submitted.get('status_code')
+            })
 
-        # Получаем статус обработки
-        status_info = check_feed_status(feed_id)
-        full_result = format_status_response(status_info)
+        if duplicate:
+            full_result = {
+                'status': existing['status'],
+                'gtin': existing['gtin']
+            }
+        else:
+            print(f"🔍 Проверяем статус обработки...")
+            status_info = feed_status_service.lookup(feed_id)
+            full_result = format_status_response(status_info)
+            send_ledger.update_feed(feed_id, ledger_status(full_result), full_result.get("gtin"))
 
         # Получаем GTIN из ответа
         gtin = full_result.get("gtin")
@@ -1247,15 +1956,26 @@ def send_product_to_nk(product_index):
             print(f"⚠️  GTIN пока не получен")
         
         # Формируем базовый ответ
+        if duplicate:
+            message = f'Карточка "{product_name}" уже принята НК, повторная отправка не требуется'
+        elif resumed:
+            message = f'Карточка "{product_name}" уже отправлена, фид в обработке'
+        else:
+            message = f'Карточка "{product_name}" отправлена'
+
         response_data = {
             'success': True,
+            'duplicate': duplicate,
+            'resumed': resumed,
             'feed_id': feed_id,
             'product_name': product_name,
-            'message': f'Карточка "{product_name}" отправлена',
+            'message': message,
             'status': status,
             'gtin': gtin,
             'gtin_updated_in_ms': False,
-            'ms_update_message': None
+            'ms_update_message': None,
+            'card_hash': card_hash,
+            'preview_outdated': preview_outdated
         }
         
         # Добавляем информацию о примененных изменениях
@@ -1263,7 +1983,10 @@ def send_product_to_nk(product_index):
             response_data['applied_changes'] = applied_changes
 
         # Если получили GTIN, пытаемся обновить его в МойСклад
-        if gtin:
+        if duplicate and existing['gtin_written']:
+            response_data['gtin_updated_in_ms'] = True
+            response_data['ms_update_message'] = f'GTIN {gtin} уже записан в МойСклад'
+        elif gtin:
             print(f"\n💾 === ОБНОВЛЯЕМ GTIN В МОЙСКЛАД ===")
             
             # Используем тот же способ определения товара/варианта
@@ -1281,6 +2004,7 @@ def send_product_to_nk(product_index):
                 gtin_update_result = api.update_product_gtin(item_id, gtin, is_variant)
                 
                 if gtin_update_result.get('success'):
+                    send_ledger.mark_gtin_written(item_id, gtin)
                     response_data['gtin_updated_in_ms'] = True
                     response_data['ms_update_message'] = gtin_update_result.get('message')
                     response_data['message'] += f" и GTIN обновлен в МойСклад"
@@ -1313,6 +2037,335 @@ def send_product_to_nk(product_index):
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)})
 
+# --- Фоновые задачи (job_queue) -------------------------------------------
+
+def _job_catalog(ctx):
+    """Каталог загружается один раз на запуск задачи: {item_id: item}"""
+    if 'catalog' not in ctx:
+        filtered_items = api.get_catalog_items()
+        if filtered_items is None:
+            raise RuntimeError('Не удалось загрузить данные из МойСклад')
+        ctx['catalog'] = {item.get('id'): item for item in filtered_items}
+    return ctx['catalog']
+
+
+def _skip_carded(catalog, item_ids):
+    """Без товаров, чей GTIN из МойСклад уже есть в НК (список карточек НК загружается при необходимости)"""
+    if not RECONCILE['skip_carded'] or not item_ids:
+        return item_ids
+    try:
+        nk_product_index.ensure()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"⚠️  Карточки НК не загружены ({e}), отправка без сверки")
+        return item_ids
+    kept = [item_id for item_id in item_ids if not nk_product_index.carded_gtin(catalog[item_id])]
+    if len(kept) < len(item_ids):
+        print(f"⏭️  Пропущено {len(item_ids) - len(kept)} товаров, уже имеющих карточку в НК")
+    return kept
+
+
+def plan_send_job(params, ctx):
+    """
+    Элементы задачи send:
+      {'items': [{'id', 'user_changes'}]} — выбранные товары;
+      {'scope': 'changes'}      — новые и измененные с последней принятой отправки (полная синхронизация);
+      {'scope': 'needs_resend'} — товары, данные которых изменились с последней принятой
+                                  отправки; ее правки (user_changes) переносятся в новую.
+    """
+    if params.get('items'):
+        for entry in params['items']:
+            entry = entry if isinstance(entry, dict) else {'id': entry}
+            yield entry['id'], {'id': entry['id'], 'user_changes': entry.get('user_changes') or {}}
+        return
+
+    catalog = _job_catalog(ctx)
+    scope = params.get('scope', 'changes')
+    if scope == 'changes':
+        rows = [api._extract_item_fields(item) for item in catalog.values()]
+        item_ids = [change['id'] for change in detect_changes(rows, send_ledger.accepted_fingerprints())['changes']]
+    elif scope == 'needs_resend':
+        hashes = {item_id: card_content_hash(api._extract_item_fields(item)) for item_id, item in catalog.items()}
+        item_ids = send_ledger.needs_resend(hashes)
+    else:
+        raise ValueError(f'Неизвестный scope: {scope}')
+    accepted = send_ledger.last_accepted()
+    for item_id in _skip_carded(catalog, item_ids):
+        user_changes = accepted[item_id]['user_changes'] if item_id in accepted else {}
+        yield item_id, {'id': item_id, 'user_changes': user_changes}
+
+
+def run_send_item(payload, ctx):
+    item = _job_catalog(ctx).get(payload['id'])
+    if item is None:
+        raise LookupError('Товар не найден среди отмеченных для НК')
+    product_data = api.extract_item_data_with_inheritance(item)
+    modified_data, _ = apply_user_changes(product_data, payload.get('user_changes') or {})
+    if not modified_data.get('name'):
+        raise ValueError('Отсутствует наименование товара')
+    if not modified_data.get('tnved'):
+        raise ValueError('Отсутствует ТН ВЭД')
+
+    card_hash, card_data = card_cache.get_or_build(product_data, modified_data, payload.get('user_changes') or {})
+    submitted = submit_card(item, product_data, card_hash, card_data, payload.get('user_changes'))
+    if submitted['outcome'] == 'invalid':
+        raise ValueError('; '.join(
+            f"{error.get('attr_name') or error['field']}: {error['message']}" for error in submitted['errors']
+        ))
+    if submitted['outcome'] == 'failed':
+        raise RuntimeError(submitted['error'])
+    return {'outcome': submitted['outcome'], 'feed_id': submitted.get('feed_id'), 'card_hash': card_hash}
+
+
+def plan_gtin_job(params, ctx):
+    """
+    Элементы задачи gtin_write_back: {'items': [{'id', 'gtin', 'is_variant'}]}
+    или, без параметров, все принятые отправки с незаписанным GTIN.
+    """
+    if params.get('items'):
+        for entry in params['items']:
+            yield entry['id'], {'id': entry['id'], 'gtin': entry['gtin'],
+                                'is_variant': bool(entry.get('is_variant')), 'ledger': False}
+        return
+    for job in send_ledger.gtin_pending():
+        yield job['item_id'], {'id': job['item_id'], 'gtin': job['gtin'],
+                               'is_variant': job['item_type'] == 'variant', 'ledger': True}
+
+
+def run_gtin_item(payload, ctx):
+    result = api.update_product_gtin(payload['id'], payload['gtin'], payload['is_variant'])
+    if payload['ledger'] and result.get('success'):
+        send_ledger.mark_gtin_written(payload['id'], payload['gtin'])
+    progress_hub.publish(EVENT_GTIN_WRITTEN, {
+        'item_id': payload['id'],
+        'gtin': payload['gtin'],
+        'success': bool(result.get('success')),
+        'message': result.get('message') or result.get('error'),
+    })
+    if not result.get('success'):
+        raise RuntimeError(result.get('error') or 'GTIN не записан')
+    return {'message': result.get('message')}
+
+
+def plan_custom_fields_job(params, ctx):
+    """Элементы задачи custom_fields: {'names': [...]} или все отсутствующие поля"""
+    for name in params.get('names') or api.check_missing_custom_fields():
+        yield name, {'name': name}
+
+
+def run_custom_field_item(payload, ctx):
+    if api.attributes.get(payload['name']) is not None:
+        return {'created': False, 'message': 'Поле уже существует'}
+    if not api.create_custom_field(payload['name']):
+        raise RuntimeError(f"Не удалось создать поле «{payload['name']}»")
+    return {'created': True}
+
+
+def _correction_params(params):
+    """(правила, правки строк) из параметров; ValueError — неверный формат"""
+    return parse_rules(params.get('rules')), parse_edits(params.get('edits'))
+
+
+def plan_corrections_job(params, ctx):
+    """
+    Элементы задачи corrections — пачки массового обновления МойСклад:
+    {'rules': [{'field', 'from', 'to'}], 'edits': [{'id', 'changes'}]}
+    """
+    rules, edits = _correction_params(params)
+    plan = corrections.plan(_job_catalog(ctx).values(), rules, edits)
+    for number, (entity_type, writes) in enumerate(corrections.chunks(plan['writes'])):
+        yield f"{entity_type}:{number}", {'entity': entity_type, 'writes': writes}
+
+
+def run_corrections_item(payload, ctx):
+    result = corrections.write(payload['entity'], payload['writes'])
+    if result['failed']:
+        details = '; '.join(f"{entry['name']}: {entry['error']}" for entry in result['failed'][:5])
+        raise RuntimeError(f"Не записано {len(result['failed'])} из {len(payload['writes'])}: {details}")
+    return {'updated': len(result['updated'])}
+
+
+def plan_nk_link_job(params, ctx):
+    """
+    Элементы задачи nk_link — пачки записи GTIN найденных карточек НК в МойСклад:
+      {'ids': [...]}               — из сопоставленных (matched) только эти товары, без ids — все;
+      {'links': [{'id', 'gtin'}]}  — явный выбор карточки (например, для ambiguous).
+    """
+    catalog = _job_catalog(ctx)
+    nk_product_index.ensure()
+    if params.get('links'):
+        links = [link for link in params['links'] if normalize_gtin(link.get('gtin')) in nk_product_index.goods]
+    else:
+        ids = set(params.get('ids') or ())
+        links = [
+            result for result in reconcile(api, catalog.values(), nk_product_index)['items']
+            if result['status'] == STATUS_MATCHED and (not ids or result['id'] in ids)
+        ]
+    writes = link_writes(links, catalog)
+    for number, (entity_type, chunk) in enumerate(corrections.chunks(writes)):
+        yield f"{entity_type}:{number}", {'entity': entity_type, 'writes': chunk}
+
+
+def run_nk_link_item(payload, ctx):
+    bulk = [write for write in payload['writes'] if write['body']]
+    result = corrections.write(payload['entity'], bulk) if bulk else {'updated': [], 'failed': []}
+    updated, failed = set(result['updated']), list(result['failed'])
+    for write in payload['writes']:
+        if write['body'] is None:
+            single = api.update_product_gtin(write['id'], write['gtin'], payload['entity'] == 'variant')
+            if single.get('success'):
+                updated.add(write['id'])
+            else:
+                failed.append({'id': write['id'], 'name': write['name'], 'error': single.get('error')})
+
+    for write in payload['writes']:
+        if write['id'] in updated:
+            progress_hub.publish(EVENT_GTIN_WRITTEN, {
+                'item_id': write['id'],
+                'gtin': write['gtin'],
+                'success': True,
+                'message': 'GTIN найденной карточки НК записан в МойСклад',
+            })
+    if failed:
+        details = '; '.join(f"{entry['name']}: {entry['error']}" for entry in failed[:5])
+        raise RuntimeError(f"Не записано {len(failed)} из {len(payload['writes'])}: {details}")
+    return {'linked': len(updated)}
+
+
+job_queue.register('send', plan_send_job, run_send_item)
+job_queue.register('gtin_write_back', plan_gtin_job, run_gtin_item)
+job_queue.register('custom_fields', plan_custom_fields_job, run_custom_field_item)
+job_queue.register('corrections', plan_corrections_job, run_corrections_item)
+job_queue.register('nk_link', plan_nk_link_job, run_nk_link_item)
+
+
+@app.before_request
+def start_job_workers():
+    """
+    Рабочие потоки очереди — только в процессе, который обслуживает запросы:
+    импорт app из pipeline.py, manage_webhooks.py и бенчмарков их не запускает,
+    как и родительский процесс перезагрузчика при debug=True
+    """
+    if JOBS['autostart'] and not job_queue.started:
+        job_queue.start()
+
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def jobs_route():
+    """
+    GET — последние задачи с прогрессом.
+    POST {"kind": "send"|"gtin_write_back"|"custom_fields"|"corrections"|"nk_link", "params": {...}} — ставит задачу в очередь.
+    """
+    if request.method == 'GET':
+        limit = request.args.get('limit', 50, type=int)
+        jobs = job_queue.list(limit, params={'tenant': current_tenant().name},
+                              defaults={'tenant': tenants.default.name})
+        return jsonify({'jobs': jobs})
+
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    if kind not in job_queue.kinds:
+        return jsonify({'error': f'Неизвестный вид задачи: {kind}', 'kinds': sorted(job_queue.kinds)}), 400
+    job = submit_job(kind, data.get('params') or {})
+    print(f"🗂️  Задача {job['id']} ({kind}) поставлена в очередь")
+    return jsonify(job), 202
+
+
+@app.route('/jobs/<int:job_id>')
+def job_route(job_id):
+    """Задача с прогрессом и элементами (?status=failed — только упавшие)"""
+    job = _tenant_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    job['items'] = job_queue.items(job_id, request.args.get('status'), request.args.get('limit', 200, type=int))
+    return jsonify(job)
+
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job_route(job_id):
+    job = job_queue.cancel(job_id) if _tenant_job(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job_route(job_id):
+    """Повтор упавших (и не выполненных из-за отмены) элементов"""
+    job = job_queue.retry(job_id) if _tenant_job(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job)
+
+
+@app.route('/corrections', methods=['POST'])
+def corrections_route():
+    """
+    Исправления цвета, вида товара и размера в МойСклад:
+    {"rules": [{"field": "color", "from": "Голубой", "to": "СВЕТЛО-СИНИЙ"}],
+     "edits": [{"id": "...", "changes": {"product_type": "..."}}], "dry_run": true}
+    dry_run — только список затрагиваемых строк, иначе ставится задача corrections.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        rules, edits = _correction_params(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not rules and not edits:
+        return jsonify({'error': 'Не заданы правила и правки'}), 400
+
+    if not data.get('dry_run'):
+        job = submit_job('corrections', {'rules': data.get('rules') or [], 'edits': data.get('edits') or []})
+        print(f"🗂️  Задача {job['id']} (corrections) поставлена в очередь")
+        return jsonify(job), 202
+
+    filtered_items = api.get_catalog_items()
+    if filtered_items is None:
+        return jsonify({'error': 'Ошибка при загрузке данных из МойСклад'}), 500
+    plan = corrections.plan(filtered_items, rules, edits)
+    writes = defaultdict(int)
+    for write in plan['writes']:
+        writes[write['entity']] += 1
+    return jsonify({
+        'changes': plan['changes'],
+        'skipped': plan['skipped'],
+        'total_changes': len(plan['changes']),
+        'total_writes': dict(writes),
+    })
+
+@app.route('/reconcile', methods=['GET', 'POST'])
+def reconcile_route():
+    """
+    Сверка товаров с карточками НК.
+    GET — отчет: ?status=linked|matched|ambiguous|unmatched, ?refresh=1 — перезагрузить список НК.
+    POST {"ids": [...]} или {"links": [{"id", "gtin"}]} — задача nk_link: запись GTIN в МойСклад.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        job = submit_job('nk_link', {'ids': data.get('ids') or [], 'links': data.get('links') or []})
+        print(f"🗂️  Задача {job['id']} (nk_link) поставлена в очередь")
+        return jsonify(job), 202
+
+    try:
+        if request.args.get('refresh'):
+            nk_product_index.refresh()
+        else:
+            nk_product_index.ensure()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return jsonify({'error': f'Не удалось загрузить карточки НК: {e}'}), 502
+
+    filtered_items = api.get_catalog_items()
+    if filtered_items is None:
+        return jsonify({'error': 'Ошибка при загрузке данных из МойСклад'}), 500
+    report = reconcile(api, filtered_items, nk_product_index)
+    status = request.args.get('status')
+    items = [result for result in report['items'] if not status or result['status'] == status]
+    return jsonify({
+        'summary': report['summary'],
+        'items': items[:request.args.get('limit', 500, type=int)],
+        'total': len(items),
+        'nk_cards': len(nk_product_index.goods),
+    })
+
 if __name__ == '__main__':
     app.run(debug=True)
 
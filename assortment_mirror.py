@@ -0,0 +1,106 @@
+"""
+Зеркало ассортимента МойСклад в памяти
+
+Хранит строки ассортимента (товары и варианты) в порядке МойСклад и
+обновляется точечно по вебхукам. version увеличивается при каждом
+изменении — по нему можно проверять актуальность производных данных;
+updated_at — время последнего изменения (для Last-Modified).
+
+Полная загрузка идет внутри reloading(): одна за раз, а слушатели
+(WebhookBatcher) узнают о ее окончании и применяют события, пришедшие,
+пока ассортимент загружался.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional
+
+
+class AssortmentMirror:
+    def __init__(self):
+        self._rows = {}           # id строки -> строка
+        self._lock = threading.Lock()
+        self.version = 0
+        self.updated_at = time.time()
+        self.loaded_at: Optional[float] = None
+        self.reloading_now = False
+        self._reload_lock = threading.Lock()
+        self._reload_listeners: List[Callable[[], None]] = []
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def on_reloaded(self, listener: Callable[[], None]) -> None:
+        """listener() вызывается после каждой полной загрузки (и неудачной тоже)"""
+        self._reload_listeners.append(listener)
+
+    @contextmanager
+    def reloading(self):
+        """
+        Полная загрузка: параллельные вызовы ждут ее окончания (и могут
+        взять уже загруженное зеркало), события на это время откладываются
+        """
+        with self._reload_lock:
+            self.reloading_now = True
+            try:
+                yield self
+            finally:
+                self.reloading_now = False
+                for listener in list(self._reload_listeners):
+                    try:
+                        listener()
+                    except Exception as e:
+                        print(f"⚠️  Ошибка обработчика загрузки зеркала: {e}")
+
+    def age(self) -> Optional[float]:
+        return time.monotonic() - self.loaded_at if self.loaded else None
+
+    def rows(self) -> List[dict]:
+        """Снимок строк (список, чтобы обновления не мешали обходу)"""
+        with self._lock:
+            return list(self._rows.values())
+
+    def _changed(self) -> None:
+        self.version += 1
+        self.updated_at = time.time()
+
+    def load(self, rows: Iterable[dict]) -> int:
+        """Полностью заменяет содержимое зеркала"""
+        new_rows = {row.get('id'): row for row in rows}
+        with self._lock:
+            self._rows = new_rows
+            self._changed()
+            self.loaded_at = time.monotonic()
+        return len(new_rows)
+
+    def upsert(self, rows: Iterable[dict]) -> int:
+        """Добавляет новые и заменяет измененные строки (позиция существующих сохраняется)"""
+        count = 0
+        with self._lock:
+            for row in rows:
+                self._rows[row.get('id')] = row
+                count += 1
+            if count:
+                self._changed()
+        return count
+
+    def remove(self, ids: Iterable[str]) -> int:
+        count = 0
+        with self._lock:
+            for item_id in ids:
+                if self._rows.pop(item_id, None) is not None:
+                    count += 1
+            if count:
+                self._changed()
+        return count
+
+    def invalidate(self) -> None:
+        """Следующее чтение загрузит ассортимент заново"""
+        with self._lock:
+            self._rows = {}
+            self.loaded_at = None
+            self._changed()
+
+
+assortment_mirror = AssortmentMirror()
@@ -0,0 +1,86 @@
+"""
+Реестр пользовательских атрибутов МойСклад
+
+Метаданные атрибутов загружаются один раз (и обновляются по METADATA_TTL)
+через MoySkladAPI.get_attribute_metadata. Реестр сопоставляет название
+атрибута с его id и типом и отдает значения пользовательских справочников,
+чтобы при обработке строк сравнивать атрибуты по id, а не по названию.
+"""
+from json_backend import response_json
+
+
+class AttributeRegistry:
+    def __init__(self, api, entity='product'):
+        self.api = api
+        self.entity = entity
+        self._source = None
+        self._by_name = {}
+
+    def _index(self):
+        """name → метаданные; пересобирается, когда API обновил кеш метаданных"""
+        metadata = self.api.get_attribute_metadata(self.entity)
+        if metadata is not self._source:
+            self._by_name = {attr.get('name'): attr for attr in metadata.values()}
+            self._source = metadata
+        return self._by_name
+
+    @property
+    def loaded(self):
+        """Метаданные получены (в том числе пустые — у аккаунта нет атрибутов)"""
+        self._index()
+        return self.api.metadata_loaded(('attributes', self.entity))
+
+    @property
+    def load_error(self):
+        """Ошибка последней загрузки метаданных (None — успешно)"""
+        return self.api._metadata_errors.get(('attributes', self.entity))
+
+    def names(self):
+        return list(self._index())
+
+    def get(self, name):
+        """Метаданные атрибута по названию (None, если атрибута нет)"""
+        return self._index().get(name)
+
+    def id_for(self, name):
+        attr = self.get(name)
+        return attr.get('id') if attr else None
+
+    def type_for(self, name):
+        attr = self.get(name)
+        return attr.get('type') if attr else None
+
+    def keys(self, names):
+        """
+        (by_id, {поле: ключ}) для словаря {поле: название атрибута}.
+        by_id=False — метаданные недоступны, ключами служат названия.
+        """
+        index = self._index()
+        if not index:
+            return False, dict(names)
+        return True, {field: index[name].get('id') if name in index else None
+                      for field, name in names.items()}
+
+    def customentity_values(self, name):
+        """Названия значений пользовательского справочника атрибута"""
+        attr = self.get(name)
+        if not attr or attr.get('type') != 'customentity':
+            return []
+        href = attr.get('customEntityMeta', {}).get('href', '')
+        entity_id = href.rstrip('/').split('/')[-1]
+        if not entity_id:
+            return []
+
+        def load():
+            url = f"{self.api.base_url}/entity/customentity/{entity_id}"
+            resp = self.api.scheduler.get('moysklad', url, headers=self.api.headers, timeout=self.api.timeout)
+            resp.raise_for_status()
+            return [row.get('name') for row in response_json(resp).get('rows', [])]
+
+        return self.api._cached_metadata(('customentity', entity_id), load) or []
+
+    def invalidate(self):
+        """Сбрасывает кеш метаданных (после создания новых атрибутов)"""
+        self.api._metadata_cache.pop(('attributes', self.entity), None)
+        self._source = None
+        self._by_name = {}
@@ -0,0 +1,320 @@
+"""
+Бенчмарки горячих путей с порогами регрессии
+
+    python -m bench.hot_paths run --sizes 1000,10000,100000
+    python -m bench.hot_paths run --save              # записать bench/baseline.json
+    python -m bench.hot_paths compare --threshold 0.25
+
+Каждый бенчмарк гоняется на синтетическом ассортименте (bench.synthetic)
+заданного размера --repeat раз (короткие — по нескольку прогонов в одном
+замере, как timeit); в зачет идет минимальное время. Входные
+данные для функций по одной строке берутся из отобранных товаров и
+вариантов этого ассортимента. Справочники НК и метаданные МойСклад
+отдаются локальными заглушками (bench.stubs) и кешируются на прогреве,
+так что измеряется только локальная работа.
+
+compare завершается с кодом 1, если какой-либо путь медленнее базовой
+линии больше чем на порог (и больше чем на --min-delta-ms), и печатает
+таблицу в Markdown для ревью.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import math
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+BASELINE_FILE = Path(__file__).with_name("baseline.json")
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Короткие бенчмарки повторяются в одном замере, пока он не займет столько секунд
+MIN_SAMPLE = 0.05
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _setup_environment():
+    """Заглушки API до импорта приложения (config читает адреса при импорте)"""
+    ms_port, nk_port = _free_port(), _free_port()
+    os.environ.update({
+        "MS_BASE_URL": f"http://127.0.0.1:{ms_port}/api/remap/1.2",
+        "NC_BASE_URL": f"http://127.0.0.1:{nk_port}",
+        "MS_TOKEN": os.environ.get("MS_TOKEN", "stub-token"),
+        "NC_API_KEY": os.environ.get("NC_API_KEY", "stub-key"),
+    })
+    from bench.stubs import StubSettings, start_stubs
+    return start_stubs(10, StubSettings(), StubSettings(), ms_port, nk_port)
+
+
+class Workload:
+    """Синтетический ассортимент одного размера и производные входные данные"""
+
+    def __init__(self, api, rows: int):
+        from bench.synthetic import make_catalogue
+
+        self.api = api
+        self.size = rows
+        self.catalogue = make_catalogue(rows)
+        self.items = api.process_products_and_variants(self.catalogue)
+        self.fields = [api._extract_item_fields(item) for item in self.items]
+        self.data = api.validate_items_data([dict(f) for f in self.fields])
+        self.reset()
+
+    def reset(self):
+        """Сбрасывает разобранные атрибуты, которые строки кешируют на себе"""
+        for row in self.catalogue:
+            row.pop("_attr_values", None)
+
+
+def _bench_process(w):
+    w.reset()
+    w.api.process_products_and_variants(w.catalogue)
+    return len(w.catalogue)
+
+
+def _bench_extract(w):
+    w.reset()
+    for item in w.items:
+        w.api.extract_item_data_with_inheritance(item)
+    return len(w.items)
+
+
+def _bench_extract_tnved(w):
+    for item in w.items:
+        parent = item.get("_parent_product", item)
+        w.api.extract_tnved(item, parent)
+    return len(w.items)
+
+
+def _bench_choose_category(w):
+    from category_mapper import choose_category
+    for row in w.fields:
+        choose_category(row["tnved"], row["product_type"])
+    return len(w.fields)
+
+
+def _bench_tokenize(w):
+    from category_mapper import tokenize
+    for row in w.fields:
+        tokenize(row["name"])
+    return len(w.fields)
+
+
+def _bench_create_card(w):
+    from nk_api import create_card_data
+    for row in w.data:
+        create_card_data(row)
+    return len(w.data)
+
+
+def _bench_find_similar(w):
+    from nk_api import find_similar_values, get_color_preset
+    preset = get_color_preset()
+    # Опечатки: без последней буквы, чтобы подсказки действительно искались
+    for row in w.fields:
+        find_similar_values(row["color"][:-1], preset)
+    return len(w.fields)
+
+
+def _bench_format_status(w):
+    from nk_api import format_status_response
+    for index in range(len(w.items)):
+        format_status_response({
+            "success": True, "feed_id": index, "status": "Moderated",
+            "items_count": 1, "items_processed": 1, "items_accepted": 1,
+            "raw_data": {"status": "Moderated", "item": [{"gtin": f"029{index:010d}"}]},
+            "errors": [{"attr_id": 36, "message": "bad color"}] if index % 10 == 0 else [],
+        })
+    return len(w.items)
+
+
+BENCHMARKS = {
+    "process_products_and_variants": _bench_process,
+    "extract_item_data_with_inheritance": _bench_extract,
+    "extract_tnved": _bench_extract_tnved,
+    "choose_category": _bench_choose_category,
+    "tokenize": _bench_tokenize,
+    "create_card_data": _bench_create_card,
+    "find_similar_values": _bench_find_similar,
+    "format_status_response": _bench_format_status,
+}
+
+
+def _calibrate(bench, workload):
+    """Число повторов в одном замере, чтобы замер длился не меньше MIN_SAMPLE"""
+    started = time.perf_counter()
+    items = bench(workload)
+    elapsed = time.perf_counter() - started
+    return max(1, math.ceil(MIN_SAMPLE / elapsed) if elapsed else 1000), items
+
+
+def run(sizes, names, repeat: int) -> dict:
+    stubs = _setup_environment()
+    quiet = io.StringIO()
+    results = {}
+    try:
+        # Приложение и nk_api печатают по строке на товар — в зачет не идет
+        with contextlib.redirect_stdout(quiet):
+            from app import MoySkladAPI
+            api = MoySkladAPI()
+        for size in sizes:
+            with contextlib.redirect_stdout(quiet):
+                workload = Workload(api, size)
+            for name in names:
+                timings = []
+                items = 0
+                loops = 0
+                for _ in range(repeat):
+                    quiet.seek(0)
+                    quiet.truncate()
+                    # Как в timeit: сборщик мусора не вмешивается в замер
+                    gc.collect()
+                    gc.disable()
+                    try:
+                        with contextlib.redirect_stdout(quiet):
+                            if not loops:
+                                loops, items = _calibrate(BENCHMARKS[name], workload)
+                            started = time.perf_counter()
+                            for _ in range(loops):
+                                items = BENCHMARKS[name](workload)
+                            timings.append((time.perf_counter() - started) / loops)
+                    finally:
+                        gc.enable()
+                key = f"{name}@{size}"
+                results[key] = {
+                    "name": name,
+                    "rows": size,
+                    "items": items,
+                    "min": round(min(timings), 6),
+                    "median": round(statistics.median(timings), 6),
+                }
+                print(f"  {key:<48} {min(timings) * 1000:>10.2f} мс", file=sys.stderr)
+            del workload
+    finally:
+        for server in stubs[:2]:
+            server.stop()
+    return results
+
+
+def _meta(repeat: int) -> dict:
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+    }
+
+
+def _parse_thresholds(values, default: float) -> dict:
+    thresholds = {"*": default}
+    for value in values or []:
+        name, _, limit = value.partition("=")
+        thresholds[name] = float(limit)
+    return thresholds
+
+
+def compare(current: dict, baseline: dict, thresholds: dict, min_delta: float):
+    """Строки сравнения и признак регрессии"""
+    rows = []
+    regressed = False
+    for key, result in current.items():
+        base = baseline.get(key)
+        limit = thresholds.get(result["name"], thresholds["*"])
+        if not base:
+            rows.append((result, None, None, "новый"))
+            continue
+        change = result["min"] / base["min"] - 1 if base["min"] else 0.0
+        if change > limit and result["min"] - base["min"] > min_delta:
+            status = f"❌ регрессия (> {limit:.0%})"
+            regressed = True
+        elif change < -limit:
+            status = "🚀 быстрее"
+        else:
+            status = "✅"
+        rows.append((result, base, change, status))
+    return rows, regressed
+
+
+def markdown_table(rows) -> str:
+    lines = [
+        "| бенчмарк | строк | элементов | база, мс | сейчас, мс | мкс/элемент | изменение | статус |",
+        "|---|---:|---:|---:|---:|---:|---:|---|",
+    ]
+    for result, base, change, status in rows:
+        per_item = result["min"] / result["items"] * 1e6 if result["items"] else 0.0
+        base_ms = f"{base['min'] * 1000:.2f}" if base else "—"
+        change_text = f"{change:+.1%}" if change is not None else "—"
+        lines.append(
+            f"| {result['name']} | {result['rows']} | {result['items']} | {base_ms} "
+            f"| {result['min'] * 1000:.2f} | {per_item:.1f} | {change_text} | {status} |"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["run", "compare"])
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="размеры ассортимента через запятую (1000 … 200000)")
+    parser.add_argument("--only", help="бенчмарки через запятую: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="записать результаты как базовую линию")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление (0.25 = 25%%)")
+    parser.add_argument("--limit", action="append", metavar="NAME=THRESHOLD",
+                        help="порог для отдельного бенчмарка, например find_similar_values=0.5")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="замедление меньше этого не считается регрессией (шум)")
+    parser.add_argument("--output", type=Path, help="сохранить результаты прогона в JSON")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+
+    results = run(sizes, names, args.repeat)
+    document = {"meta": _meta(args.repeat), "results": results}
+    if args.output:
+        args.output.write_text(json.dumps(document, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8")).get("results", {})
+
+    rows, regressed = compare(results, baseline,
+                              _parse_thresholds(args.limit, args.threshold), args.min_delta_ms / 1000)
+    print(markdown_table(rows))
+
+    if args.save:
+        merged = dict(baseline, **results)
+        args.baseline.write_text(
+            json.dumps({"meta": _meta(args.repeat), "results": merged}, ensure_ascii=False, indent=2) + "\n",
+            encoding="utf-8",
+        )
+        print(f"\nБазовая линия сохранена: {args.baseline}")
+
+    if args.command == "compare":
+        if not baseline:
+            print(f"\nНет базовой линии {args.baseline}: запустите run --save")
+            sys.exit(2)
+        if regressed:
+            print("\nЕсть регрессии горячих путей")
+            sys.exit(1)
+        print("\nРегрессий нет")
+
+
+if __name__ == "__main__":
+    main()
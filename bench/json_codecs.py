@@ -0,0 +1,130 @@
+"""
+Бенчмарк JSON: разбор страниц МойСклад и сериализация /api/products
+
+    python -m bench.json_codecs --sizes 1000,10000,100000
+
+Разбор — одна страница /entity/assortment (--page-size строк, как отдает
+МойСклад): потоковый разбор json_stream (прежний путь), json.loads и
+orjson.loads. Сериализация — тело /api/products для синтетического
+ассортимента заданного размера: прежний jsonify (sort_keys, ensure_ascii),
+компактный stdlib и orjson. orjson замеряется, если установлен.
+
+В зачет идет минимальное время из --repeat прогонов; таблица в Markdown
+показывает время на страницу / выгрузку и экономию относительно прежнего
+пути.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import sys
+import time
+
+from bench.hot_paths import Workload, _setup_environment
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _chunks(body: bytes, size: int = 65536):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def parse_codecs():
+    from json_stream import iter_json_rows
+    codecs = {
+        "json_stream (прежний)": lambda body: list(iter_json_rows(_chunks(body))),
+        "json.loads": lambda body: json.loads(body)["rows"],
+    }
+    if orjson is not None:
+        codecs["orjson.loads"] = lambda body: orjson.loads(body)["rows"]
+    return codecs
+
+
+def serialize_codecs():
+    codecs = {
+        "jsonify (прежний)": lambda data: json.dumps(data, ensure_ascii=True, sort_keys=True,
+                                                     separators=(",", ":")).encode("utf-8"),
+        "json.dumps компактный": lambda data: json.dumps(data, ensure_ascii=False,
+                                                         separators=(",", ":")).encode("utf-8"),
+    }
+    if orjson is not None:
+        codecs["orjson.dumps"] = lambda data: orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return codecs
+
+
+def _measure(func, arg, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            func(arg)
+            timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return min(timings)
+
+
+def _rows(path: str, subject: str, size_bytes: int, timings: dict):
+    baseline = next(iter(timings.values()))
+    for name, seconds in timings.items():
+        saved = baseline - seconds
+        yield (f"| {path} | {subject} | {size_bytes / 1024:.0f} | {name} | {seconds * 1000:.2f} "
+               f"| {saved * 1000:+.2f} | {baseline / seconds:.1f}× |")
+
+
+def run(sizes, page_size: int, repeat: int) -> str:
+    from bench.synthetic import iter_page_bodies
+
+    lines = [
+        "| путь | объем | КБ | backend | мс | экономия, мс | ускорение |",
+        "|---|---|---:|---|---:|---:|---:|",
+    ]
+    body = next(iter_page_bodies(page_size, page_size=page_size))
+    timings = {name: _measure(codec, body, repeat) for name, codec in parse_codecs().items()}
+    lines.extend(_rows("разбор страницы МойСклад", f"{page_size} строк", len(body), timings))
+
+    stubs = _setup_environment()
+    quiet = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(quiet):
+            from app import MoySkladAPI
+            api = MoySkladAPI()
+        for size in sizes:
+            with contextlib.redirect_stdout(quiet):
+                workload = Workload(api, size)
+            data = {"products": workload.data, "total_filtered": len(workload.data), "total_items": size}
+            encoded = serialize_codecs()["json.dumps компактный"](data)
+            timings = {name: _measure(codec, data, repeat) for name, codec in serialize_codecs().items()}
+            lines.extend(_rows("выгрузка /api/products", f"{size} строк ({len(workload.data)} товаров)",
+                               len(encoded), timings))
+            print(f"  {size}: готово", file=sys.stderr)
+            del workload
+    finally:
+        for server in stubs[:2]:
+            server.stop()
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="размеры ассортимента для выгрузки через запятую")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("⚠️  orjson не установлен — сравниваются только варианты stdlib", file=sys.stderr)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    print(run(sizes, args.page_size, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Нагрузочный тест приложения на локальных заглушках МойСклад и НК
+
+    python -m bench.load_test --rows 20000 --concurrency 8 --duration 30
+
+Поднимает заглушки (bench.stubs) и приложение в одном процессе, затем
+параллельно гоняет смесь запросов /, /api/products, /nk_preview/<i> и
+/send_to_nk/<i> и печатает p50/p95/p99 и пропускную способность по каждому
+маршруту. Вывод самого приложения, включая его фоновые потоки (опрос фидов,
+очередь задач), отправляется в stderr (--verbose) или отбрасывается; перед
+остановкой заглушек эти потоки останавливаются.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Вес маршрута в смеси запросов
+DEFAULT_MIX = {"index": 1, "api_products": 2, "nk_preview": 6, "send_to_nk": 3}
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"неизвестный маршрут: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class LoadRunner:
+    def __init__(self, app_url: str, items: int, mix: dict, seed: int = 7):
+        self.app_url = app_url
+        self.items = items
+        self.routes = list(mix)
+        self.weights = [mix[name] for name in self.routes]
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name in self.routes}
+        self.failures = {name: 0 for name in self.routes}
+
+    def _call(self, session: requests.Session, route: str, index: int):
+        if route == "index":
+            return session.get(f"{self.app_url}/", timeout=300)
+        if route == "api_products":
+            return session.get(f"{self.app_url}/api/products", timeout=300)
+        if route == "nk_preview":
+            return session.get(f"{self.app_url}/nk_preview/{index}", timeout=300)
+        return session.post(f"{self.app_url}/send_to_nk/{index}", json={"user_changes": {}}, timeout=300)
+
+    def _failed(self, route: str, response: requests.Response) -> bool:
+        if response.status_code >= 400:
+            return True
+        if route == "index":
+            return "Ошибка" in response.text[:2000] and "<table" not in response.text
+        data = response.json()
+        return bool(data.get("error")) or data.get("success") is False
+
+    def worker(self, deadline: float, max_requests: int, counter: list):
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            with self._lock:
+                if max_requests and counter[0] >= max_requests:
+                    return
+                counter[0] += 1
+                route = self._rng.choices(self.routes, self.weights)[0]
+                index = self._rng.randrange(self.items) if self.items else 0
+            started = time.perf_counter()
+            try:
+                response = self._call(session, route, index)
+                failed = self._failed(route, response)
+            except (requests.exceptions.RequestException, ValueError):
+                failed = True
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.latencies[route].append(elapsed)
+                if failed:
+                    self.failures[route] += 1
+
+    def run(self, concurrency: int, duration: float, max_requests: int = 0) -> float:
+        counter = [0]
+        deadline = time.monotonic() + duration
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(self.worker, deadline, max_requests, counter)
+        return time.perf_counter() - started
+
+    def report(self, wall: float) -> str:
+        lines = [f"{'маршрут':<14}{'запросов':>9}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}"
+                 f"{'p99, мс':>10}{'rps':>8}"]
+        total = 0
+        for route in self.routes:
+            values = self.latencies[route]
+            total += len(values)
+            lines.append(
+                f"{route:<14}{len(values):>9}{self.failures[route]:>8}"
+                f"{percentile(values, 50) * 1000:>10.0f}{percentile(values, 95) * 1000:>10.0f}"
+                f"{percentile(values, 99) * 1000:>10.0f}{len(values) / wall:>8.2f}"
+            )
+        lines.append(f"Всего: {total} запросов за {wall:.1f} с, {total / wall:.2f} запросов/с")
+        return "\n".join(lines)
+
+
+def main():
+    # Заглушки импортируются после настройки окружения: bench.synthetic
+    # тянет config, а он читает MS_BASE_URL и SEND_LEDGER_FILE при импорте
+    ms_port, nk_port = _free_port(), _free_port()
+    ledger_dir = tempfile.mkdtemp(prefix="nk_load_")
+    os.environ.update({
+        "MS_BASE_URL": f"http://127.0.0.1:{ms_port}/api/remap/1.2",
+        "NC_BASE_URL": f"http://127.0.0.1:{nk_port}",
+        "MS_TOKEN": os.environ.get("MS_TOKEN", "stub-token"),
+        "NC_API_KEY": os.environ.get("NC_API_KEY", "stub-key"),
+        "SEND_LEDGER_FILE": os.path.join(ledger_dir, "send_ledger.sqlite3"),
+        "JOB_QUEUE_FILE": os.path.join(ledger_dir, "jobs.sqlite3"),
+    })
+
+    from bench.stubs import StubServer, add_stub_arguments, settings_from_args, start_stubs
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_stub_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="секунд нагрузки")
+    parser.add_argument("--requests", type=int, default=0, help="остановиться после N запросов")
+    parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX,
+                        help="веса маршрутов, например index=1,api_products=2,nk_preview=6,send_to_nk=3")
+    parser.add_argument("--verbose", action="store_true", help="вывод приложения в stderr")
+    args = parser.parse_args()
+
+    ms_settings, nk_settings = settings_from_args(args)
+    ms, nk, _, _ = start_stubs(args.rows, ms_settings, nk_settings, ms_port, nk_port,
+                               args.flagged_share, args.feed_delay)
+
+    real_stdout = sys.stdout
+    sys.stdout = sys.stderr if args.verbose else open(os.devnull, "w")
+
+    from app import app as flask_app, job_queue, tenants
+    server = StubServer(flask_app).start()
+
+    # Прогрев: метаданные, справочники НК и число строк в таблице
+    items = len(requests.get(f"{server.url}/api/products", timeout=300).json().get("products", []))
+
+    runner = LoadRunner(server.url, items, args.mix)
+    wall = runner.run(args.concurrency, args.duration, args.requests)
+
+    # Фоновые потоки приложения останавливаются, пока заглушки еще отвечают
+    server.stop()
+    for tenant in tenants:
+        tenant.progress_poller.stop()
+    job_queue.stop()
+    ms.stop()
+    nk.stop()
+
+    sys.stdout = real_stdout
+    print(f"Ассортимент: {args.rows} строк, в таблице {items}; параллельно {args.concurrency}")
+    print(runner.report(wall))
+    print(f"Заглушка МойСклад: {ms_settings.counters}")
+    print(f"Заглушка НК:       {nk_settings.counters}")
+
+
+if __name__ == "__main__":
+    main()
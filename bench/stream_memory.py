@@ -0,0 +1,109 @@
+"""
+Пиковая память конвейера загрузки ассортимента: списки против потока
+
+    python -m bench.stream_memory --rows 100000
+
+Каждый режим запускается в отдельном процессе; страницы синтетического
+ассортимента (bench.synthetic) отдаются кусками по 64 КБ, как тело
+HTTP-ответа. Сравниваются:
+  list   — прежняя схема: json.loads каждой страницы, все строки в одном
+           списке, затем process_products_and_variants и список данных;
+  stream — iter_json_rows → iter_products_and_variants → извлечение по одной строке.
+Извлекаются только поля (без валидации в НК, чтобы не ходить в сеть).
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+CHUNK = 65536
+
+
+def _chunks(body: bytes):
+    for start in range(0, len(body), CHUNK):
+        yield body[start:start + CHUNK]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode: str, rows: int, flagged_share: float) -> dict:
+    from app import MoySkladAPI
+    from bench.synthetic import iter_page_bodies
+    from json_stream import iter_json_rows
+
+    api = MoySkladAPI()
+    pages = iter_page_bodies(rows, flagged_share=flagged_share)
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+
+    if mode == "list":
+        all_items = []
+        for body in pages:
+            all_items.extend(json.loads(b"".join(_chunks(body)))["rows"])
+        filtered = api.process_products_and_variants(all_items)
+        extracted = [api._extract_item_fields(item) for item in filtered]
+        total = len(all_items)
+    else:
+        def rows_iter():
+            for body in pages:
+                yield from iter_json_rows(_chunks(body))
+
+        stats = {"total_items": 0}
+
+        def counted():
+            for row in rows_iter():
+                stats["total_items"] += 1
+                yield row
+
+        extracted = [api._extract_item_fields(item) for item in api.iter_products_and_variants(counted())]
+        total = stats["total_items"]
+
+    return {
+        "mode": mode,
+        "rows": total,
+        "extracted": len(extracted),
+        "seconds": round(time.perf_counter() - started, 2),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "peak_rss_delta_mb": round(_peak_rss_mb() - baseline, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--flagged-share", type=float, default=0.05)
+    parser.add_argument("--mode", choices=["list", "stream"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        # Дочерний процесс: вывод конвейера — в stderr, результат — последней строкой stdout
+        sys.stdout, real_stdout = sys.stderr, sys.stdout
+        result = run_mode(args.mode, args.rows, args.flagged_share)
+        print(json.dumps(result), file=real_stdout)
+        return
+
+    results = []
+    for mode in ("list", "stream"):
+        out = subprocess.run(
+            [sys.executable, "-m", "bench.stream_memory", "--mode", mode,
+             "--rows", str(args.rows), "--flagged-share", str(args.flagged_share)],
+            check=True, capture_output=True, text=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'режим':<8}{'строк':>10}{'отобрано':>10}{'сек':>8}{'пик RSS, МБ':>14}{'прирост, МБ':>14}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['rows']:>10}{r['extracted']:>10}{r['seconds']:>8}"
+              f"{r['peak_rss_mb']:>14}{r['peak_rss_delta_mb']:>14}")
+    list_delta, stream_delta = results[0]["peak_rss_delta_mb"], results[1]["peak_rss_delta_mb"]
+    if list_delta > 0:
+        print(f"Снижение прироста пиковой памяти: {100 * (1 - stream_delta / list_delta):.0f}%")
+
+
+if __name__ == "__main__":
+    main()
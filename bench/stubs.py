@@ -0,0 +1,348 @@
+"""
+Локальные заглушки API МойСклад и Национального каталога
+
+    python -m bench.stubs --rows 50000 --latency 0.05 --error-rate 0.01 --rate-limit 15
+
+МойСклад (http://127.0.0.1:8081/api/remap/1.2):
+  /context/employee, /entity/assortment (limit/offset, expand — до 100 строк),
+  /entity/product|variant (filter=id=...;id=..., POST — массовое обновление),
+  /entity/product|variant/{id} GET/PUT,
+  /entity/product/metadata/attributes, /entity/variant/metadata.
+НК (http://127.0.0.1:8082):
+  /v3/categories, /v3/attributes, POST /v3/feed, /v3/feed-status, /v3/feeds,
+  /v4/product-list (limit/offset), /v3/product (gtins=...): заранее заведенные
+  карточки (--carded-share) и карточки принятых фидов.
+
+Приложение переключается на заглушки переменными окружения
+MS_BASE_URL и NC_BASE_URL (см. config.py). Ассортимент — bench.synthetic.
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from bench.synthetic import (
+    CHARACTERISTIC_METADATA, COLORS, KINDS, TNVED, attribute_metadata, carded_goods, iter_catalogue,
+)
+
+MS_PREFIX = "/api/remap/1.2"
+CLOTHES_CATEGORY = 30933
+
+
+# Схема атрибутов категории в формате /v3/attributes (attr_type "m" — обязательный)
+NK_ATTRIBUTES = [
+    {"attr_id": 36, "attr_name": "Цвет", "attr_type": "m", "attr_preset": [c.upper() for c in COLORS]},
+    {"attr_id": 12, "attr_name": "Вид товара", "attr_type": "m", "attr_preset": [k.upper() for k in KINDS]},
+    {"attr_id": 2630, "attr_name": "Страна производства", "attr_type": "m", "attr_preset": ["RU", "CN", "TR", "BY"]},
+    {"attr_id": 2478, "attr_name": "Полное наименование", "attr_type": "m", "attr_field_length": 1000},
+    {"attr_id": 2504, "attr_name": "Товарный знак", "attr_type": "m"},
+    {"attr_id": 35, "attr_name": "Размер", "attr_type": "o",
+     "attr_value_type": ["РОССИЯ", "МЕЖДУНАРОДНЫЙ", "ЕВРОПА", "США", "КИТАЙ"]},
+    {"attr_id": 14013, "attr_name": "Пол", "attr_type": "m",
+     "attr_preset": ["ЖЕНСКИЙ", "МУЖСКОЙ", "БЕЗ УКАЗАНИЯ ПОЛА", "УНИВЕРСАЛЬНЫЙ (УНИСЕКС)"]},
+    {"attr_id": 2483, "attr_name": "Состав", "attr_type": "o"},
+    {"attr_id": 13836, "attr_name": "Регламент", "attr_type": "o"},
+    {"attr_id": 13914, "attr_name": "Артикул", "attr_type": "o", "attr_value_type": ["Артикул", "Модель"]},
+    {"attr_id": 13933, "attr_name": "Детальный ТН ВЭД", "attr_type": "o", "attr_field_type": "Число"},
+    {"attr_id": 23557, "attr_name": "Разрешительные документы", "attr_type": "o"},
+]
+
+
+class StubSettings:
+    """Поведение заглушки: задержка, доля ошибок, лимит запросов в секунду"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._updated = time.monotonic()
+        self.counters = {"requests": 0, "errors": 0, "throttled": 0}
+
+    def _take_token(self) -> bool:
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._updated) * self.rate_limit)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def before_request(self):
+        """Задержка, 429 и случайные 5xx; None — обрабатывать запрос"""
+        with self._lock:
+            self.counters["requests"] += 1
+            allowed = self._take_token()
+            fail = self._rng.random() < self.error_rate
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        if delay:
+            time.sleep(delay)
+        if not allowed:
+            with self._lock:
+                self.counters["throttled"] += 1
+            response = jsonify({"errors": [{"error": "Превышено ограничение на количество запросов"}]})
+            response.status_code = 429
+            response.headers["X-Lognex-Retry-After"] = str(int(1000 / self.rate_limit) + 1)
+            response.headers["Retry-After"] = "1"
+            return response
+        if fail:
+            with self._lock:
+                self.counters["errors"] += 1
+            response = jsonify({"errors": [{"error": "Внутренняя ошибка заглушки"}]})
+            response.status_code = 503
+            return response
+        return None
+
+
+def _lean_row(row: dict) -> dict:
+    """Строка без expand: у атрибутов только ссылка, id и значение"""
+    if "attributes" not in row:
+        return row
+    return dict(row, attributes=[
+        {"meta": attr["meta"], "id": attr["id"], "value": attr["value"]} for attr in row["attributes"]
+    ])
+
+
+def create_moysklad_app(rows: int, settings: StubSettings, flagged_share: float = 0.05) -> Flask:
+    catalogue = list(iter_catalogue(rows, flagged_share=flagged_share))
+    by_id = {row["id"]: row for row in catalogue}
+    attributes = attribute_metadata()
+    lock = threading.Lock()
+
+    app = Flask("moysklad_stub")
+    app.before_request(settings.before_request)
+
+    @app.route(f"{MS_PREFIX}/context/employee")
+    def employee():
+        return jsonify({"id": "stub-employee", "name": "Заглушка"})
+
+    @app.route(f"{MS_PREFIX}/entity/assortment")
+    def assortment():
+        expand = request.args.get("expand", "")
+        limit = min(int(request.args.get("limit", 1000)), 100 if expand else 1000)
+        offset = int(request.args.get("offset", 0))
+        page = catalogue[offset:offset + limit]
+        if not expand:
+            page = [_lean_row(row) for row in page]
+        return jsonify({
+            "meta": {"size": len(catalogue), "limit": limit, "offset": offset},
+            "rows": page,
+        })
+
+    @app.route(f"{MS_PREFIX}/entity/<entity_type>/metadata/attributes")
+    def attribute_metadata_route(entity_type):
+        return jsonify({"rows": attributes if entity_type == "product" else []})
+
+    @app.route(f"{MS_PREFIX}/entity/variant/metadata")
+    def variant_metadata():
+        return jsonify({"characteristics": CHARACTERISTIC_METADATA})
+
+    def _merge(row: dict, changes: dict) -> None:
+        """Атрибуты и характеристики обновляются по id, как в МойСклад"""
+        for key in ("attributes", "characteristics"):
+            if key not in changes:
+                continue
+            current = {entry.get("id"): entry for entry in row.setdefault(key, [])}
+            for entry in changes[key]:
+                entry_id = entry.get("id") or entry.get("meta", {}).get("href", "").rstrip("/").split("/")[-1]
+                if entry_id in current:
+                    current[entry_id]["value"] = entry.get("value")
+                elif key == "attributes":
+                    row[key].append(dict(entry, id=entry_id))
+        row.update({key: value for key, value in changes.items() if key in ("barcodes", "name")})
+
+    @app.route(f"{MS_PREFIX}/entity/<entity_type>", methods=["GET", "POST"])
+    def entity_list(entity_type):
+        if request.method == "POST":
+            # Массовое обновление: массив {meta, ...}; ошибка элемента — {"errors": [...]} на его месте
+            result = []
+            with lock:
+                for changes in request.get_json(silent=True) or []:
+                    entity_id = changes.get("meta", {}).get("href", "").rstrip("/").split("/")[-1]
+                    row = by_id.get(entity_id)
+                    if row is None or row["meta"]["type"] != entity_type:
+                        result.append({"errors": [{"error": f"Объект {entity_id} не найден"}]})
+                        continue
+                    _merge(row, changes)
+                    result.append(row)
+            return jsonify(result)
+        ids = [part[3:] for part in request.args.get("filter", "").split(";") if part.startswith("id=")]
+        found = [by_id[i] for i in ids if i in by_id and by_id[i]["meta"]["type"] == entity_type]
+        return jsonify({"rows": found})
+
+    @app.route(f"{MS_PREFIX}/entity/<entity_type>/<entity_id>", methods=["GET", "PUT"])
+    def entity(entity_type, entity_id):
+        row = by_id.get(entity_id)
+        if row is None or row["meta"]["type"] != entity_type:
+            response = jsonify({"errors": [{"error": "Объект не найден"}]})
+            response.status_code = 404
+            return response
+        if request.method == "PUT":
+            changes = request.get_json(silent=True) or {}
+            with lock:
+                row.update({key: value for key, value in changes.items() if key in ("barcodes", "attributes", "name")})
+        return jsonify(row)
+
+    return app
+
+
+def create_nk_app(settings: StubSettings, feed_delay: float = 2.0, goods=None) -> Flask:
+    feeds = {}
+    goods = list(goods or [])
+    feed_ids = itertools.count(100000)
+    gtins = itertools.count(2900000000000)
+    lock = threading.Lock()
+
+    app = Flask("nk_stub")
+    app.before_request(settings.before_request)
+
+    @app.route("/v3/categories")
+    def categories():
+        cat_id = request.args.get("cat_id")
+        if cat_id:
+            return jsonify({"result": [{"cat_id": int(cat_id), "category_name": "Одежда (заглушка)"}]})
+        tnved = request.args.get("tnved", "")
+        if any(code.startswith(tnved[:4]) for code in TNVED):
+            return jsonify({"result": [{"cat_id": CLOTHES_CATEGORY, "category_name": "Одежда (заглушка)"}]})
+        return jsonify({"result": []})
+
+    @app.route("/v3/attributes")
+    def attributes():
+        return jsonify({"result": NK_ATTRIBUTES})
+
+    @app.route("/v3/feed", methods=["POST"])
+    def create_feed():
+        cards = request.get_json(silent=True) or []
+        with lock:
+            feed_id = next(feed_ids)
+            card = (cards[0] if isinstance(cards, list) and cards else cards) or {}
+            feeds[feed_id] = {"created": time.monotonic(), "count": len(cards), "gtin": None, "card": card}
+        return jsonify({"result": {"feed_id": feed_id}})
+
+    @app.route("/v3/feeds")
+    def list_feeds():
+        return jsonify({"result": [
+            {"feed_id": feed_id, "status": "Moderated" if feed["gtin"] else "Processing", "items_count": feed["count"]}
+            for feed_id, feed in feeds.items()
+        ]})
+
+    @app.route("/v3/feed-status")
+    def feed_status():
+        feed = feeds.get(int(request.args.get("feed_id", 0)))
+        if feed is None:
+            response = jsonify({"error": {"code": 404, "message": "feed not found"}})
+            response.status_code = 404
+            return response
+        age = time.monotonic() - feed["created"]
+        result = {"status": "Received", "items_count": feed["count"]}
+        if age >= feed_delay:
+            with lock:
+                if feed["gtin"] is None:
+                    feed["gtin"] = str(next(gtins))
+                    goods.append({"good_id": 900000 + len(goods), "gtin": feed["gtin"],
+                                  "good_name": feed["card"].get("good_name", ""), "good_status": "draft",
+                                  "good_attrs": feed["card"].get("good_attrs", [])})
+            result.update(status="Moderated", items_processed=feed["count"], items_accepted=feed["count"],
+                          item=[{"gtin": feed["gtin"], "status": "accepted"}])
+        elif age >= feed_delay / 2:
+            result["status"] = "Processing"
+        return jsonify({"result": result})
+
+    @app.route("/v4/product-list")
+    def product_list():
+        limit = min(int(request.args.get("limit", 1000)), 1000)
+        offset = int(request.args.get("offset", 0))
+        page = goods[offset:offset + limit]
+        return jsonify({"apiversion": 4, "result": {"goods": [
+            {key: good[key] for key in ("good_id", "gtin", "good_name", "good_status")} for good in page
+        ]}})
+
+    @app.route("/v3/product")
+    def products():
+        wanted = {gtin.strip().lstrip("0") for gtin in request.args.get("gtins", "").split(",") if gtin.strip()}
+        return jsonify({"result": [good for good in goods if good["gtin"].lstrip("0") in wanted]})
+
+    return app
+
+
+class StubServer:
+    """Flask-приложение в фоновом потоке (многопоточный werkzeug)"""
+
+    def __init__(self, app: Flask, host: str = "127.0.0.1", port: int = 0):
+        self._server = make_server(host, port, app, threaded=True)
+        self.host = host
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "StubServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+
+def start_stubs(rows: int, ms_settings: StubSettings, nk_settings: StubSettings,
+                ms_port: int = 0, nk_port: int = 0, flagged_share: float = 0.05,
+                feed_delay: float = 2.0, carded_share: float = 0.0):
+    """Запускает обе заглушки; возвращает (ms_server, nk_server, MS_BASE_URL, NC_BASE_URL)"""
+    ms = StubServer(create_moysklad_app(rows, ms_settings, flagged_share), port=ms_port).start()
+    goods = carded_goods(rows, carded_share, flagged_share) if carded_share else []
+    nk = StubServer(create_nk_app(nk_settings, feed_delay, goods), port=nk_port).start()
+    return ms, nk, f"{ms.url}{MS_PREFIX}", nk.url
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--rows", type=int, default=20_000, help="строк синтетического ассортимента")
+    parser.add_argument("--flagged-share", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа, секунд")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="запросов в секунду (0 — без лимита)")
+    parser.add_argument("--feed-delay", type=float, default=2.0, help="через сколько секунд фид принят")
+    parser.add_argument("--carded-share", type=float, default=0.0,
+                        help="доля вариантов, у которых уже есть карточка в НК")
+
+
+def settings_from_args(args):
+    ms = StubSettings(args.latency, args.jitter, args.error_rate, args.rate_limit, seed=1)
+    nk = StubSettings(args.latency, args.jitter, args.error_rate, args.rate_limit, seed=2)
+    return ms, nk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_stub_arguments(parser)
+    parser.add_argument("--ms-port", type=int, default=8081)
+    parser.add_argument("--nk-port", type=int, default=8082)
+    args = parser.parse_args()
+
+    ms_settings, nk_settings = settings_from_args(args)
+    ms, nk, ms_url, nk_url = start_stubs(args.rows, ms_settings, nk_settings, args.ms_port, args.nk_port,
+                                         args.flagged_share, args.feed_delay, args.carded_share)
+    print(f"МойСклад: MS_BASE_URL={ms_url}")
+    print(f"НК:       NC_BASE_URL={nk_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        ms.stop()
+        nk.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Синтетический ассортимент в формате МойСклад для бенчмарков и заглушек
+"""
+import json
+import random
+from typing import Iterator, List
+
+from config import CUSTOM_ATTRIBUTES
+
+COLORS = ["Красный", "Черный", "Белый", "Голубой", "Темно-синий", "Бежевый", "Серый", "Зеленый"]
+KINDS = ["Брюки", "Платье", "Блузка", "Юбка", "Куртка", "Джемпер"]
+TNVED = ["6204631800", "6204430000", "6206400000", "6204530000", "6202930000", "6110309900"]
+SIZES = ["40", "42", "44", "46", "48", "50", "52"]
+
+BASE_URL = "https://api.moysklad.ru/api/remap/1.2"
+
+
+def _attr(attr_id: str, name: str, value, attr_type: str = "string") -> dict:
+    return {
+        "meta": {
+            "href": f"{BASE_URL}/entity/product/metadata/attributes/{attr_id}",
+            "type": "attributemetadata",
+            "mediaType": "application/json",
+        },
+        "id": attr_id,
+        "name": name,
+        "type": attr_type,
+        "value": value,
+    }
+
+
+def make_product(index: int, rng: random.Random, flagged: bool) -> dict:
+    product_id = f"00000000-0000-0000-0000-{index:012d}"
+    kind = rng.choice(KINDS)
+    return {
+        "meta": {
+            "href": f"{BASE_URL}/entity/product/{product_id}",
+            "type": "product",
+            "mediaType": "application/json",
+        },
+        "id": product_id,
+        "name": f"{kind} женские арт. {index}",
+        "article": f"ART-{index}",
+        "tnved": rng.choice(TNVED)[:4],
+        "barcodes": [],
+        "attributes": [
+            _attr("attr-national-catalog", CUSTOM_ATTRIBUTES["national_catalog"], flagged, "boolean"),
+            _attr("attr-composition", CUSTOM_ATTRIBUTES["composition"], "Хлопок 95%, эластан 5%"),
+            _attr("attr-permit-docs", CUSTOM_ATTRIBUTES["permit_docs"], f"ЕАЭС N RU Д-RU.РА01.В.{index:05d}/24"),
+            _attr("attr-product-type", CUSTOM_ATTRIBUTES["product_type"], kind),
+            _attr("attr-color", CUSTOM_ATTRIBUTES["color"], rng.choice(COLORS)),
+            _attr("attr-brand-nk", CUSTOM_ATTRIBUTES["brand_nk"], "БрендОдежды"),
+            _attr("attr-target-gender", CUSTOM_ATTRIBUTES["target_gender"], {"name": "ЖЕНСКИЙ"}, "customentity"),
+            _attr("attr-size-type", CUSTOM_ATTRIBUTES["size_type"], {"name": "РОССИЯ"}, "customentity"),
+        ],
+    }
+
+
+def make_variant(product: dict, index: int, size: str, rng: random.Random) -> dict:
+    variant_id = f"00000000-0000-0000-0001-{index:012d}"
+    return {
+        "meta": {
+            "href": f"{BASE_URL}/entity/variant/{variant_id}",
+            "type": "variant",
+            "mediaType": "application/json",
+        },
+        "id": variant_id,
+        "name": f"{product['name']} ({size})",
+        "barcodes": [],
+        "product": {"meta": {"href": product["meta"]["href"], "type": "product"}},
+        "characteristics": [
+            {"id": "char-size", "name": "Размер", "value": size},
+            {"id": "char-color", "name": "Цвет", "value": rng.choice(COLORS)},
+        ],
+    }
+
+
+def iter_catalogue(rows: int, flagged_share: float = 0.05, variants_per_product: int = 4,
+                   seed: int = 42) -> Iterator[dict]:
+    """
+    Отдает rows строк ассортимента: товары, за каждым — его варианты.
+    flagged_share — доля товаров с флажком «Для нац.каталога».
+    """
+    rng = random.Random(seed)
+    produced = 0
+    index = 0
+    while produced < rows:
+        product = make_product(index, rng, rng.random() < flagged_share)
+        index += 1
+        yield product
+        produced += 1
+        for size in SIZES[:variants_per_product]:
+            if produced >= rows:
+                return
+            yield make_variant(product, index, size, rng)
+            index += 1
+            produced += 1
+
+
+def attribute_metadata() -> List[dict]:
+    """Метаданные атрибутов товаров (как /entity/product/metadata/attributes)"""
+    sample = make_product(0, random.Random(0), True)
+    return [
+        {"meta": attr["meta"], "id": attr["id"], "name": attr["name"], "type": attr["type"], "required": False}
+        for attr in sample["attributes"]
+    ]
+
+
+CHARACTERISTIC_METADATA = [{"id": "char-size", "name": "Размер"}, {"id": "char-color", "name": "Цвет"}]
+
+
+def carded_goods(rows: int, share: float, flagged_share: float = 0.05, seed: int = 7) -> List[dict]:
+    """
+    Карточки НК (как /v3/product) для доли share вариантов отмеченных товаров —
+    «уже заведены поставщиком»: артикул товара, размер варианта, GTIN 046….
+    """
+    rng = random.Random(seed)
+    flag_name = CUSTOM_ATTRIBUTES["national_catalog"]
+    flagged = {}
+    goods = []
+    for row in iter_catalogue(rows, flagged_share=flagged_share):
+        if row["meta"]["type"] == "product":
+            if any(attr["name"] == flag_name and attr["value"] for attr in row["attributes"]):
+                flagged[row["meta"]["href"]] = row
+            continue
+        product = flagged.get(row["product"]["meta"]["href"])
+        if product is None or rng.random() >= share:
+            continue
+        size = next(char["value"] for char in row["characteristics"] if char["id"] == "char-size")
+        goods.append({
+            "good_id": 500000 + len(goods),
+            "gtin": f"046{len(goods):011d}",
+            "good_name": row["name"],
+            "good_status": "published",
+            "good_attrs": [
+                {"attr_id": 13914, "attr_name": "Артикул", "attr_value": product["article"],
+                 "attr_value_type": "Артикул"},
+                {"attr_id": 35, "attr_name": "Размер", "attr_value": size, "attr_value_type": "РОССИЯ"},
+            ],
+        })
+    return goods
+
+
+def make_catalogue(rows: int, **kwargs) -> List[dict]:
+    return list(iter_catalogue(rows, **kwargs))
+
+
+def iter_page_bodies(rows: int, page_size: int = 1000, **kwargs) -> Iterator[bytes]:
+    """Тела ответов /entity/assortment постранично (JSON, как отдает МойСклад)"""
+    page = []
+    offset = 0
+    for row in iter_catalogue(rows, **kwargs):
+        page.append(row)
+        if len(page) == page_size:
+            yield page_body(page, offset, rows)
+            offset += page_size
+            page = []
+    if page or offset == 0:
+        yield page_body(page, offset, rows)
+
+
+def page_body(page: List[dict], offset: int, total: int) -> bytes:
+    body = {
+        "context": {"employee": {"meta": {"href": f"{BASE_URL}/context/employee"}}},
+        "meta": {"href": f"{BASE_URL}/entity/assortment", "size": total, "limit": len(page), "offset": offset},
+        "rows": page,
+    }
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
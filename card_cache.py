@@ -0,0 +1,84 @@
+"""
+Кеш карточек НК по хешу содержимого
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from nk_api import create_card_data
+
+# Поля данных товара, от которых зависит содержимое карточки
+CARD_FIELDS = (
+    "name", "article", "tnved", "product_type", "color", "size", "size_type",
+    "composition", "permit_docs", "brand_nk", "target_gender",
+)
+
+# Поля, которые пользователь может поменять в превью
+USER_CHANGE_FIELDS = ("color", "product_type", "size")
+
+
+def _normalize(value) -> str:
+    return " ".join(str(value or "").split())
+
+
+def card_content_hash(product_data: dict, user_changes: Optional[dict] = None) -> str:
+    """Стабильный хеш нормализованных данных товара и пользовательских изменений"""
+    payload = {
+        "data": {field: _normalize(product_data.get(field)) for field in CARD_FIELDS},
+        "changes": {
+            field: _normalize(value)
+            for field, value in (user_changes or {}).items()
+            if field in USER_CHANGE_FIELDS and value
+        },
+    }
+    # Только stdlib json: хеш хранится в журнале отправок и не должен зависеть от json_backend
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CardCache:
+    """LRU-кеш готовых карточек: hash → card"""
+
+    def __init__(self, maxsize: int = 4096, builder: Callable[[dict], dict] = create_card_data):
+        self.maxsize = maxsize
+        self.builder = builder
+        self._cards: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, card_hash: str) -> Optional[dict]:
+        with self._lock:
+            card = self._cards.get(card_hash)
+            if card is not None:
+                self._cards.move_to_end(card_hash)
+            return card
+
+    def put(self, card_hash: str, card: dict) -> None:
+        with self._lock:
+            self._cards[card_hash] = card
+            self._cards.move_to_end(card_hash)
+            while len(self._cards) > self.maxsize:
+                self._cards.popitem(last=False)
+
+    def get_or_build(self, product_data: dict, modified_data: dict,
+                     user_changes: Optional[dict] = None) -> Tuple[str, dict]:
+        """
+        Возвращает (hash, card). Хеш считается по исходным данным и изменениям,
+        карточка строится из данных с уже примененными изменениями.
+        """
+        card_hash = card_content_hash(product_data, user_changes)
+        card = self.get(card_hash)
+        if card is None:
+            card = self.builder(modified_data)
+            self.put(card_hash, card)
+        else:
+            print(f"♻️  Карточка взята из кеша: {card_hash[:12]}")
+        return card_hash, card
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cards.clear()
+
+
+card_cache = CardCache()
@@ -0,0 +1,74 @@
+"""
+Отправка одной карточки в НК
+
+Проверка по схеме категории, сверка с карточками НК, резерв в журнале
+отправок и POST фида — для аккаунта tenant (tenants.py). Общая часть
+/send_to_nk, фоновой задачи send и pipeline.py.
+
+Импорт модуля ничего не запускает: опрос фидов после отправки включает
+вызывающий (веб-приложение — ProgressPoller, конвейер — свой этап poll).
+"""
+from card_cache import card_content_hash
+from card_validator import validate_card
+from config import PREFLIGHT_VALIDATION, RECONCILE
+from delta_sync import fingerprint, fingerprint_fields
+from progress_events import EVENT_SENT
+from send_ledger import STATUS_ACCEPTED, STATUS_SENDING
+
+
+def submit_card(tenant, item, product_data, card_hash, card_data, user_changes=None) -> dict:
+    """
+    product_data — данные товара без пользовательских изменений user_changes.
+    outcome: invalid, carded, in_progress, duplicate, resumed, sent или failed.
+    """
+    # Проверка по схеме категории: ошибки видны сразу, без фида и опроса статуса
+    if PREFLIGHT_VALIDATION:
+        preflight = validate_card(card_data)
+        if not preflight['valid']:
+            print(f"⛔ Карточка не прошла проверку: {len(preflight['errors'])} ошибок")
+            return {'outcome': 'invalid', 'errors': preflight['errors'], 'warnings': preflight['warnings']}
+
+    # Товар уже есть в НК (GTIN из МойСклад найден при сверке) — новый черновик не нужен
+    if RECONCILE['skip_carded']:
+        carded = tenant.nk_index.carded_gtin(item)
+        if carded:
+            print(f"⏭️  Карточка с GTIN {carded} уже есть в НК")
+            return {'outcome': 'carded', 'gtin': carded}
+
+    # Журнал отправок: повторные клики и ретраи не создают новых фидов
+    item_id = item.get('id')
+    item_type = item.get('meta', {}).get('type', 'unknown')
+    existing = tenant.ledger.reserve(
+        item_id, card_hash, item_type,
+        fingerprint=fingerprint(product_data), fields=fingerprint_fields(product_data),
+        base_hash=card_content_hash(product_data), user_changes=user_changes
+    )
+
+    if existing and existing['status'] == STATUS_SENDING:
+        print(f"⏳ Карточка уже отправляется параллельным запросом")
+        return {'outcome': 'in_progress'}
+
+    if existing:
+        feed_id = existing['feed_id']
+        if existing['status'] == STATUS_ACCEPTED:
+            print(f"⏭️  Карточка уже принята НК, feed_id: {feed_id}")
+            return {'outcome': 'duplicate', 'feed_id': feed_id, 'existing': existing}
+        print(f"🔁 Фид {feed_id} еще обрабатывается, продолжаем опрос статуса")
+        return {'outcome': 'resumed', 'feed_id': feed_id, 'existing': existing}
+
+    # Отправляем в НК
+    print(f"📤 Отправляем в национальный каталог...")
+    send_result = tenant.nk.send_card_to_nk(card_data)
+    feed_id = send_result.get("feed_id")
+
+    if not send_result.get("success") or not feed_id:
+        error_msg = send_result.get('error') or 'Не получен feed_id от национального каталога'
+        print(f"❌ Ошибка отправки: {error_msg}")
+        tenant.ledger.record_failed(item_id, card_hash, error_msg)
+        return {'outcome': 'failed', 'error': error_msg, 'status_code': send_result.get('status_code')}
+
+    status = send_result.get("status", "Processing")
+    tenant.ledger.record_sent(item_id, card_hash, feed_id, status)
+    print(f"✅ Карточка отправлена в НК, feed_id: {feed_id}")
+    tenant.hub.publish(EVENT_SENT, {'item_id': item_id, 'feed_id': str(feed_id), 'status': status})
+    return {'outcome': 'sent', 'feed_id': feed_id, 'status': status}
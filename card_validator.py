@@ -0,0 +1,191 @@
+"""
+Предварительная проверка карточек НК до отправки фида
+
+Схема категории строится один раз из /v3/attributes (nk_api.get_category_attributes)
+и держит по attr_id: обязательность, справочник значений, допустимые типы
+значения (вид размера, «Артикул»/«Модель»), числовой тип и длину. Проверка
+карточки — только словарные поиски, поэтому тысячи карточек проверяются за
+миллисекунды, а ошибки, которые НК вернул бы после POST /v3/feed и опроса
+статуса, видны сразу.
+
+Ошибки в том же виде, что nk_api.format_errors: field, message, code,
+value, attr_id, attr_name (+ suggestions для значений не из справочника).
+Если схема категории недоступна (НК не ответил), проверяются только поля
+самой карточки, а в warnings добавляется предупреждение.
+"""
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from config import REQUIRED_CUSTOM_FIELDS
+from nk_api import attribute_preset, cache_success, find_similar_values, get_attr_name, get_category_attributes
+
+# attr_type обязательного атрибута в ответе /v3/attributes
+REQUIRED_ATTR_TYPES = {"m"}
+
+# attr_field_type числовых атрибутов
+NUMERIC_FIELD_TYPES = {"число", "number", "integer", "float", "decimal"}
+
+# Типы значения, если схема их не перечисляет: вид размера (attr 35)
+DEFAULT_VALUE_TYPES = {
+    35: frozenset(REQUIRED_CUSTOM_FIELDS["Вид размера"]["values"]),
+}
+
+# Атрибуты, которые карточка передает своим полем, а не в good_attrs
+TNVED_GROUP_ATTR_ID = 3959
+TNVED_DETAILED_ATTR_ID = 13933
+
+
+def _upper_set(values) -> FrozenSet[str]:
+    if not isinstance(values, (list, tuple, set, frozenset)):
+        return frozenset()
+    return frozenset(str(v).upper() for v in values if v not in (None, ""))
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text.replace(",", "."))
+    except ValueError:
+        return False
+    return True
+
+
+class CategorySchema:
+    """Скомпилированная схема атрибутов одной категории НК"""
+
+    def __init__(self, cat_id: int, attributes: Iterable[Dict]):
+        self.cat_id = cat_id
+        self.attributes = {attr["attr_id"]: attr for attr in attributes if "attr_id" in attr}
+        self.loaded = bool(self.attributes)
+        self.required = frozenset(
+            attr_id for attr_id, attr in self.attributes.items()
+            if attr.get("attr_type") in REQUIRED_ATTR_TYPES
+        )
+        self.value_types = {}
+        for attr_id, attr in self.attributes.items():
+            types = _upper_set(attr.get("attr_value_type")) or DEFAULT_VALUE_TYPES.get(attr_id)
+            if types:
+                self.value_types[attr_id] = types
+        self.numeric = frozenset(
+            attr_id for attr_id, attr in self.attributes.items()
+            if str(attr.get("attr_field_type") or "").lower() in NUMERIC_FIELD_TYPES
+        )
+        self.max_length = {
+            attr_id: int(attr["attr_field_length"])
+            for attr_id, attr in self.attributes.items()
+            if str(attr.get("attr_field_length") or "").isdigit() and int(attr["attr_field_length"]) > 0
+        }
+        self._presets: Dict[int, FrozenSet[str]] = {}
+
+    def preset(self, attr_id: int) -> FrozenSet[str]:
+        """Справочник атрибута (preset_url загружается при первой проверке)"""
+        preset = self._presets.get(attr_id)
+        if preset is None:
+            preset = attribute_preset(self.attributes[attr_id])
+            # Пустой — справочника нет или НК не ответил: не запоминаем
+            if preset:
+                self._presets[attr_id] = preset
+        return preset
+
+    def name(self, attr_id: int) -> str:
+        attr = self.attributes.get(attr_id) or {}
+        return attr.get("attr_name") or get_attr_name(attr_id)
+
+
+@cache_success(lambda cat_id: CategorySchema(cat_id, ()))
+def get_category_schema(cat_id: int) -> CategorySchema:
+    """Схема категории; пока НК недоступен — незагруженная (не кешируется)"""
+    return CategorySchema(cat_id, get_category_attributes.strict(cat_id))
+
+
+def _covered_by_card(attr_id: int, card: dict) -> bool:
+    """Обязательный атрибут заполнен полем карточки (ТН ВЭД передается в tnved)"""
+    tnved = str(card.get("tnved") or "")
+    if attr_id == TNVED_GROUP_ATTR_ID:
+        return bool(tnved)
+    if attr_id == TNVED_DETAILED_ATTR_ID:
+        return len(tnved) == 10
+    return False
+
+
+def _problem(code: str, message: str, field: str = "", value="", attr_id: Optional[int] = None,
+             schema: Optional[CategorySchema] = None) -> dict:
+    problem = {"field": field, "message": message, "code": code, "value": value}
+    if attr_id is not None:
+        problem["field"] = field or "good_attrs"
+        problem["attr_id"] = attr_id
+        problem["attr_name"] = schema.name(attr_id) if schema else get_attr_name(attr_id)
+    return problem
+
+
+def validate_card(card: dict) -> dict:
+    """
+    Проверяет карточку create_card_data по схеме ее категории.
+    Возвращает {'valid', 'cat_id', 'errors', 'warnings'}.
+    """
+    errors: List[dict] = []
+    warnings: List[dict] = []
+
+    categories = card.get("categories") or []
+    cat_id = categories[0] if categories else None
+    if not cat_id:
+        errors.append(_problem("category", "Не указана категория", "categories"))
+    if not str(card.get("good_name") or "").strip():
+        errors.append(_problem("required", "Отсутствует наименование товара", "good_name"))
+    tnved = str(card.get("tnved") or "")
+    if not (tnved.isdigit() and len(tnved) in (4, 10)):
+        errors.append(_problem("tnved", "ТН ВЭД должен состоять из 4 или 10 цифр", "tnved", tnved))
+
+    schema = get_category_schema(cat_id) if cat_id else None
+    if schema is not None and not schema.loaded:
+        warnings.append(_problem("schema", f"Схема атрибутов категории {cat_id} недоступна, "
+                                           f"проверены только поля карточки", "categories", cat_id))
+        schema = None
+
+    seen = set()
+    for attr in card.get("good_attrs") or []:
+        attr_id = attr.get("attr_id")
+        value = attr.get("attr_value")
+        text = "" if value is None else str(value).strip()
+        seen.add(attr_id)
+        if not text:
+            errors.append(_problem("empty", "Пустое значение атрибута", value=value, attr_id=attr_id, schema=schema))
+            continue
+        if schema is None:
+            continue
+        if attr_id not in schema.attributes:
+            warnings.append(_problem("unknown_attr", f"Атрибута нет в категории {cat_id}",
+                                     value=value, attr_id=attr_id, schema=schema))
+            continue
+
+        preset = schema.preset(attr_id)
+        if preset and text.upper() not in preset:
+            problem = _problem("preset", "Значения нет в справочнике НК", value=value, attr_id=attr_id, schema=schema)
+            problem["suggestions"] = find_similar_values(text, preset)
+            errors.append(problem)
+
+        types = schema.value_types.get(attr_id)
+        if types:
+            value_type = str(attr.get("attr_value_type") or "")
+            if value_type.upper() not in types:
+                errors.append(_problem("value_type", f"Недопустимый тип значения «{value_type}»",
+                                       value=value, attr_id=attr_id, schema=schema))
+
+        if attr_id in schema.numeric and not _is_number(text):
+            errors.append(_problem("field_type", "Ожидается число", value=value, attr_id=attr_id, schema=schema))
+
+        max_length = schema.max_length.get(attr_id)
+        if max_length and len(text) > max_length:
+            errors.append(_problem("length", f"Длиннее {max_length} символов",
+                                   value=value, attr_id=attr_id, schema=schema))
+
+    if schema is not None:
+        for attr_id in sorted(schema.required - seen):
+            if not _covered_by_card(attr_id, card):
+                errors.append(_problem("required", "Не заполнен обязательный атрибут",
+                                       attr_id=attr_id, schema=schema))
+
+    return {"valid": not errors, "cat_id": cat_id, "errors": errors, "warnings": warnings}
+
+
+def validate_cards(cards: Iterable[dict]) -> List[dict]:
+    """Пакетная проверка: схема каждой категории загружается один раз"""
+    return [validate_card(card) for card in cards]
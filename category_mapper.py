@@ -1,17 +1,16 @@
-import json
 from pathlib import Path
 from typing import Dict, List, Tuple
 import re
 
 from config import MAPPING_FILE, LOW_PRIORITY_CATS
+from json_backend import loads
 
 # -------- 1. загружаем соответствие ТНВЭД → {cat_id: name} ----------------
 def load_mapping() -> Dict[str, Dict[int, str]]:
     p = Path(MAPPING_FILE)
     if not p.exists():
         raise FileNotFoundError(f"Файл маппинга {p} не найден")
-    with p.open(encoding="utf-8") as f:
-        raw = json.load(f)
+    raw = loads(p.read_bytes())
     # conv cat_id -> int для удобства
     return {k: {int(cid): name for cid, name in v.items()} for k, v in raw.items()}
 
@@ -1,13 +1,169 @@
 """
 Конфигурация для работы с МойСклад и Национальным каталогом
 """
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # API настройки
+# MS_BASE_URL / NC_BASE_URL в окружении переключают приложение на другие
+# адреса API, например на локальные заглушки (bench/stubs.py)
 API_SETTINGS = {
-    'base_url': 'https://api.moysklad.ru/api/remap/1.2',
+    'base_url': os.getenv('MS_BASE_URL', 'https://api.moysklad.ru/api/remap/1.2'),
     'timeout': 30
 }
 
+# Загрузка ассортимента
+# МойСклад отдает до 1000 строк на страницу, но при expand — не больше 100.
+# По умолчанию страницы запрашиваются без expand, а названия и типы атрибутов
+# и характеристик восстанавливаются локально по закешированным метаданным.
+ASSORTMENT_FETCH = {
+    'expand': '',          # например 'attributes,characteristics' — страницы будут по 100 строк
+    'fields': '',          # параметр fields, если аккаунт/эндпоинт его поддерживает
+    'page_size': 1000,
+    'expand_page_size': 100,
+}
+
+# Время жизни кеша метаданных МойСклад (атрибуты, характеристики), секунд
+METADATA_TTL = 600
+
+# Лимиты исходящих запросов (см. rate_limiter.py)
+# МойСклад: 45 запросов за 3 секунды и не больше 5 параллельных на пользователя.
+RATE_LIMITS = {
+    'moysklad': {'rate': 15, 'burst': 45, 'concurrency': 5},
+    'nk': {'rate': 5, 'burst': 10, 'concurrency': 4},
+}
+
+# Вебхуки МойСклад (product/variant CREATE/UPDATE/DELETE)
+# Если задан MS_WEBHOOK_SECRET, ассортимент держится в памяти (зеркало)
+# и обновляется по событиям вместо полной загрузки на каждый запрос.
+WEBHOOKS = {
+    'path': '/webhooks/moysklad',
+    'entity_types': ('product', 'variant'),
+    'actions': ('CREATE', 'UPDATE', 'DELETE'),
+    'debounce': 2.0,             # тишина после последнего события перед загрузкой, секунд
+    'max_delay': 10.0,           # максимальная задержка применения первого события, секунд
+    'batch_size': 100,           # id в одном запросе filter=id=...;id=...
+    'full_reload_threshold': 1000,  # больше изменений — проще перезагрузить ассортимент целиком
+    'mirror_max_age': 24 * 3600,  # полная перезагрузка зеркала не реже этого срока, секунд
+}
+
+# Пакетная проверка статусов фидов НК (feed_status.py)
+FEED_STATUS = {
+    'ttl': 2.0,            # кеш статуса фида в обработке, секунд
+    'final_ttl': 300.0,    # кеш итогового статуса (принят/отклонен), секунд
+    'workers': 4,          # параллельных запросов /v3/feed-status на пакет
+    'max_cached': 5000,
+    'max_batch': 500,      # feed_id в одном запросе /feed_status/batch
+}
+
+# Поток событий об отправках для таблицы (progress_events.py)
+PROGRESS = {
+    'poll_interval': 5.0,      # опрос фидов в обработке, секунд
+    'write_back_gtin': True,   # записывать полученные GTIN в МойСклад с сервера
+    'write_retry': 60.0,       # повтор неудачной записи GTIN, секунд (удваивается с каждой попыткой)
+    'write_attempts': 5,       # попыток записи GTIN, дальше — не повторяем до перезапуска
+    'max_poll_interval': 300.0,  # фид без изменений опрашивается все реже, до этого интервала, секунд
+    'feed_timeout': 86400.0,   # фид без финального статуса дольше — не опрашиваем до перезапуска, секунд
+    'keepalive': 15.0,         # комментарий в SSE при отсутствии событий, секунд
+    'max_events': 1000,        # событий в буфере для переподключения
+}
+
+# Справочники НК (атрибуты категорий, пресеты) кешируются до перезапуска только
+# при успешном ответе; после ошибки повторный запрос — не раньше, секунд
+NK_REFERENCE_RETRY = 30.0
+
+# Проверка карточки по схеме категории НК перед отправкой (card_validator.py):
+# карточка с ошибками не отправляется, ошибки возвращаются сразу
+PREFLIGHT_VALIDATION = True
+
+# Очередь фоновых задач (job_queue.py): массовая отправка, запись GTIN,
+# создание доп.полей. Задачи хранятся в SQLite и переживают перезапуск.
+JOBS = {
+    'file': os.getenv('JOB_QUEUE_FILE', 'jobs.sqlite3'),
+    'workers': 2,                # задач, выполняемых одновременно
+    'idle_poll': 5.0,            # проверка очереди без уведомлений, секунд
+    'progress_interval': 1.0,    # событие о прогрессе задачи не чаще, секунд
+    'heartbeat': 15.0,           # продление аренды выполняемых задач, секунд
+    'lease': 60.0,               # без продления дольше — задача забирается другим процессом, секунд
+    # Рабочие потоки стартуют с первым запросом веб-приложения; JOB_WORKERS=0 —
+    # приложение только ставит задачи (их выполняет другой процесс)
+    'autostart': os.getenv('JOB_WORKERS', '1') != '0',
+}
+
+# Условные запросы и сжатие /api/products и страницы таблицы (http_cache.py)
+HTTP_CACHE = {
+    'max_age': 300.0,        # тело перестраивается не реже, секунд (метаданные, справочники НК)
+    'min_size': 1024,        # ответы меньше не сжимаются, байт
+    'gzip_level': 6,
+    'brotli_quality': 5,     # если установлен пакет brotli
+}
+
+# Массовая запись исправлений цвета/вида товара/размера в МойСклад (corrections.py)
+CORRECTIONS = {
+    'chunk_size': 200,       # сущностей в одном POST /entity/{product|variant} (МойСклад — до 1000)
+    'fields': ('color', 'product_type', 'size'),
+}
+
+# Сверка с карточками НК (reconciliation.py): список карточек аккаунта
+# загружается постранично и кешируется, товары МойСклад сопоставляются
+# с ним по GTIN, артикулу и наименованию.
+RECONCILE = {
+    'page_size': 1000,       # карточек на страницу /v4/product-list
+    'details': True,         # артикул и размер — из /v3/product (без них сверка только по GTIN и наименованию)
+    'details_batch': 25,     # GTIN в одном запросе /v3/product
+    'ttl': 3600.0,           # кеш списка карточек НК, секунд
+    'match_by': ('gtin', 'article', 'name'),
+    'skip_carded': True,     # не отправлять товары, чей GTIN из МойСклад уже есть в НК
+}
+
+# Пакетный конвейер из командной строки (pipeline.py)
+PIPELINE = {
+    'dir': os.getenv('PIPELINE_DIR', 'pipeline_runs'),  # каталог контрольных точек запусков
+    'concurrency': {             # потоков на этап (--concurrency send=8)
+        'categorize': 4,
+        'build': 1,
+        'send': 4,
+        'write_back': 2,
+    },
+    'validate_batch': 1000,      # строк в одной пачке проверки цветов и видов
+    'poll_interval': 5.0,        # опрос статусов фидов, секунд
+    'poll_timeout': 1800.0,      # дольше — этап poll остается незавершенным до следующего --resume
+}
+
+# Несколько юрлиц в одном процессе (tenants.py). Аккаунт по умолчанию — из
+# .env (MS_TOKEN, NC_API_KEY, SEND_LEDGER_FILE, MS_WEBHOOK_SECRET), остальные —
+# из JSON-файла TENANTS_FILE: {"имя": {"ms_token_env": ..., "nk_api_key_env": ..., ...}}.
+# Аккаунт запроса выбирается заголовком, параметром или cookie (запоминается).
+TENANTS = {
+    'file': os.getenv('TENANTS_FILE', ''),
+    'default': os.getenv('DEFAULT_TENANT', 'default'),
+    'header': 'X-Tenant',
+    'query_arg': 'tenant',
+    'cookie': 'tenant',
+    'ledger_file': 'send_ledger_{name}.sqlite3',   # журнал аккаунта, если не задан send_ledger_file
+}
+
+# JSON: auto — orjson, если установлен, иначе stdlib (json_backend.py)
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+# Пакетное превью карточек НК (/nk_preview/batch): не больше товаров в запросе
+BATCH_PREVIEW_MAX_ITEMS = 1000
+
+# Профилирование запросов (см. profiling.py)
+# PROFILE_REQUESTS=1 профилирует каждый запрос; иначе — только запросы
+# с заголовком X-Profile: <ADMIN_TOKEN>. Без обоих ничего не подключается.
+PROFILING = {
+    'enabled': os.getenv('PROFILE_REQUESTS', '') == '1',
+    'header': 'X-Profile',
+    'interval': 0.005,           # шаг выборки стеков, секунд
+    'max_samples': 100_000,      # не больше выборок на профиль
+    'directory': os.getenv('PROFILE_DIR', 'profiles'),
+    'keep': 50,                  # хранить последних профилей
+}
+
 # Названия кастомных атрибутов в МойСклад
 # Названия кастомных атрибутов в МойСклад
 CUSTOM_ATTRIBUTES = {
@@ -61,6 +217,9 @@ LOW_PRIORITY_CATS = {
 }
 # <<< ----------------------------------------------------------------------
 
+# Журнал отправленных в НК карточек (SQLite)
+SEND_LEDGER_FILE = os.getenv("SEND_LEDGER_FILE", "send_ledger.sqlite3")
+
 
 # Обязательные доп.поля и их типы
 REQUIRED_CUSTOM_FIELDS = {
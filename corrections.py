@@ -0,0 +1,261 @@
+"""
+Массовая запись исправлений в МойСклад (цвет, вид товара, размер)
+
+Исправление задается правилом замены значения ({"field": "color",
+"from": "Голубой", "to": "СВЕТЛО-СИНИЙ"} — для всех строк каталога с этим
+значением) или правкой строки ({"id": ..., "changes": {"color": ...}}).
+Правка строки важнее правила.
+
+Значение пишется туда, откуда его берет _extract_item_fields: в
+характеристику варианта, в атрибут самой строки или — если значение
+унаследовано — в атрибут основного товара, так что правило исправляет
+сразу все его варианты. Правка строки с унаследованным значением
+пишется в атрибут самой строки и не задевает соседние варианты.
+
+Изменения собираются по сущностям и отправляются массовым обновлением
+POST /entity/{product|variant} пачками CORRECTIONS['chunk_size']. Записанные
+строки перечитываются в зеркало ассортимента: новая версия зеркала
+сбрасывает кеш /api/products, а карточки с исправленными значениями
+получают новые хеши (кеш карточек, журнал отправок).
+"""
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import requests
+
+from config import CHARACTERISTICS, CORRECTIONS, CUSTOM_ATTRIBUTES, WEBHOOKS
+from json_backend import response_json
+
+# Типы атрибутов, значение которых записывается строкой
+WRITABLE_ATTRIBUTE_TYPES = ("string", "text")
+
+
+def _normalize(value) -> str:
+    """Значение для сравнения: без учета регистра и лишних пробелов"""
+    return " ".join(str(value or "").split()).casefold()
+
+
+def parse_rules(rules, fields=CORRECTIONS["fields"]) -> Dict[Tuple[str, str], str]:
+    """{(поле, нормализованное исходное значение): новое значение}; ValueError — неверное правило"""
+    parsed = {}
+    for rule in rules or ():
+        if not isinstance(rule, dict):
+            raise ValueError("Правило должно быть объектом {field, from, to}")
+        field = rule.get("field")
+        if field not in fields:
+            raise ValueError(f"Поле {field!r} нельзя исправлять (доступны: {', '.join(fields)})")
+        source, target = _normalize(rule.get("from")), str(rule.get("to") or "").strip()
+        if not source or not target:
+            raise ValueError(f"Правило для поля {field} должно содержать from и to")
+        parsed[(field, source)] = target
+    return parsed
+
+
+def parse_edits(edits, fields=CORRECTIONS["fields"]) -> Dict[str, Dict[str, str]]:
+    """{id строки: {поле: новое значение}}; ValueError — неверная правка"""
+    parsed: Dict[str, Dict[str, str]] = {}
+    for edit in edits or ():
+        if not isinstance(edit, dict) or not edit.get("id"):
+            raise ValueError("Правка должна содержать id строки")
+        changes = {
+            field: str(value).strip()
+            for field, value in (edit.get("changes") or {}).items()
+            if str(value or "").strip()
+        }
+        unknown = sorted(set(changes) - set(fields))
+        if unknown:
+            raise ValueError(f"Поля {', '.join(unknown)} нельзя исправлять (доступны: {', '.join(fields)})")
+        if changes:
+            parsed.setdefault(edit["id"], {}).update(changes)
+    return parsed
+
+
+class BulkCorrections:
+    def __init__(self, api, mirror, settings: dict = CORRECTIONS):
+        self.api = api
+        self.mirror = mirror
+        self.settings = settings
+        self.stats = {"requests": 0, "updated": 0, "failed": 0}
+
+    # ------------------------------------------------------------------
+    # Планирование
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _characteristic(item, field):
+        """Характеристика варианта, из которой берется значение поля (как в _extract_item_fields)"""
+        for char in item.get("characteristics", ()):
+            char_name = char.get("name", "").lower()
+            char_value = char.get("value", "")
+            if isinstance(char_value, dict):
+                char_value = char_value.get("name", "")
+            if char_value and any(keyword in char_name for keyword in CHARACTERISTICS.get(field, ())):
+                return char
+        return None
+
+    def _has_own_value(self, item, field) -> bool:
+        by_id, keys = self.api.attributes.keys({field: CUSTOM_ATTRIBUTES[field]})
+        return bool(self.api._attribute_values(item, by_id).get(keys[field]))
+
+    def _target(self, item, field, own: bool):
+        """
+        (строка, характеристика или None) — куда записать поле строки.
+        own — правка самой строки: унаследованное значение пишется в строку, а не в товар.
+        """
+        char = self._characteristic(item, field)
+        if char is not None:
+            return item, char
+        parent = item.get("_parent_product")
+        if own or parent is None or self._has_own_value(item, field):
+            return item, None
+        return parent, None
+
+    def _attribute(self, field):
+        """(метаданные атрибута поля, ошибка)"""
+        name = CUSTOM_ATTRIBUTES[field]
+        attr = self.api.attributes.get(name)
+        if attr is None:
+            return None, f"Атрибут «{name}» не найден в МойСклад"
+        if attr.get("type") not in WRITABLE_ATTRIBUTE_TYPES:
+            return None, f"Атрибут «{name}» типа {attr.get('type')} не поддерживается"
+        return attr, None
+
+    @staticmethod
+    def _char_ref(char) -> dict:
+        return {"meta": char["meta"]} if char.get("meta") else {"id": char.get("id")}
+
+    def plan(self, items: Iterable[dict], rules=None, edits=None) -> dict:
+        """
+        Изменения для строк каталога (товар, затем его варианты).
+
+        Возвращает {'writes', 'changes', 'skipped'}: writes — тела массового
+        обновления по сущностям, changes — строки каталога, чьи значения
+        изменятся, skipped — изменения, которые нельзя записать.
+        """
+        rules = rules or {}
+        edits = edits or {}
+        slots = {}       # (тип, id сущности, attribute|characteristic, id) -> (значение, правка строки)
+        entities = {}    # (тип, id сущности) -> строка
+        attributes = {}  # поле -> (метаданные атрибута, ошибка)
+        changes, skipped = [], []
+
+        for index, item in enumerate(items):
+            item_edits = edits.get(item.get("id"), {})
+            if not rules and not item_edits:
+                continue
+            data = self.api._extract_item_fields(item)
+            for field in self.settings["fields"]:
+                current = data.get(field, "")
+                own = field in item_edits
+                value = item_edits[field] if own else rules.get((field, _normalize(current))) if current else None
+                if value is None or value == current:
+                    continue
+
+                row, char = self._target(item, field, own)
+                if char is None:
+                    if field not in attributes:
+                        attributes[field] = self._attribute(field)
+                    attr, error = attributes[field]
+                    if error:
+                        skipped.append({"id": item.get("id"), "product_index": index, "field": field, "error": error})
+                        continue
+                    slot = (row["meta"]["type"], row["id"], "attribute", attr.get("id"))
+                else:
+                    slot = (row["meta"]["type"], row["id"], "characteristic", self.api._ref_id(char))
+
+                previous = slots.get(slot)
+                if previous is not None and previous[1] and not own:
+                    continue
+                slots[slot] = (value, own)
+                entities[slot[:2]] = row
+                changes.append({
+                    "id": item.get("id"),
+                    "product_index": index,
+                    "name": data["name"],
+                    "field": field,
+                    "from": current,
+                    "to": value,
+                    "target": {"type": slot[0], "id": slot[1], "via": slot[2], "inherited": row is not item},
+                    "_slot": slot,
+                })
+
+        # Правило могло быть перекрыто правкой строки, записанной позже
+        for change in changes:
+            change["to"] = slots[change.pop("_slot")][0]
+        changes = [change for change in changes if change["to"] != change["from"]]
+
+        meta_by_attr = {attr.get("id"): attr.get("meta") for attr, _ in attributes.values() if attr}
+        grouped: Dict[Tuple[str, str], Dict[str, dict]] = {}
+        for (entity_type, entity_id, kind, ref), (value, _) in slots.items():
+            refs = grouped.setdefault((entity_type, entity_id), {"attribute": {}, "characteristic": {}})
+            refs[kind][ref] = value
+
+        writes = []
+        for entity, refs in grouped.items():
+            row = entities[entity]
+            body = {"meta": row["meta"]}
+            if refs["attribute"]:
+                body["attributes"] = [
+                    {"meta": meta_by_attr[attr_id], "value": value} for attr_id, value in refs["attribute"].items()
+                ]
+            if refs["characteristic"]:
+                # Характеристики варианта передаются все: набор заменяется целиком
+                body["characteristics"] = [
+                    dict(self._char_ref(char),
+                         value=refs["characteristic"].get(self.api._ref_id(char), char.get("value")))
+                    for char in row.get("characteristics", ())
+                ]
+            writes.append({"entity": entity[0], "id": entity[1], "name": row.get("name", ""), "body": body})
+
+        return {"writes": writes, "changes": changes, "skipped": skipped}
+
+    def chunks(self, writes: List[dict]) -> Iterator[Tuple[str, List[dict]]]:
+        """Пачки массового обновления: (тип сущности, записи)"""
+        by_type: Dict[str, List[dict]] = {}
+        for write in writes:
+            by_type.setdefault(write["entity"], []).append(write)
+        size = self.settings["chunk_size"]
+        for entity_type, entity_writes in by_type.items():
+            for start in range(0, len(entity_writes), size):
+                yield entity_type, entity_writes[start:start + size]
+
+    # ------------------------------------------------------------------
+    # Запись
+    # ------------------------------------------------------------------
+
+    def write(self, entity_type: str, writes: List[dict]) -> dict:
+        """
+        Массовое обновление одной пачки: {'updated': [id], 'failed': [{'id', 'name', 'error'}]}.
+        Ошибка запроса целиком — исключение requests.
+        """
+        url = f"{self.api.base_url}/entity/{entity_type}"
+        response = self.api.scheduler.post("moysklad", url, headers=self.api.headers,
+                                  json=[write["body"] for write in writes], timeout=self.api.timeout)
+        self.stats["requests"] += 1
+        response.raise_for_status()
+
+        updated, failed = [], []
+        for write, result in zip(writes, response_json(response)):
+            errors = result.get("errors") if isinstance(result, dict) else None
+            if errors:
+                failed.append({"id": write["id"], "name": write["name"],
+                               "error": "; ".join(str(error.get("error", error)) for error in errors)})
+            else:
+                updated.append(write["id"])
+        self.stats["updated"] += len(updated)
+        self.stats["failed"] += len(failed)
+        print(f"✏️  Массовое обновление {entity_type}: записано {len(updated)}, ошибок {len(failed)}")
+
+        self._refresh(entity_type, updated)
+        return {"updated": updated, "failed": failed}
+
+    def _refresh(self, entity_type: str, ids: List[str]) -> None:
+        """Перечитывает записанные строки в зеркало ассортимента (без зеркала каталог читается заново)"""
+        if not ids or not self.mirror.loaded:
+            return
+        batch_size = WEBHOOKS["batch_size"]
+        try:
+            for start in range(0, len(ids), batch_size):
+                self.mirror.upsert(self.api.fetch_entities(entity_type, ids[start:start + batch_size]))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"⚠️  Исправления записаны, но строки не перечитаны: {e} — зеркало будет загружено заново")
+            self.mirror.invalidate()
@@ -0,0 +1,61 @@
+"""
+Выявление изменений для синхронизации с НК
+
+Для каждой строки extract_item_data_with_inheritance считается отпечаток
+NK-значимых полей и сравнивается с отпечатком последней принятой НК
+отправки (журнал send_ledger). В набор изменений попадают только новые
+товары и товары, у которых отличается хотя бы одно из этих полей.
+"""
+import hashlib
+import json
+from typing import Dict, Iterable, List
+
+from send_ledger import send_ledger
+
+# Поля, изменение которых требует переотправки карточки в НК
+NK_FINGERPRINT_FIELDS = (
+    "name", "tnved", "color", "size", "composition", "permit_docs",
+    "brand_nk", "target_gender", "size_type",
+)
+
+
+def fingerprint_fields(row: dict) -> Dict[str, str]:
+    """Нормализованные NK-значимые поля строки"""
+    return {field: " ".join(str(row.get(field) or "").split()) for field in NK_FINGERPRINT_FIELDS}
+
+
+def fingerprint(row: dict) -> str:
+    # Только stdlib json, как card_content_hash: отпечаток хранится в журнале отправок
+    raw = json.dumps(fingerprint_fields(row), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def detect_changes(rows: Iterable[dict], stored: Dict[str, dict] = None) -> dict:
+    """
+    Сравнивает строки с сохраненными отпечатками.
+    Строки должны содержать 'id' (см. extract_item_data_with_inheritance).
+    Возвращает:
+      changes   — [{'id', 'index', 'change': 'new'|'changed', 'fields': [...], 'row'}]
+      unchanged — количество строк без изменений
+    """
+    if stored is None:
+        stored = send_ledger.accepted_fingerprints()
+
+    changes: List[dict] = []
+    unchanged = 0
+    for index, row in enumerate(rows):
+        item_id = row.get("id")
+        previous = stored.get(item_id)
+        if previous is None:
+            changes.append({"id": item_id, "index": index, "change": "new",
+                            "fields": list(NK_FINGERPRINT_FIELDS), "row": row})
+            continue
+        if fingerprint(row) == previous["fingerprint"]:
+            unchanged += 1
+            continue
+        current = fingerprint_fields(row)
+        changed_fields = [f for f in NK_FINGERPRINT_FIELDS if current[f] != previous["fields"].get(f, "")]
+        changes.append({"id": item_id, "index": index, "change": "changed",
+                        "fields": changed_fields, "row": row})
+
+    return {"changes": changes, "unchanged": unchanged}
@@ -0,0 +1,106 @@
+"""
+Пакетная проверка статусов фидов НК
+
+FeedStatusService.lookup_many разрешает сразу много feed_id:
+  - одинаковые запросы, уже выполняющиеся в других потоках, не повторяются —
+    вызывающий ждет тот же результат;
+  - свежие ответы берутся из короткого кеша (итоговые статусы — из долгого);
+  - статусы оставшихся фидов запрашиваются параллельно через планировщик
+    (он же ограничивает нагрузку на НК), а детали отклоненных фидов —
+    одним списком /v3/feeds на весь пакет (NKClient.get_feed_details_many).
+Фиды принадлежат аккаунту НК: у каждого аккаунта свой сервис (tenants.py).
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, Iterable
+
+from config import FEED_STATUS
+from nk_api import FEED_ACCEPTED_STATUSES, NKClient, attach_feed_details, feed_needs_details, nk_client
+
+FINAL_STATUSES = FEED_ACCEPTED_STATUSES | {"Rejected"}
+
+
+class FeedStatusService:
+    def __init__(self, settings: dict = FEED_STATUS, nk: NKClient = nk_client):
+        self.nk = nk
+        self.ttl = settings["ttl"]
+        self.final_ttl = settings["final_ttl"]
+        self._pool = ThreadPoolExecutor(settings["workers"], thread_name_prefix="feed-status")
+        self._cache: Dict[str, tuple] = {}       # feed_id -> (истекает, feed_info)
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "cache_hits": 0, "coalesced": 0, "fetched": 0, "details": 0}
+
+    def lookup(self, feed_id) -> dict:
+        return self.lookup_many([feed_id])[str(feed_id)]
+
+    def lookup_many(self, feed_ids: Iterable) -> Dict[str, dict]:
+        """{feed_id: ответ в формате nk_api.check_feed_status}"""
+        results: Dict[str, dict] = {}
+        waiting: Dict[str, Future] = {}
+        mine = []
+        now = time.monotonic()
+        with self._lock:
+            for feed_id in dict.fromkeys(str(feed_id) for feed_id in feed_ids):
+                self.stats["lookups"] += 1
+                cached = self._cache.get(feed_id)
+                if cached and cached[0] > now:
+                    self.stats["cache_hits"] += 1
+                    results[feed_id] = cached[1]
+                elif feed_id in self._inflight:
+                    self.stats["coalesced"] += 1
+                    waiting[feed_id] = self._inflight[feed_id]
+                else:
+                    waiting[feed_id] = self._inflight[feed_id] = Future()
+                    mine.append(feed_id)
+
+        if mine:
+            self._resolve(mine)
+        for feed_id, future in waiting.items():
+            results[feed_id] = future.result()
+        return results
+
+    def _resolve(self, feed_ids) -> None:
+        infos = {}
+        try:
+            # Приоритет вызывающего (опрос, интерактивный запрос) переходит в потоки пула
+            futures = {
+                feed_id: self._pool.submit(copy_context().run, self.nk.fetch_feed_status, feed_id)
+                for feed_id in feed_ids
+            }
+            infos = {feed_id: future.result() for feed_id, future in futures.items()}
+            self.stats["fetched"] += len(infos)
+
+            rejected = [feed_id for feed_id, info in infos.items() if feed_needs_details(info)]
+            if rejected:
+                self.stats["details"] += len(rejected)
+                details = self.nk.get_feed_details_many(rejected)
+                for feed_id in rejected:
+                    attach_feed_details(infos[feed_id], details.get(feed_id, {}))
+        except Exception as e:
+            for feed_id in feed_ids:
+                infos.setdefault(feed_id, {"success": False, "error": str(e)})
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                for feed_id in feed_ids:
+                    info = infos.get(feed_id) or {"success": False, "error": "статус не получен"}
+                    if info.get("success"):
+                        ttl = self.final_ttl if info.get("status") in FINAL_STATUSES else self.ttl
+                        self._cache[feed_id] = (now + ttl, info)
+                    self._inflight.pop(feed_id).set_result(info)
+                self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        if len(self._cache) > FEED_STATUS["max_cached"]:
+            for feed_id in [key for key, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[feed_id]
+
+    def invalidate(self, feed_id) -> None:
+        with self._lock:
+            self._cache.pop(str(feed_id), None)
+
+
+feed_status_service = FeedStatusService()
@@ -0,0 +1,140 @@
+"""
+Условные запросы и сжатие тяжелых ответов (/api/products, страница таблицы)
+
+ResponseCache хранит по ключу маршрута последнее тело ответа вместе с
+уже сжатыми вариантами (gzip, br). Тело строится заново, только если
+изменилась версия снимка ассортимента (assortment_mirror.version) или
+истек HTTP_CACHE['max_age']; сжатие выполняется один раз на вариант.
+
+ETag — хеш содержимого (W/, так как тело отдается в разных кодировках),
+поэтому 304 корректен и без зеркала: тогда ответ строится на каждый
+запрос, но одинаковое тело не сжимается повторно. Last-Modified — время
+изменения снимка, а без него — время первого появления такого тела.
+
+brotli — необязательная зависимость: без нее отдается gzip.
+"""
+import gzip
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+from typing import Dict, Optional
+
+from flask import Response, request
+
+from config import HTTP_CACHE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=HTTP_CACHE["brotli_quality"])
+    return gzip.compress(body, compresslevel=HTTP_CACHE["gzip_level"])
+
+
+def supported_encodings():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+class CachedBody:
+    """Тело ответа и его сжатые варианты (сжимаются при первом запросе)"""
+
+    def __init__(self, body: bytes, mimetype: str, version, last_modified: float):
+        self.mimetype = mimetype
+        self.version = version
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.last_modified = last_modified
+        self.created = time.monotonic()
+        self._encoded: Dict[str, bytes] = {"identity": body}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self._encoded["identity"])
+
+    def encoded(self, encoding: str) -> bytes:
+        data = self._encoded.get(encoding)
+        if data is None:
+            with self._lock:
+                data = self._encoded.get(encoding)
+                if data is None:
+                    data = self._encoded[encoding] = _compress(self._encoded["identity"], encoding)
+        return data
+
+
+class ResponseCache:
+    def __init__(self, settings: dict = HTTP_CACHE):
+        self.settings = settings
+        self._entries: Dict[str, CachedBody] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "builds": 0, "not_modified": 0, "compressed_reused": 0}
+
+    def get(self, key: str, version) -> Optional[CachedBody]:
+        """Тело для версии снимка; None — нужно строить (версии нет, она другая или истек max_age)"""
+        if version is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            return None
+        if time.monotonic() - entry.created > self.settings["max_age"]:
+            return None
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: str, body: bytes, mimetype: str, version=None,
+            last_modified: Optional[float] = None) -> CachedBody:
+        """
+        Запоминает построенное тело. Если оно совпадает с прежним,
+        остаются прежние сжатые варианты и Last-Modified.
+        """
+        entry = CachedBody(body, mimetype, version, last_modified or time.time())
+        with self._lock:
+            self.stats["builds"] += 1
+            previous = self._entries.get(key)
+            if previous is not None and previous.etag == entry.etag:
+                self.stats["compressed_reused"] += 1
+                previous.version = version
+                previous.created = entry.created
+                if last_modified:
+                    previous.last_modified = min(previous.last_modified, last_modified)
+                return previous
+            self._entries[key] = entry
+        return entry
+
+    def _not_modified(self, entry: CachedBody) -> bool:
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(entry.etag)
+        if request.if_modified_since:
+            return int(entry.last_modified) <= request.if_modified_since.timestamp()
+        return False
+
+    def _encoding(self, entry: CachedBody) -> str:
+        if entry.size < self.settings["min_size"]:
+            return "identity"
+        accept = request.accept_encodings
+        best = max(supported_encodings(), key=lambda encoding: accept.quality(encoding))
+        return best if accept.quality(best) > 0 else "identity"
+
+    def respond(self, entry: CachedBody) -> Response:
+        """Ответ на текущий запрос: 304 или тело в лучшей из принятых клиентом кодировок"""
+        headers = {
+            "ETag": f'W/"{entry.etag}"',
+            "Last-Modified": formatdate(entry.last_modified, usegmt=True),
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if self._not_modified(entry):
+            self.stats["not_modified"] += 1
+            return Response(status=304, headers=headers)
+
+        encoding = self._encoding(entry)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(entry.encoded(encoding), mimetype=entry.mimetype, headers=headers)
+
+
+response_cache = ResponseCache()
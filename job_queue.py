@@ -0,0 +1,416 @@
+"""
+Очередь фоновых задач (SQLite)
+
+Долгие операции — массовая отправка в НК, запись GTIN, создание
+доп.полей — выполняются рабочими потоками, а не в обработчике запроса.
+Задача (job) состоит из элементов (items): вид задачи задает plan(params, ctx),
+который перечисляет элементы, и run_item(payload, ctx), который выполняет один.
+
+  - прогресс: total / done / failed, скорость (элементов в секунду) и ETA;
+  - отмена: между элементами; невыполненные элементы остаются pending;
+  - повтор: retry возвращает упавшие элементы в pending и ставит задачу в очередь;
+  - возобновление: задачи, прерванные перезапуском процесса, продолжаются
+    с первого невыполненного элемента.
+
+Рабочие потоки запускаются явно (start) — только в процессе, который
+обслуживает очередь; ставить задачи и читать их можно из любого процесса.
+Выполняемая задача арендуется процессом: владелец (owner) продлевает
+heartbeat каждые JOBS['heartbeat'] секунд, и другой процесс забирает
+задачу только после истечения аренды (JOBS['lease']), то есть когда
+владелец остановлен. Живые задачи соседнего процесса не перехватываются.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import JOBS
+from json_backend import dumps_str, loads
+from rate_limiter import PRIORITY_BACKGROUND, request_priority
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_ERROR = "error"            # не удалось составить список элементов
+
+ITEM_PENDING = "pending"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind        TEXT NOT NULL,
+    params      TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    planned     INTEGER NOT NULL DEFAULT 0,
+    total       INTEGER NOT NULL DEFAULT 0,
+    done        INTEGER NOT NULL DEFAULT 0,
+    failed      INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    elapsed     REAL NOT NULL DEFAULT 0,
+    error       TEXT,
+    created_at  TEXT NOT NULL,
+    started_at  TEXT,
+    finished_at TEXT,
+    updated_at  TEXT NOT NULL,
+    owner       TEXT,
+    heartbeat   REAL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id      INTEGER NOT NULL,
+    seq         INTEGER NOT NULL,
+    item_key    TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    result      TEXT,
+    updated_at  TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE INDEX IF NOT EXISTS job_items_status ON job_items (job_id, status);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class JobKind:
+    def __init__(self, plan: Callable[[dict, dict], Iterable[Tuple[str, dict]]],
+                 run_item: Callable[[dict, dict], Optional[dict]]):
+        self.plan = plan
+        self.run_item = run_item
+
+
+class JobQueue:
+    """
+    on_progress(job) вызывается при смене статуса задачи и во время
+    выполнения не чаще раза в JOBS['progress_interval'] секунд.
+    job_context(job) — контекстный менеджер, внутри которого выполняется
+    задача (например, аккаунт из ее параметров, см. tenants.py).
+    Скорость считается по суммарному времени выполнения элементов.
+    """
+
+    def __init__(self, path: str = JOBS["file"], workers: int = JOBS["workers"],
+                 on_progress: Optional[Callable[[dict], None]] = None,
+                 job_context: Optional[Callable[[dict], object]] = None):
+        self.path = path
+        self.workers = workers
+        self.on_progress = on_progress
+        self.job_context = job_context or (lambda job: nullcontext())
+        self.kinds: Dict[str, JobKind] = {}
+        self._threads: List[threading.Thread] = []
+        self._wake = threading.Condition()
+        self._stopping = threading.Event()
+        self._claim_lock = threading.Lock()
+        # Владелец аренды: процесс на хосте (pid может повториться после перезапуска)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # Колонки, добавленные после первой версии очереди
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("heartbeat", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def register(self, kind: str, plan, run_item) -> None:
+        self.kinds[kind] = JobKind(plan, run_item)
+
+    # ------------------------------------------------------------------
+    # Управление задачами
+    # ------------------------------------------------------------------
+
+    def submit(self, kind: str, params: Optional[dict] = None) -> dict:
+        if kind not in self.kinds:
+            raise ValueError(f"Неизвестный вид задачи: {kind}")
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, dumps_str(params or {}), JOB_QUEUED, _now(), _now()),
+            )
+            job_id = cursor.lastrowid
+        self._notify()
+        return self.get(job_id)
+
+    def cancel(self, job_id: int) -> Optional[dict]:
+        """Отмена: очередная задача отменяется сразу, выполняющаяся — после текущего элемента"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN status = ? THEN ? ELSE status END, "
+                "cancel_requested = 1, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                (JOB_QUEUED, JOB_CANCELLED, _now(), job_id, JOB_QUEUED, JOB_RUNNING),
+            )
+        return self.get(job_id)
+
+    def retry(self, job_id: int) -> Optional[dict]:
+        """Упавшие элементы — снова в pending; отмененная или завершенная задача — снова в очередь"""
+        with self._connect() as conn:
+            job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None or job["status"] in (JOB_QUEUED, JOB_RUNNING):
+                return self.get(job_id) if job else None
+            retried = conn.execute(
+                "UPDATE job_items SET status = ?, error = NULL, updated_at = ? WHERE job_id = ? AND status = ?",
+                (ITEM_PENDING, _now(), job_id, ITEM_FAILED),
+            ).rowcount
+            conn.execute(
+                "UPDATE jobs SET status = ?, failed = failed - ?, cancel_requested = 0, error = NULL, "
+                "finished_at = NULL, updated_at = ? WHERE id = ?",
+                (JOB_QUEUED, retried, _now(), job_id),
+            )
+        self._notify()
+        return self.get(job_id)
+
+    # ------------------------------------------------------------------
+    # Чтение
+    # ------------------------------------------------------------------
+
+    def _describe(self, row) -> dict:
+        job = dict(row)
+        job.pop("heartbeat", None)
+        job["params"] = loads(job["params"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        job["planned"] = bool(job["planned"])
+        processed = job["done"] + job["failed"]
+        job["pending"] = max(0, job["total"] - processed)
+        job["progress"] = round(processed / job["total"], 4) if job["total"] else 0.0
+        rate = processed / job["elapsed"] if job["elapsed"] else 0.0
+        job["throughput"] = round(rate, 2)
+        job["eta"] = round(job["pending"] / rate, 1) if rate and job["status"] == JOB_RUNNING else None
+        return job
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._describe(row) if row else None
+
+    def list(self, limit: int = 50, params: Optional[dict] = None,
+             defaults: Optional[dict] = None) -> List[dict]:
+        """
+        Последние задачи; params — только с такими значениями параметров
+        (например {"tenant": "acme"}), defaults — значение параметра, если
+        у задачи его нет (задачи, поставленные до его появления)
+        """
+        conditions, args = [], []
+        for key, value in (params or {}).items():
+            conditions.append("COALESCE(json_extract(params, ?), ?) = ?")
+            args += [f"$.{key}", (defaults or {}).get(key), value]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT * FROM jobs{where} ORDER BY id DESC LIMIT ?", (*args, limit)).fetchall()
+        return [self._describe(row) for row in rows]
+
+    def items(self, job_id: int, status: Optional[str] = None, limit: int = 200) -> List[dict]:
+        query = "SELECT item_key, status, attempts, error, result FROM job_items WHERE job_id = ?"
+        args: list = [job_id]
+        if status:
+            query += " AND status = ?"
+            args.append(status)
+        query += " ORDER BY seq LIMIT ?"
+        args.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(query, args).fetchall()
+        return [dict(row, result=loads(row["result"]) if row["result"] else None) for row in rows]
+
+    # ------------------------------------------------------------------
+    # Рабочие потоки
+    # ------------------------------------------------------------------
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    def start(self) -> None:
+        """
+        Запускает рабочие потоки и продление аренды. Задачи других процессов
+        не трогаются: прерванные перезапуском забираются после истечения аренды.
+        """
+        with self._wake:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{index}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Останавливает рабочие потоки после текущего элемента задачи. Прерванная
+        задача остается выполняемой и после истечения аренды забирается снова.
+        """
+        with self._wake:
+            threads, self._threads = self._threads, []
+            self._stopping.set()
+            self._wake.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _heartbeat(self) -> None:
+        """Продлевает аренду всех выполняемых этим процессом задач"""
+        while not self._stopping.wait(JOBS["heartbeat"]):
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = ?",
+                        (time.time(), self.owner, JOB_RUNNING),
+                    )
+            except sqlite3.Error as e:
+                print(f"⚠️  Очередь задач: аренда не продлена: {e}")
+
+    def _notify(self) -> None:
+        with self._wake:
+            self._wake.notify_all()
+
+    def _claim(self) -> Optional[dict]:
+        """Очередная задача или выполнявшаяся, чья аренда истекла (владелец остановлен)"""
+        expired = time.time() - JOBS["lease"]
+        with self._claim_lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? OR (status = ? AND COALESCE(heartbeat, 0) < ?) "
+                "ORDER BY id LIMIT 1",
+                (JOB_QUEUED, JOB_RUNNING, expired),
+            ).fetchone()
+            if row is None:
+                return None
+            claimed = conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, started_at = COALESCE(started_at, ?), "
+                "updated_at = ? WHERE id = ? AND status = ? AND COALESCE(heartbeat, 0) = COALESCE(?, 0)",
+                (JOB_RUNNING, self.owner, time.time(), _now(), _now(), row["id"], row["status"], row["heartbeat"]),
+            ).rowcount
+        if claimed and row["status"] == JOB_RUNNING:
+            print(f"🔁 Очередь задач: возобновлена прерванная задача {row['id']} ({row['kind']})")
+        return self.get(row["id"]) if claimed else None
+
+    def _worker(self) -> None:
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                with self._wake:
+                    if not self._stopping.is_set():
+                        self._wake.wait(JOBS["idle_poll"])
+                continue
+            try:
+                with request_priority(PRIORITY_BACKGROUND), self.job_context(job):
+                    self._run(job)
+            except Exception as e:
+                print(f"❌ Задача {job['id']} ({job['kind']}) прервана: {e}")
+                self._finish(job["id"], JOB_ERROR, str(e))
+
+    def _run(self, job: dict) -> None:
+        kind = self.kinds.get(job["kind"])
+        if kind is None:
+            self._finish(job["id"], JOB_ERROR, f"Неизвестный вид задачи: {job['kind']}")
+            return
+        ctx: dict = {"job_id": job["id"]}
+        if not job["planned"]:
+            self._plan(job, kind, ctx)
+        self._report(job["id"])
+
+        last_report = time.monotonic()
+        with self._connect() as conn:
+            pending = conn.execute(
+                "SELECT seq, payload FROM job_items WHERE job_id = ? AND status = ? ORDER BY seq",
+                (job["id"], ITEM_PENDING),
+            ).fetchall()
+
+        for row in pending:
+            state = self._state(job["id"])
+            if state is None or state["owner"] != self.owner:
+                print(f"⚠️  Задача {job['id']} выполняется другим процессом (аренда истекла)")
+                return
+            if state["cancel_requested"]:
+                self._finish(job["id"], JOB_CANCELLED)
+                return
+            if self._stopping.is_set():
+                print(f"⏸️  Задача {job['id']} прервана остановкой очереди")
+                return
+            started = time.monotonic()
+            try:
+                result = kind.run_item(loads(row["payload"]), ctx)
+                status, error = ITEM_DONE, None
+            except Exception as e:
+                result, status, error = None, ITEM_FAILED, str(e)
+            self._record_item(job["id"], row["seq"], status, error, result, time.monotonic() - started)
+            if time.monotonic() - last_report >= JOBS["progress_interval"]:
+                last_report = time.monotonic()
+                self._report(job["id"])
+
+        self._finish(job["id"], JOB_DONE)
+
+    def _plan(self, job: dict, kind: JobKind, ctx: dict) -> None:
+        items = [
+            (seq, str(key), dumps_str(payload), ITEM_PENDING, _now())
+            for seq, (key, payload) in enumerate(kind.plan(job["params"], ctx))
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO job_items (job_id, seq, item_key, payload, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(job["id"], *item) for item in items],
+            )
+            conn.execute(
+                "UPDATE jobs SET planned = 1, total = ?, updated_at = ? WHERE id = ?",
+                (len(items), _now(), job["id"]),
+            )
+        print(f"📋 Задача {job['id']} ({job['kind']}): {len(items)} элементов")
+
+    def _record_item(self, job_id: int, seq: int, status: str, error: Optional[str],
+                     result: Optional[dict], elapsed: float) -> None:
+        counter = "done" if status == ITEM_DONE else "failed"
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE job_items SET status = ?, attempts = attempts + 1, error = ?, result = ?, updated_at = ? "
+                "WHERE job_id = ? AND seq = ?",
+                (status, error, dumps_str(result) if result is not None else None,
+                 _now(), job_id, seq),
+            )
+            conn.execute(
+                f"UPDATE jobs SET {counter} = {counter} + 1, elapsed = elapsed + ?, updated_at = ? WHERE id = ?",
+                (elapsed, _now(), job_id),
+            )
+
+    def _state(self, job_id: int):
+        with self._connect() as conn:
+            return conn.execute("SELECT cancel_requested, owner FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, owner = NULL, heartbeat = NULL, finished_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                (status, error, _now(), _now(), job_id),
+            )
+        self._report(job_id)
+
+    def _report(self, job_id: int) -> None:
+        if self.on_progress is None:
+            return
+        job = self.get(job_id)
+        if job is not None:
+            try:
+                self.on_progress(job)
+            except Exception as e:
+                print(f"⚠️  Ошибка уведомления о задаче {job_id}: {e}")
@@ -0,0 +1,102 @@
+"""
+JSON: orjson, если установлен, иначе стандартный json
+
+Используется для ответов МойСклад и НК, тел ответов API (Flask
+app.json и /api/products), потоков событий и JSON, хранимого на диске
+(журнал отправок, очередь задач, таблица ТН ВЭД → категория).
+Backend выбирается JSON_BACKEND в config.py (переменная окружения
+JSON_BACKEND: auto, orjson или stdlib).
+
+Хеши карточек и отпечатки полей (card_cache, delta_sync) всегда
+считаются стандартным json: по ним журнал отправок узнает уже
+отправленные карточки, и байты не должны зависеть от backend.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable, List, Optional
+from uuid import UUID
+
+from flask.json.provider import DefaultJSONProvider
+
+from config import JSON_BACKEND
+from json_stream import iter_json_rows
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if JSON_BACKEND == "orjson" and orjson is None:
+    print("⚠️  JSON_BACKEND=orjson, но пакет orjson не установлен — используется stdlib")
+
+BACKEND = "orjson" if orjson is not None and JSON_BACKEND in ("auto", "orjson") else "stdlib"
+
+
+def _default(obj):
+    """Типы, которые не сериализуются напрямую (как в Flask DefaultJSONProvider)"""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (Decimal, UUID)):
+        return str(obj)
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if BACKEND == "orjson":
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def dumps_str(obj) -> str:
+    return dumps(obj).decode("utf-8")
+
+
+def response_json(response):
+    """Замена response.json() для ответов requests"""
+    return loads(response.content)
+
+
+def page_rows(body: bytes, key: str = "rows", extra: Optional[dict] = None) -> List[dict]:
+    """Строки страницы из тела ответа целиком (остальные поля — в extra)"""
+    data = loads(body)
+    rows = data.pop(key, None) or []
+    if extra is not None:
+        extra.update(data)
+    return rows
+
+
+def iter_page_rows(response, key: str = "rows") -> Iterable[dict]:
+    """
+    Строки страницы ответа requests (stream=True).
+    С orjson тело разбирается целиком — это в разы быстрее; со stdlib —
+    потоково (json_stream), чтобы не держать в памяти разобранную страницу.
+    """
+    if BACKEND == "orjson":
+        return page_rows(response.content, key)
+    return iter_json_rows(response.iter_content(chunk_size=65536), key)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask (jsonify, request.get_json) на выбранном backend"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        # Отступы (отладочный режим Flask) — только у stdlib
+        if kwargs.get("indent"):
+            return super().dumps(obj, **kwargs)
+        return dumps_str(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
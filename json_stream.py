@@ -0,0 +1,113 @@
+"""
+Потоковый разбор JSON-ответов МойСклад
+
+Страница ассортимента — это объект {"context": ..., "meta": ..., "rows": [...]}.
+iter_json_rows читает тело ответа кусками и отдает элементы массива "rows"
+по одному, не собирая в памяти ни весь текст ответа, ни весь список строк.
+"""
+import codecs
+import json
+from typing import Iterable, Iterator, Optional
+
+_WHITESPACE = " \t\n\r"
+
+# Буфер подрезается, когда разобранная часть превышает этот размер
+_TRIM_THRESHOLD = 1 << 20
+
+
+class _Buffer:
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def fill(self) -> bool:
+        """Дочитывает следующий кусок; False, если данных больше нет"""
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            text = self._decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if not text:
+                continue
+            if self.pos > _TRIM_THRESHOLD or self.pos == len(self.text):
+                self.text = self.text[self.pos:]
+                self.pos = 0
+            self.text += text
+            return True
+        tail = self._decoder.decode(b"", final=True)
+        if tail:
+            self.text += tail
+            return True
+        self.exhausted = True
+        return False
+
+    def peek(self) -> str:
+        """Первый непробельный символ (позиция сдвигается на него)"""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ValueError("Неожиданный конец JSON")
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"Ожидался '{char}' в позиции {self.pos}: {self.text[self.pos:self.pos + 40]!r}")
+        self.pos += 1
+
+    def value(self, decoder: json.JSONDecoder):
+        """Разбирает одно значение целиком, при необходимости дочитывая данные"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # Число на границе буфера может быть обрезано — дочитываем
+            if end == len(self.text) and isinstance(value, (int, float)) and not self.exhausted:
+                if self.fill():
+                    continue
+            self.pos = end
+            return value
+
+
+def iter_json_rows(chunks: Iterable[bytes], key: str = "rows",
+                   extra: Optional[dict] = None) -> Iterator[dict]:
+    """
+    Отдает элементы массива `key` верхнего уровня JSON-объекта.
+    Остальные поля верхнего уровня складываются в `extra` (если передан).
+    """
+    decoder = json.JSONDecoder()
+    buf = _Buffer(chunks)
+    buf.expect("{")
+
+    if buf.peek() == "}":
+        return
+    while True:
+        name = buf.value(decoder)
+        buf.expect(":")
+        if name == key and buf.peek() == "[":
+            buf.pos += 1
+            if buf.peek() != "]":
+                while True:
+                    yield buf.value(decoder)
+                    if buf.peek() == ",":
+                        buf.pos += 1
+                        continue
+                    break
+            buf.expect("]")
+        else:
+            value = buf.value(decoder)
+            if extra is not None:
+                extra[name] = value
+
+        if buf.peek() == ",":
+            buf.pos += 1
+            continue
+        buf.expect("}")
+        return
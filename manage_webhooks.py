@@ -0,0 +1,44 @@
+"""
+Управление вебхуками МойСклад
+
+    python manage_webhooks.py list
+    python manage_webhooks.py register https://catalog.example.ru
+    python manage_webhooks.py unregister https://catalog.example.ru
+    python manage_webhooks.py --tenant acme register https://catalog.example.ru
+"""
+import argparse
+import sys
+
+from app import tenants
+from webhooks import list_webhooks, register_webhooks, unregister_webhooks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Вебхуки МойСклад для зеркала ассортимента")
+    parser.add_argument("--tenant", help="аккаунт из TENANTS_FILE (по умолчанию — из .env)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="показать зарегистрированные вебхуки")
+    for name, help_text in (("register", "подписаться на события product/variant"),
+                            ("unregister", "удалить вебхуки этого сервера")):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument("public_url", help="внешний адрес приложения, например https://catalog.example.ru")
+    args = parser.parse_args(argv)
+    try:
+        tenant = tenants.get(args.tenant)
+    except LookupError as e:
+        parser.error(f"{e} (доступны: {', '.join(tenants.names())})")
+
+    if args.command == "list":
+        for hook in list_webhooks(tenant.api):
+            print(f"{hook.get('entityType', ''):10} {hook.get('action', ''):7} {hook.get('url')}")
+    elif args.command == "register":
+        created = register_webhooks(tenant.api, args.public_url, tenant.webhook_path)
+        print(f"✅ Создано вебхуков: {len(created)}")
+    else:
+        removed = unregister_webhooks(tenant.api, args.public_url, tenant.webhook_path)
+        print(f"🗑️  Удалено вебхуков: {len(removed)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
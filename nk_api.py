@@ -2,120 +2,160 @@
 API для работы с национальным каталогом
 """
 import os
-from functools import cache
-from typing import Tuple, Set, List, Dict
+import time
+from collections import defaultdict
+from functools import cache, lru_cache, wraps
+from typing import Tuple, Set, List, Dict, FrozenSet, Iterable, Iterator
 from category_mapper import choose_category
 import requests
 from dotenv import load_dotenv
 from datetime import datetime
-from config import DEFAULT_NK_CATEGORY
+from config import DEFAULT_NK_CATEGORY, NK_REFERENCE_RETRY
+from rate_limiter import scheduler
+from json_backend import response_json
 
 load_dotenv()
 
 NC_API_KEY = os.getenv("NC_API_KEY")
-BASE_URL = "https://апи.национальный-каталог.рф"
+BASE_URL = os.getenv("NC_BASE_URL", "https://апи.национальный-каталог.рф")
 USE_LOCAL_MAPPING_FIRST = True
 
 # ---------------------------------------------------------------------------
 # 🔗  Запросы к API
 # ---------------------------------------------------------------------------
 
-def _req(path: str, **params):
-    """Базовый GET-запрос к API нац. каталога"""
-    params.setdefault("apikey", NC_API_KEY)
+# Справочники (категории, атрибуты, пресеты цветов и видов) одинаковы для
+# всех аккаунтов НК: они запрашиваются ключом reference_client и кешируются
+# на уровне процесса, а запросы от имени аккаунта — методы NKClient.
+
+def _get_result(path: str, **params):
+    """GET-запрос справочника НК: поле result ответа; ошибки — исключения"""
+    return reference_client.get_result(path, **params)
 
-    try:
-        resp = requests.get(f"{BASE_URL}{path}", params=params, timeout=30)
-        resp.raise_for_status()
-        return resp.json().get("result")
-    except requests.exceptions.RequestException as e:
-        print(f"❌  Ошибка API нац. каталога: {e}")
-    except (KeyError, ValueError) as e:
-        print(f"❌  Неверный формат ответа API: {e}")
 
-    return None
+def cache_success(fallback):
+    """
+    Как @cache, но запоминаются только успешные результаты. Исключение
+    печатается, а вызывающему возвращается fallback (значение или функция
+    от аргументов); следующий запрос — не раньше чем через NK_REFERENCE_RETRY
+    секунд, чтобы сбой НК не закрепился до перезапуска и не превратился
+    в поток запросов. func.strict(...) — то же, но ошибка пробрасывается
+    (для кешей, построенных поверх справочника).
+    """
+    def decorator(func):
+        results = {}
+        failed_until = {}
+
+        def strict(*args):
+            try:
+                return results[args]
+            except KeyError:
+                pass
+            if failed_until.get(args, 0) > time.monotonic():
+                raise LookupError(f"{func.__name__}{args}: справочник НК недавно был недоступен")
+            try:
+                value = func(*args)
+            except Exception:
+                failed_until[args] = time.monotonic() + NK_REFERENCE_RETRY
+                raise
+            failed_until.pop(args, None)
+            results[args] = value
+            return value
+
+        @wraps(func)
+        def wrapper(*args):
+            try:
+                return strict(*args)
+            except Exception as e:
+                print(f"❌  {e}" if isinstance(e, LookupError) else f"❌  Ошибка справочника НК {func.__name__}{args}: {e}")
+                return fallback(*args) if callable(fallback) else fallback
+
+        wrapper.strict = strict
+        wrapper.cache_clear = lambda: (results.clear(), failed_until.clear())
+        return wrapper
+    return decorator
 
 
 # ---------------------------------------------------------------------------
 # 📋  Справочники
 # ---------------------------------------------------------------------------
 
-@cache
-def get_color_preset() -> Set[str]:
-    """Множество допустимых цветов (attr_id 36) в верхнем регистре"""
-    try:
-        attrs = _req("/v3/attributes", cat_id=30933, attr_type="a") or []
-        color_attr = next((a for a in attrs if a["attr_id"] == 36), None)
-        if not color_attr:
-            return set()
+# Пресеты возвращаются как frozenset: хеш frozenset вычисляется один раз,
+# поэтому по самому пресету дешево кешировать индекс подсказок.
 
-        if color_attr.get("attr_preset"):
-            return {v.upper() for v in color_attr["attr_preset"]}
-        if color_attr.get("preset_url"):
-            preset = _req(color_attr["preset_url"]) or []
-            return {v.upper() for v in preset}
+@cache_success(())
+def get_category_attributes(cat_id: int) -> Tuple[Dict, ...]:
+    """
+    Атрибуты категории из /v3/attributes (все типы) — один запрос на категорию.
+    Из них берутся пресеты цветов и видов и схема для проверки карточек
+    (card_validator.py). При ошибке НК — пустой кортеж (не кешируется).
+    """
+    return tuple(_get_result("/v3/attributes", cat_id=cat_id, attr_type="a") or ())
 
-    except Exception as e:
-        print(f"❌  Ошибка получения пресета цветов: {e}")
 
-    return set()
+@cache_success(frozenset())
+def get_preset_values(preset_url: str) -> FrozenSet[str]:
+    """Значения справочника, вынесенного в отдельный preset_url"""
+    return frozenset(v.upper() for v in _get_result(preset_url) or [])
 
 
-@cache
-def get_kind_preset(cat_id: int) -> Set[str]:
-    """Множество допустимых «видов товара» (attr_id 12) в верхнем регистре"""
-    try:
-        attrs = _req("/v3/attributes", cat_id=cat_id, attr_type="a") or []
-        kind_attr = next((a for a in attrs if a["attr_id"] == 12), None)
-        if not kind_attr:
-            return set()
+def attribute_preset(attr: Dict) -> FrozenSet[str]:
+    """Допустимые значения атрибута в верхнем регистре (пусто — без справочника)"""
+    if attr.get("attr_preset"):
+        return frozenset(str(v).upper() for v in attr["attr_preset"])
+    if attr.get("preset_url"):
+        return get_preset_values(attr["preset_url"])
+    return frozenset()
 
-        if kind_attr.get("attr_preset"):
-            return {v.upper() for v in kind_attr["attr_preset"]}
-        if kind_attr.get("preset_url"):
-            preset = _req(kind_attr["preset_url"]) or []
-            return {v.upper() for v in preset}
 
-    except Exception as e:
-        print(f"❌  Ошибка получения видов для категории {cat_id}: {e}")
+def _category_preset(cat_id: int, attr_id: int) -> FrozenSet[str]:
+    """Пресет атрибута категории; ошибка НК — исключение (пустой пресет не кешируется)"""
+    attr = next((a for a in get_category_attributes.strict(cat_id) if a.get("attr_id") == attr_id), None)
+    if not attr:
+        return frozenset()
+    if attr.get("preset_url") and not attr.get("attr_preset"):
+        return get_preset_values.strict(attr["preset_url"])
+    return attribute_preset(attr)
 
-    return set()
 
+@cache_success(frozenset())
+def get_color_preset() -> FrozenSet[str]:
+    """Множество допустимых цветов (attr_id 36) в верхнем регистре"""
+    return _category_preset(30933, 36)
 
-@cache
+
+@cache_success(frozenset())
+def get_kind_preset(cat_id: int) -> FrozenSet[str]:
+    """Множество допустимых «видов товара» (attr_id 12) в верхнем регистре"""
+    return _category_preset(cat_id, 12)
+
+
+@cache_success(lambda tnved: [])
 def get_categories_by_tnved(tnved: str) -> List[Dict]:
-    """Категории, в которые входит указанный код ТН ВЭД"""
-    try:
-        print(f"\n🔍  Запрашиваем категории для ТН ВЭД {tnved}")
-        # если код 10-значный — сначала пробуем по группе (первые 4 цифры)
-        if len(tnved) == 10:
-            group_code = tnved[:4]
-            cats = _req("/v3/categories", tnved=group_code) or []
-            if cats:
-                print(f"  ✅  Нашли категории по группе {group_code}")
-                return cats
-
-        cats = _req("/v3/categories", tnved=tnved) or []
+    """Категории, в которые входит указанный код ТН ВЭД (ошибка НК не кешируется)"""
+    print(f"\n🔍  Запрашиваем категории для ТН ВЭД {tnved}")
+    # если код 10-значный — сначала пробуем по группе (первые 4 цифры)
+    if len(tnved) == 10:
+        group_code = tnved[:4]
+        cats = _get_result("/v3/categories", tnved=group_code) or []
         if cats:
-            print("  ✅  Нашли категории по полному коду")
-        else:
-            print("  ❌  Категории не найдены")
+            print(f"  ✅  Нашли категории по группе {group_code}")
+            return cats
 
-        return cats
-    except Exception as e:
-        print(f"❌  Ошибка получения категорий для ТН ВЭД {tnved}: {e}")
-        return []
+    cats = _get_result("/v3/categories", tnved=tnved) or []
+    if cats:
+        print("  ✅  Нашли категории по полному коду")
+    else:
+        print("  ❌  Категории не найдены")
 
+    return cats
 
-@cache
+
+@cache_success(lambda cat_id: {})
 def get_category_by_id(cat_id: int) -> Dict:
-    """Информация о категории"""
-    try:
-        cats = _req("/v3/categories", cat_id=cat_id) or []
-        return cats[0] if cats else {}
-    except Exception as e:
-        print(f"❌  Ошибка получения категории {cat_id}: {e}")
-        return {}
+    """Информация о категории (ошибка НК не кешируется)"""
+    cats = _get_result("/v3/categories", cat_id=cat_id) or []
+    return cats[0] if cats else {}
 
 
 # ---------------------------------------------------------------------------
@@ -188,7 +228,7 @@ def determine_category_for_tnved(tnved: str) -> int:
 
 def validate_color(color_value: str) -> Tuple[bool, Set[str]]:
     if not color_value:
-        return False, set()
+        return False, frozenset()
     preset = get_color_preset()
     val = color_value.upper()
     return val in preset, preset
@@ -196,64 +236,116 @@ def validate_color(color_value: str) -> Tuple[bool, Set[str]]:
 
 def validate_product_kind(kind_value: str, cat_id: int) -> Tuple[bool, Set[str]]:
     if not kind_value or not cat_id:
-        return False, set()
+        return False, frozenset()
     preset = get_kind_preset(cat_id)
     val = kind_value.upper()
     return val in preset, preset
 
 
+# Пакетная проверка: результат кешируется по каждому различному значению,
+# поэтому страница из тысяч строк стоит столько, сколько в ней разных цветов/видов.
+# Пресет — часть ключа кеша: пустой пресет (НК был недоступен) не закрепляет
+# вердикт «недопустимо», после загрузки пресета значения проверяются заново.
+
+@lru_cache(maxsize=8192)
+def _check_value(value: str, preset: FrozenSet[str], threshold: float) -> Tuple[bool, Tuple[str, ...]]:
+    if value.upper() in preset:
+        return True, ()
+    return False, tuple(find_similar_values(value, preset, threshold))
+
+
+def _check_color(value: str, threshold: float) -> Tuple[bool, Tuple[str, ...]]:
+    return _check_value(value, get_color_preset(), threshold)
+
+
+def _check_kind(value: str, cat_id: int, threshold: float) -> Tuple[bool, Tuple[str, ...]]:
+    if not cat_id:
+        return False, ()
+    return _check_value(value, get_kind_preset(cat_id), threshold)
+
+
+def validate_colors(values: Iterable[str], threshold: float = 0.6) -> Dict[str, Tuple[bool, List[str]]]:
+    """
+    Проверяет все различные цвета за один проход.
+    Возвращает {значение: (валидно, подсказки)}; пустые значения пропускаются.
+    """
+    return {
+        value: (valid, list(suggestions))
+        for value in set(values) if value
+        for valid, suggestions in (_check_color(value, threshold),)
+    }
+
+
+def validate_product_kinds(values: Iterable[str], cat_id: int,
+                           threshold: float = 0.6) -> Dict[str, Tuple[bool, List[str]]]:
+    """Пакетная проверка видов товара в пределах одной категории"""
+    return {
+        value: (valid, list(suggestions))
+        for value in set(values) if value
+        for valid, suggestions in (_check_kind(value, cat_id, threshold),)
+    }
+
+
 # ---------------------------------------------------------------------------
 # 📦  Формирование карточки
 # ---------------------------------------------------------------------------
 
-def create_card_data(product_data: dict, cat_id: int | None = None) -> dict:
+def determine_card_category(product_data: dict) -> int:
     """
-    Формирует данные для карточки:
+    Категория НК для карточки:
       1) ТН ВЭД + вид товара
       2) ТН ВЭД + название товара (для выбора правильной категории)
       3) только ТН ВЭД
       4) только вид
       5) дефолт
     """
+    cat_id = None
+    tnved = (product_data.get("tnved") or "").strip()
+    ptype = (product_data.get("product_type") or "").strip()
+    name = (product_data.get("name") or "").strip().lower()
+    
+    print(f"\n📦 Определяем категорию для: {product_data.get('name')}")
+    print(f"   ТН ВЭД: {tnved}, Вид товара: {ptype}")
+    
+    # Сначала пробуем ТН ВЭД + вид товара
+    if tnved and ptype:
+        cat_id = determine_category_by_product_type(tnved, ptype)
+        if cat_id:
+            print(f"   ✅ Найдена категория по виду товара: {cat_id}")
+    
+    # Если не нашли и есть название, пробуем подобрать по ключевым словам в названии
+    if not cat_id and tnved and name:
+        # Анализируем название для выбора категории
+        if "брюки" in name or "брюк" in name or "штаны" in name:
+            cat_id = determine_category_by_product_type(tnved, "брюки")
+        elif "платье" in name:
+            cat_id = determine_category_by_product_type(tnved, "платья")
+        elif "блузка" in name or "блуза" in name:
+            cat_id = determine_category_by_product_type(tnved, "блузки")
+        elif "юбка" in name:
+            cat_id = determine_category_by_product_type(tnved, "юбки")
+        elif "куртка" in name or "куртк" in name:
+            cat_id = determine_category_by_product_type(tnved, "куртки")
+        elif "джемпер" in name or "свитер" in name:
+            cat_id = determine_category_by_product_type(tnved, "джемперы")
+            
+    if not cat_id and tnved:
+        cat_id = determine_category_for_tnved(tnved)
+
+    if not cat_id and ptype:
+        cat_id = determine_category_by_product_type("", ptype)
+
+    if not cat_id:
+        cat_id = DEFAULT_NK_CATEGORY
+        print(f"   ➡️  Используем дефолтную категорию {cat_id}")
+
+    return cat_id
+
+
+def create_card_data(product_data: dict, cat_id: int | None = None) -> dict:
+    """Формирует данные для карточки (категория — determine_card_category, если не задана)"""
     if cat_id is None:
-        tnved = (product_data.get("tnved") or "").strip()
-        ptype = (product_data.get("product_type") or "").strip()
-        name = (product_data.get("name") or "").strip().lower()
-        
-        print(f"\n📦 Определяем категорию для: {product_data.get('name')}")
-        print(f"   ТН ВЭД: {tnved}, Вид товара: {ptype}")
-        
-        # Сначала пробуем ТН ВЭД + вид товара
-        if tnved and ptype:
-            cat_id = determine_category_by_product_type(tnved, ptype)
-            if cat_id:
-                print(f"   ✅ Найдена категория по виду товара: {cat_id}")
-        
-        # Если не нашли и есть название, пробуем подобрать по ключевым словам в названии
-        if not cat_id and tnved and name:
-            # Анализируем название для выбора категории
-            if "брюки" in name or "брюк" in name or "штаны" in name:
-                cat_id = determine_category_by_product_type(tnved, "брюки")
-            elif "платье" in name:
-                cat_id = determine_category_by_product_type(tnved, "платья")
-            elif "блузка" in name or "блуза" in name:
-                cat_id = determine_category_by_product_type(tnved, "блузки")
-            elif "юбка" in name:
-                cat_id = determine_category_by_product_type(tnved, "юбки")
-            elif "куртка" in name or "куртк" in name:
-                cat_id = determine_category_by_product_type(tnved, "куртки")
-            elif "джемпер" in name or "свитер" in name:
-                cat_id = determine_category_by_product_type(tnved, "джемперы")
-                
-        if not cat_id and tnved:
-            cat_id = determine_category_for_tnved(tnved)
-
-        if not cat_id and ptype:
-            cat_id = determine_category_by_product_type("", ptype)
-
-        if not cat_id:
-            cat_id = DEFAULT_NK_CATEGORY
-            print(f"   ➡️  Используем дефолтную категорию {cat_id}")
+        cat_id = determine_card_category(product_data)
 
     # Определяем, какой ТН ВЭД использовать в карточке
     tnved_for_card = product_data.get("tnved", "")
@@ -383,131 +475,244 @@ def determine_gender(product_data: dict) -> str | None:
 # 🚚  Отправка карточки и проверка статуса
 # ---------------------------------------------------------------------------
 
-def send_card_to_nk(card_data: dict) -> dict:
-    """POST /v3/feed"""
-    try:
-        resp = requests.post(
-            f"{BASE_URL}/v3/feed",
-            params={"apikey": NC_API_KEY},
-            headers={"Content-Type": "application/json; charset=utf-8"},
-            json=card_data,
-            timeout=30
-        )
-
-        if resp.status_code == 200:
-            data = resp.json()
-            print("\n✅  Карточка успешно отправлена")
-            result = data.get("result")
-
-            if not result:
-                print("❌ Не удалось получить feed_id. Ответ:", data)
-                return {"success": False, "error": "Отсутствует result в ответе", "raw": data}
-
-            feed_id = result.get("feed_id")
-            if not feed_id:
-                print("❌ В ответе нет feed_id. Ответ:", data)
-                return {"success": False, "error": "Отсутствует feed_id в ответе", "raw": data}
-
-            # Проверяем статус отправленной карточки
-            status_info = check_feed_status(feed_id)
-            return format_status_response(status_info)
+# Статусы фида, при которых карточка считается принятой НК
+FEED_ACCEPTED_STATUSES = {"Moderated", "Signed"}
 
-        else:
-            print(f"❌ Ошибка HTTP: {resp.status_code}")
-            return {"success": False, "error": f"HTTP {resp.status_code}: {resp.text}", "status_code": resp.status_code}
 
-    except Exception as e:
-        print(f"❌ Исключение при отправке карточки: {e}")
-        return {"success": False, "error": str(e)}
-            
+def is_feed_accepted(status_response: dict) -> bool:
+    """Фид принят: статус из FEED_ACCEPTED_STATUSES или уже выдан GTIN"""
+    if status_response.get("status") == "Rejected":
+        return False
+    return bool(status_response.get("gtin")) or status_response.get("status") in FEED_ACCEPTED_STATUSES
+
+
+def feed_needs_details(feed_info: dict) -> bool:
+    """Есть отклоненные товары — нужны детали ошибок"""
+    return bool(feed_info.get("success")) and (
+        feed_info.get("items_rejected", 0) > 0 or feed_info.get("status") == "Rejected"
+    )
+
+
+def attach_feed_details(feed_info: dict, feed_details: dict) -> dict:
+    if feed_details:
+        feed_info["detailed_errors"] = feed_details.get("errors", [])
+        feed_info["validation_errors"] = feed_details.get("validation_errors", [])
+        feed_info["items"] = feed_details.get("items", [])
+    return feed_info
 
 
-def check_feed_status(feed_id: str) -> dict:
-    """GET /v3/feed-status с расширенной информацией"""
-    try:
-        resp = requests.get(
-            f"{BASE_URL}/v3/feed-status",
-            params={"apikey": NC_API_KEY, "feed_id": feed_id},
-            timeout=30
-        )
+class NKClient:
+    """
+    Запросы к НК от имени одного аккаунта (apikey) через его планировщик:
+    отправка карточек, статусы и детали фидов, список карточек аккаунта.
+    """
+
+    def __init__(self, api_key: str = None, base_url: str = BASE_URL, scheduler=scheduler):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.scheduler = scheduler
+        # Какой способ получения деталей фида работает: None — еще не проверяли,
+        # "feed-details" — отдельный эндпоинт, "feeds" — только через список фидов.
+        # "feeds" запоминается только при 404/405 (эндпоинта нет), чтобы не
+        # пробовать его на каждом фиде; временные ошибки не запоминаются.
+        self._feed_details_source = None
+
+    def get_result(self, path: str, **params):
+        """GET-запрос к API нац. каталога: поле result ответа; ошибки — исключения"""
+        params.setdefault("apikey", self.api_key)
+        resp = self.scheduler.get('nk', f"{self.base_url}{path}", params=params, timeout=30)
+        resp.raise_for_status()
+        return response_json(resp).get("result")
+
+    def send_card_to_nk(self, card_data: dict) -> dict:
+        """POST /v3/feed"""
+        try:
+            resp = self.scheduler.post(
+                'nk', f"{self.base_url}/v3/feed",
+                params={"apikey": self.api_key},
+                headers={"Content-Type": "application/json; charset=utf-8"},
+                json=card_data,
+                timeout=30
+            )
+
+            if resp.status_code == 200:
+                data = response_json(resp)
+                print("\n✅  Карточка успешно отправлена")
+                result = data.get("result")
+
+                if not result:
+                    print("❌ Не удалось получить feed_id. Ответ:", data)
+                    return {"success": False, "error": "Отсутствует result в ответе", "raw": data}
+
+                feed_id = result.get("feed_id")
+                if not feed_id:
+                    print("❌ В ответе нет feed_id. Ответ:", data)
+                    return {"success": False, "error": "Отсутствует feed_id в ответе", "raw": data}
+
+                # Проверяем статус отправленной карточки
+                status_info = self.check_feed_status(feed_id)
+                response = format_status_response(status_info)
+                # Фид создан, даже если статус пока получить не удалось
+                response["success"] = True
+                response["feed_id"] = feed_id
+                return response
+
+            else:
+                print(f"❌ Ошибка HTTP: {resp.status_code}")
+                return {"success": False, "error": f"HTTP {resp.status_code}: {resp.text}", "status_code": resp.status_code}
+
+        except Exception as e:
+            print(f"❌ Исключение при отправке карточки: {e}")
+            return {"success": False, "error": str(e)}
+
+    def fetch_feed_status(self, feed_id: str) -> dict:
+        """GET /v3/feed-status: статус фида без запроса деталей ошибок"""
+        try:
+            resp = self.scheduler.get(
+                'nk', f"{self.base_url}/v3/feed-status",
+                params={"apikey": self.api_key, "feed_id": feed_id},
+                timeout=30
+            )
         
-        if resp.status_code == 200:
-            data = resp.json()
-            result = data.get("result", {})
-            
-            # Извлекаем детальную информацию
-            feed_info = {
-                "success": True,
-                "feed_id": feed_id,
-                "status": result.get("status", "Unknown"),
-                "created_at": result.get("created_at", ""),
-                "updated_at": result.get("updated_at", ""),
-                "items_count": result.get("items_count", 0),
-                "items_processed": result.get("items_processed", 0),
-                "items_accepted": result.get("items_accepted", 0),
-                "items_rejected": result.get("items_rejected", 0),
-                "errors": result.get("errors", []),
-                "warnings": result.get("warnings", []),
-                "raw_data": result  # Сохраняем полный ответ для отладки
-            }
+            if resp.status_code == 200:
+                data = response_json(resp)
+                result = data.get("result", {})
             
-            # Если есть отклоненные товары, пробуем получить детали
-            if feed_info["items_rejected"] > 0 or feed_info["status"] == "Rejected":
-                # Пробуем получить детальную информацию об ошибках
-                feed_details = get_feed_details(feed_id)
-                if feed_details:
-                    feed_info["detailed_errors"] = feed_details.get("errors", [])
-                    feed_info["validation_errors"] = feed_details.get("validation_errors", [])
-                    feed_info["items"] = feed_details.get("items", [])
+                # Извлекаем детальную информацию
+                feed_info = {
+                    "success": True,
+                    "feed_id": feed_id,
+                    "status": result.get("status", "Unknown"),
+                    "created_at": result.get("created_at", ""),
+                    "updated_at": result.get("updated_at", ""),
+                    "items_count": result.get("items_count", 0),
+                    "items_processed": result.get("items_processed", 0),
+                    "items_accepted": result.get("items_accepted", 0),
+                    "items_rejected": result.get("items_rejected", 0),
+                    "errors": result.get("errors", []),
+                    "warnings": result.get("warnings", []),
+                    "raw_data": result  # Сохраняем полный ответ для отладки
+                }
             
-            # Форматируем ошибки для удобного отображения
-            if feed_info["errors"]:
-                feed_info["formatted_errors"] = format_errors(feed_info["errors"])
+                # Форматируем ошибки для удобного отображения
+                if feed_info["errors"]:
+                    feed_info["formatted_errors"] = format_errors(feed_info["errors"])
             
-            return feed_info
+                return feed_info
             
-        return {
-            "success": False, 
-            "error": f"HTTP {resp.status_code}: {resp.text}", 
-            "status_code": resp.status_code
-        }
-        
-    except Exception as e:
-        return {"success": False, "error": str(e)}
-
-
-def get_feed_details(feed_id: str) -> dict:
-    """Получает детальную информацию о фиде"""
-    try:
-        # Пробуем получить детали через другой эндпоинт
-        resp = requests.get(
-            f"{BASE_URL}/v3/feed-details",
-            params={"apikey": NC_API_KEY, "feed_id": feed_id},
-            timeout=30
-        )
-        
-        if resp.status_code == 200:
-            return resp.json().get("result", {})
-    except:
-        pass
-    
-    # Альтернативный способ - через список фидов
-    try:
-        resp = requests.get(
-            f"{BASE_URL}/v3/feeds",
-            params={"apikey": NC_API_KEY, "feed_id": feed_id},
-            timeout=30
-        )
+            return {
+                "success": False, 
+                "error": f"HTTP {resp.status_code}: {resp.text}", 
+                "status_code": resp.status_code
+            }
         
-        if resp.status_code == 200:
-            feeds = resp.json().get("result", [])
-            for feed in feeds:
-                if str(feed.get("feed_id")) == str(feed_id):
-                    return feed
-    except:
-        pass
-    
-    return {}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def check_feed_status(self, feed_id: str) -> dict:
+        """GET /v3/feed-status с расширенной информацией"""
+        feed_info = self.fetch_feed_status(feed_id)
+        # Если есть отклоненные товары, пробуем получить детали
+        if feed_needs_details(feed_info):
+            attach_feed_details(feed_info, self.get_feed_details(feed_id))
+        return feed_info
+
+    def list_feeds(self) -> Dict[str, dict]:
+        """GET /v3/feeds: список фидов одним запросом, {feed_id: фид}"""
+        try:
+            resp = self.scheduler.get('nk', f"{self.base_url}/v3/feeds", params={"apikey": self.api_key}, timeout=30)
+            if resp.status_code == 200:
+                return {str(feed.get("feed_id")): feed for feed in response_json(resp).get("result") or []}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"❌  Ошибка получения списка фидов: {e}")
+        return {}
+
+    def get_feed_details_many(self, feed_ids: Iterable[str]) -> Dict[str, dict]:
+        """
+        Детали нескольких фидов. Пока работает /v3/feed-details — по запросу
+        на фид; иначе один список /v3/feeds на все фиды сразу.
+        """
+        pending = [str(feed_id) for feed_id in feed_ids]
+        details: Dict[str, dict] = {}
+
+        while pending and self._feed_details_source != "feeds":
+            feed_id = pending[0]
+            try:
+                resp = self.scheduler.get(
+                    'nk', f"{self.base_url}/v3/feed-details",
+                    params={"apikey": self.api_key, "feed_id": feed_id},
+                    timeout=30
+                )
+            except requests.exceptions.RequestException as e:
+                print(f"❌  Ошибка получения деталей фида {feed_id}: {e}")
+                break
+            if resp.status_code in (404, 405):
+                print(f"ℹ️  /v3/feed-details недоступен (HTTP {resp.status_code}), детали берутся из /v3/feeds")
+                self._feed_details_source = "feeds"
+                break
+            if resp.status_code != 200:
+                # Временная ошибка (5xx, 429 после повторов) — /v3/feeds только для этого вызова
+                print(f"⚠️  /v3/feed-details: HTTP {resp.status_code}, детали этого пакета берутся из /v3/feeds")
+                break
+            self._feed_details_source = "feed-details"
+            try:
+                details[feed_id] = response_json(resp).get("result", {}) or {}
+            except ValueError:
+                details[feed_id] = {}
+            pending.pop(0)
+
+        if pending:
+            listing = self.list_feeds()
+            for feed_id in pending:
+                details[feed_id] = listing.get(feed_id, {})
+        return details
+
+    def iter_product_list(self, page_size: int = 1000) -> Iterator[dict]:
+        """
+        GET /v4/product-list: все карточки аккаунта постранично (good_id, gtin,
+        good_name, good_status). Ошибка запроса — исключение, чтобы неполный
+        список не приняли за полный.
+        """
+        offset = 0
+        while True:
+            result = self.get_result("/v4/product-list", limit=page_size, offset=offset)
+            goods = result.get("goods", []) if isinstance(result, dict) else result or []
+            yield from goods
+            if len(goods) < page_size:
+                return
+            offset += page_size
+
+    def get_products(self, gtins: Iterable[str], batch_size: int = 25) -> List[dict]:
+        """GET /v3/product: карточки с атрибутами (good_attrs) по списку GTIN, пачками"""
+        gtins = list(gtins)
+        products: List[dict] = []
+        for start in range(0, len(gtins), batch_size):
+            products.extend(self.get_result("/v3/product", gtins=",".join(gtins[start:start + batch_size])) or [])
+        return products
+
+    def get_feed_details(self, feed_id: str) -> dict:
+        """Получает детальную информацию о фиде"""
+        return self.get_feed_details_many([feed_id]).get(str(feed_id), {})
+
+
+# Аккаунт из .env (NC_API_KEY); функции модуля ниже — его методы
+nk_client = NKClient(NC_API_KEY)
+reference_client = nk_client
+
+send_card_to_nk = nk_client.send_card_to_nk
+fetch_feed_status = nk_client.fetch_feed_status
+check_feed_status = nk_client.check_feed_status
+list_feeds = nk_client.list_feeds
+get_feed_details_many = nk_client.get_feed_details_many
+get_feed_details = nk_client.get_feed_details
+iter_product_list = nk_client.iter_product_list
+get_products = nk_client.get_products
+
+
+def use_reference_client(client: NKClient) -> None:
+    """Ключ, которым запрашиваются общие справочники НК (если NC_API_KEY не задан)"""
+    global reference_client
+    reference_client = client
 
 
 def format_errors(errors: list) -> list:
@@ -607,10 +812,75 @@ def format_status_response(feed_info: dict) -> dict:
 # 🧐  Поиск похожих значений (подсказки)
 # ---------------------------------------------------------------------------
 
+def _normalize_value(value: str) -> str:
+    """Верхний регистр, Ё→Е, разделители → пробел"""
+    value = value.upper().replace("Ё", "Е")
+    for sep in "-_/\\,.":
+        value = value.replace(sep, " ")
+    return " ".join(value.split())
+
+
+def _trigrams(text: str) -> FrozenSet[str]:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SuggestionIndex:
+    """
+    Триграммный индекс значений пресета.
+    Строится один раз на пресет; поиск перебирает только значения,
+    у которых есть общие триграммы с запросом.
+    """
+
+    def __init__(self, values: Iterable[str]):
+        self.values: List[str] = sorted(values)
+        self._normalized = [_normalize_value(v) for v in self.values]
+        self._grams = [_trigrams(v) for v in self._normalized]
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+        for idx, grams in enumerate(self._grams):
+            for gram in grams:
+                self._postings[gram].append(idx)
+
+    def score(self, query: str, idx: int, common: int, query_grams: FrozenSet[str]) -> float:
+        """Коэффициент Дайса по триграммам; вхождение подстроки оценивается долей длины"""
+        score = 2 * common / (len(query_grams) + len(self._grams[idx]))
+        candidate = self._normalized[idx]
+        if query in candidate or candidate in query:
+            shorter, longer = sorted((len(query), len(candidate)))
+            score = max(score, shorter / longer if longer else 0.0)
+        return score
+
+    def similar(self, value: str, threshold: float = 0.6, limit: int = 5) -> List[str]:
+        query = _normalize_value(value)
+        if not query:
+            return []
+        query_grams = _trigrams(query)
+
+        common: Dict[int, int] = defaultdict(int)
+        for gram in query_grams:
+            for idx in self._postings.get(gram, ()):
+                common[idx] += 1
+
+        scored = []
+        for idx, count in common.items():
+            score = self.score(query, idx, count, query_grams)
+            if score >= threshold:
+                scored.append((-score, self.values[idx]))
+        scored.sort()
+        return [v for _, v in scored[:limit]]
+
+
+@lru_cache(maxsize=64)
+def get_suggestion_index(preset: FrozenSet[str]) -> SuggestionIndex:
+    """Индекс подсказок для пресета (кешируется по самому пресету)"""
+    return SuggestionIndex(preset)
+
+
 def find_similar_values(value: str, preset: Set[str], threshold: float = 0.6) -> List[str]:
+    """До 5 значений пресета, похожих на value не меньше чем на threshold (0..1)"""
     if not value or not preset:
         return []
 
-    val_low = value.lower()
-    similars = [p for p in preset if val_low in p.lower() or p.lower() in val_low]
-    return sorted(similars)[:5]  # максимум 5 вариантов
+    if not isinstance(preset, frozenset):
+        preset = frozenset(preset)
+    return get_suggestion_index(preset).similar(value, threshold, limit=5)
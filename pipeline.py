@@ -0,0 +1,503 @@
+"""
+Пакетный конвейер для ночных запусков: МойСклад → НК → GTIN в МойСклад
+
+    python pipeline.py                                        # новый запуск
+    python pipeline.py --dry-run                              # только карточки в cards.ndjson
+    python pipeline.py --resume pipeline_runs/20261018-020000 # продолжить прерванный запуск
+    python pipeline.py --concurrency send=8,categorize=8 --limit 500 --quiet
+    python pipeline.py --tenant acme                          # аккаунт из TENANTS_FILE
+
+Этапы: fetch (ассортимент и отбор process_products_and_variants) → extract →
+categorize → validate → build → send → poll → write_back.
+
+Каждый этап пишет результат построчно в <запуск>/<этап>.ndjson (карточки —
+в cards.ndjson) и отмечается в state.json, когда завершен без ошибок.
+--resume пропускает завершенные этапы, читая их результат из файла, а
+прерванный или завершенный с ошибками поэлементный этап продолжает с первого
+необработанного товара и повторяет товары с ошибкой; следующие за ним этапы
+тоже выполняются заново и дообрабатывают только новые результаты. Повторная отправка не создает новых фидов — от нее
+защищает журнал отправок. Параметры запуска (--dry-run, --limit, --until,
+--tenant) при --resume берутся из state.json.
+
+В конце печатается сводка по этапам: строк на входе и выходе, ошибки,
+время и скорость; она же сохраняется в summary.json. Код возврата 1 —
+были ошибки.
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime
+
+import requests
+
+# app подключает клиентов МойСклад к аккаунтам; фоновых потоков при импорте не
+# запускает (очередь задач стартует только с первым запросом веб-приложения)
+from app import tenants
+from card_cache import card_cache, card_content_hash
+from card_submission import submit_card
+from card_validator import validate_card
+from config import PIPELINE, PREFLIGHT_VALIDATION, RECONCILE
+from json_backend import dumps, loads
+from nk_api import create_card_data, determine_card_category, format_status_response
+from send_ledger import FINAL_STATUSES, STATUS_ACCEPTED, ledger_status
+from tenants import use_tenant
+
+STAGES = ("fetch", "extract", "categorize", "validate", "build", "send", "poll", "write_back")
+OUTPUT_FILES = {"build": "cards.ndjson"}
+PROGRESS_INTERVAL = 5.0
+
+
+def log(message: str) -> None:
+    """Ход конвейера — в stderr (stdout этапов можно заглушить --quiet)"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def _stored_item(item: dict) -> dict:
+    """Строка для контрольной точки: вместо ссылки на товар — его id"""
+    stored = {key: value for key, value in item.items() if key not in ("_parent_product", "_attr_values")}
+    if "_parent_product" in item:
+        stored["_parent_id"] = item["_parent_product"].get("id")
+    return stored
+
+
+def _parallel(func, item_ids, workers: int):
+    """Результаты func по порядку item_ids; исключение превращается в запись с error"""
+    def safe(item_id):
+        try:
+            return func(item_id)
+        except Exception as e:
+            return {"id": item_id, "error": str(e)}
+
+    if workers <= 1:
+        for item_id in item_ids:
+            yield safe(item_id)
+        return
+    # Потоки пула наследуют текущий аккаунт (ContextVar) вызывающего
+    context = copy_context()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(lambda item_id: context.copy().run(safe, item_id), item_ids)
+
+
+class RunState:
+    """Каталог запуска: state.json и построчные результаты этапов"""
+
+    def __init__(self, path: str, options: dict = None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._state_file = os.path.join(path, "state.json")
+        if os.path.exists(self._state_file):
+            with open(self._state_file, "rb") as f:
+                self.state = loads(f.read())
+        else:
+            self.state = {"created": datetime.now().isoformat(timespec="seconds"),
+                          "options": options or {}, "stages": {}}
+            self._save()
+
+    @property
+    def options(self) -> dict:
+        return self.state["options"]
+
+    def _save(self) -> None:
+        tmp = f"{self._state_file}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(dumps(self.state))
+        os.replace(tmp, self._state_file)
+
+    def done(self, stage: str) -> bool:
+        return self.state["stages"].get(stage, {}).get("done", False)
+
+    def stats(self, stage: str) -> dict:
+        return self.state["stages"].get(stage, {})
+
+    def mark(self, stage: str, stats: dict, done: bool) -> None:
+        self.state["stages"][stage] = dict(stats, done=done)
+        self._save()
+
+    def file(self, stage: str) -> str:
+        return os.path.join(self.path, OUTPUT_FILES.get(stage, f"{stage}.ndjson"))
+
+    def read(self, stage: str) -> list:
+        path = self.file(stage)
+        if not os.path.exists(path):
+            return []
+        records = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(loads(line))
+                except ValueError:
+                    break  # строка, оборванная аварийной остановкой
+        return records
+
+    @contextlib.contextmanager
+    def writer(self, stage: str, reset: bool = False):
+        path = self.file(stage)
+        if reset and os.path.exists(path):
+            os.remove(path)
+        elif os.path.exists(path):
+            # Обрезаем недописанную строку, чтобы дозапись начиналась с новой
+            with open(path, "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(path, "ab") as f:
+            def write(record: dict) -> None:
+                f.write(dumps(record) + b"\n")
+                f.flush()
+            yield write
+
+
+class Pipeline:
+    def __init__(self, run: RunState, concurrency: dict, tenant):
+        self.tenant = tenant
+        self.run = run
+        self.concurrency = concurrency
+        self.items = {}        # id -> строка МойСклад (товар, затем его варианты)
+        self.data = {}         # id -> поля товара
+        self.categories = {}   # id -> категория НК
+        self.cards = {}        # id -> {'card_hash', 'card'}
+        self.sent = {}         # id -> результат отправки
+        self.stats = {}
+
+    # ------------------------------------------------------------------
+    # Общее
+    # ------------------------------------------------------------------
+
+    def execute(self, until: str) -> dict:
+        # Поэлементный этап с ошибками не завершен: --resume повторяет его упавшие
+        # товары, а следующие этапы — тоже (дообрабатывают новые результаты)
+        rerun = False
+        for stage in STAGES[:STAGES.index(until) + 1]:
+            if self.run.done(stage) and not rerun:
+                getattr(self, f"_restore_{stage}")(self.run.read(stage))
+                self.stats[stage] = dict(self.run.stats(stage), resumed=True)
+                log(f"⏭️  {stage}: завершен ранее ({self.stats[stage].get('out', 0)} строк)")
+                continue
+            rerun = True
+            log(f"▶️  {stage}")
+            started = time.monotonic()
+            stats, done = getattr(self, f"_stage_{stage}")()
+            stats["seconds"] = round(time.monotonic() - started + self.run.stats(stage).get("seconds", 0), 3)
+            self.run.mark(stage, stats, done)
+            self.stats[stage] = stats
+            log(f"✅ {stage}: {stats.get('out', 0)} из {stats.get('in', 0)}, ошибок {stats.get('errors', 0)}, "
+                f"{stats['seconds']:.1f} с" + ("" if done else " — этап не завершен"))
+        return self.stats
+
+    def _per_item(self, stage: str, item_ids: list, func, store) -> dict:
+        """
+        Поэлементный этап: результаты пишутся по мере готовности; при
+        продолжении пропускаются товары, уже обработанные без ошибки.
+        """
+        latest = {}
+        for record in self.run.read(stage):
+            latest[record["id"]] = record
+            store(record)
+        todo = [item_id for item_id in item_ids if item_id not in latest or latest[item_id].get("error")]
+        resumed = len(item_ids) - len(todo)
+
+        last_log = time.monotonic()
+        with self.run.writer(stage) as write:
+            for count, record in enumerate(_parallel(func, todo, self.concurrency.get(stage, 1)), 1):
+                write(record)
+                store(record)
+                latest[record["id"]] = record
+                if time.monotonic() - last_log >= PROGRESS_INTERVAL:
+                    last_log = time.monotonic()
+                    log(f"   {stage}: {count + resumed}/{len(item_ids)}")
+
+        records = [latest[item_id] for item_id in item_ids if item_id in latest]
+        errors = sum(1 for record in records if record.get("error"))
+        return {"in": len(item_ids), "out": len(records) - errors, "errors": errors, "resumed": resumed}
+
+    # ------------------------------------------------------------------
+    # fetch: ассортимент и отбор товаров с флажком
+    # ------------------------------------------------------------------
+
+    def _stage_fetch(self):
+        if not self.tenant.api.test_connection():
+            raise RuntimeError("Не удалось подключиться к МойСклад")
+        load_stats = {}
+        items = self.tenant.api.process_products_and_variants(self.tenant.api.iter_assortment(load_stats))
+        if load_stats.get("error"):
+            raise RuntimeError(f"Загрузка ассортимента оборвалась: {load_stats['error']}")
+        if self.run.options.get("limit"):
+            items = items[:self.run.options["limit"]]
+        with self.run.writer("fetch", reset=True) as write:
+            for item in items:
+                write(_stored_item(item))
+        self.items = {item.get("id"): item for item in items}
+        return {"in": load_stats.get("total_items", 0), "out": len(items), "errors": 0}, True
+
+    def _restore_fetch(self, records):
+        self.items = {}
+        for item in records:
+            parent = self.items.get(item.pop("_parent_id", None))
+            if parent is not None:
+                item["_parent_product"] = parent
+            self.items[item.get("id")] = item
+
+    # ------------------------------------------------------------------
+    # extract, categorize, validate
+    # ------------------------------------------------------------------
+
+    def _stage_extract(self):
+        with self.run.writer("extract", reset=True) as write:
+            for item_id, item in self.items.items():
+                self.data[item_id] = self.tenant.api._extract_item_fields(item)
+                write({"id": item_id, "data": self.data[item_id]})
+        return {"in": len(self.items), "out": len(self.data), "errors": 0}, True
+
+    def _restore_extract(self, records):
+        self.data = {record["id"]: record["data"] for record in records}
+
+    def _categorize(self, item_id):
+        return {"id": item_id, "cat_id": determine_card_category(self.data[item_id])}
+
+    def _stage_categorize(self):
+        stats = self._per_item("categorize", list(self.data), self._categorize, self._restore_category)
+        return stats, not stats["errors"]
+
+    def _restore_category(self, record):
+        if not record.get("error"):
+            self.categories[record["id"]] = record["cat_id"]
+
+    def _restore_categorize(self, records):
+        for record in records:
+            self._restore_category(record)
+
+    def _stage_validate(self):
+        item_ids = list(self.data)
+        batch_size = PIPELINE["validate_batch"]
+        invalid = 0
+        with self.run.writer("validate", reset=True) as write:
+            for start in range(0, len(item_ids), batch_size):
+                batch = item_ids[start:start + batch_size]
+                for item_id, row in zip(batch, self.tenant.api.validate_items_data([self.data[i] for i in batch])):
+                    if (row["color"] and not row["color_valid"]) or \
+                            (row["product_type"] and not row["product_type_valid"]):
+                        invalid += 1
+                    write({"id": item_id, "data": row})
+        # Недопустимые цвета и виды — предупреждение: карточку проверит build и отклонит НК
+        return {"in": len(item_ids), "out": len(item_ids), "errors": 0, "invalid_values": invalid}, True
+
+    def _restore_validate(self, records):
+        self._restore_extract(records)
+
+    # ------------------------------------------------------------------
+    # build: карточки НК (при --dry-run — результат запуска)
+    # ------------------------------------------------------------------
+
+    def _build(self, item_id):
+        data = self.data[item_id]
+        if not data.get("name"):
+            return {"id": item_id, "error": "Отсутствует наименование товара"}
+        if not data.get("tnved"):
+            return {"id": item_id, "name": data["name"], "error": "Отсутствует ТН ВЭД"}
+        card = create_card_data(data, self.categories.get(item_id))
+        card_hash = card_content_hash(data)
+        card_cache.put(card_hash, card)
+        record = {"id": item_id, "name": data["name"], "card_hash": card_hash, "card": card}
+        if PREFLIGHT_VALIDATION:
+            check = validate_card(card)
+            if not check["valid"]:
+                record["error"] = "; ".join(
+                    f"{error.get('attr_name') or error['field']}: {error['message']}" for error in check["errors"]
+                )
+        return record
+
+    def _stage_build(self):
+        stats = self._per_item("build", list(self.data), self._build, self._restore_card)
+        return stats, not stats["errors"]
+
+    def _restore_card(self, record):
+        if record.get("error"):
+            self.cards.pop(record["id"], None)
+        else:
+            self.cards[record["id"]] = record
+
+    def _restore_build(self, records):
+        for record in records:
+            self._restore_card(record)
+
+    # ------------------------------------------------------------------
+    # send, poll, write_back
+    # ------------------------------------------------------------------
+
+    def _send(self, item_id):
+        card = self.cards[item_id]
+        submitted = submit_card(self.tenant, self.items[item_id], self.data[item_id], card["card_hash"], card["card"])
+        record = {"id": item_id, "outcome": submitted["outcome"],
+                  "feed_id": str(submitted["feed_id"]) if submitted.get("feed_id") else None}
+        if submitted["outcome"] == "failed":
+            record["error"] = submitted["error"]
+        elif submitted["outcome"] == "invalid":
+            record["error"] = "Карточка не прошла проверку по схеме категории НК"
+        elif submitted["outcome"] == "in_progress":
+            record["error"] = "Карточка уже отправляется другим процессом"
+        return record
+
+    def _stage_send(self):
+        if RECONCILE["skip_carded"]:
+            try:
+                self.tenant.nk_index.ensure()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                log(f"⚠️  Карточки НК не загружены ({e}), отправка без сверки")
+        stats = self._per_item("send", list(self.cards), self._send, self._restore_sent)
+        stats["outcomes"] = dict(Counter(record["outcome"] for record in self.sent.values() if "outcome" in record))
+        return stats, not stats["errors"]
+
+    def _restore_sent(self, record):
+        self.sent[record["id"]] = record
+
+    def _restore_send(self, records):
+        for record in records:
+            self._restore_sent(record)
+
+    def _stage_poll(self):
+        feeds = defaultdict(list)
+        for record in self.sent.values():
+            if record.get("outcome") in ("sent", "resumed") and record.get("feed_id"):
+                feeds[record["feed_id"]].append(record["id"])
+        finished = {record["feed_id"] for record in self.run.read("poll")}
+        pending = set(feeds) - finished
+
+        deadline = time.monotonic() + PIPELINE["poll_timeout"]
+        with self.run.writer("poll") as write:
+            while pending and time.monotonic() < deadline:
+                for feed_id, feed_info in self.tenant.feed_status.lookup_many(pending).items():
+                    if not feed_info.get("success"):
+                        continue
+                    formatted = format_status_response(feed_info)
+                    status = ledger_status(formatted)
+                    self.tenant.ledger.update_feed(feed_id, status, formatted.get("gtin"))
+                    if status in FINAL_STATUSES:
+                        pending.discard(feed_id)
+                        write({"feed_id": feed_id, "item_ids": feeds[feed_id], "status": status,
+                               "gtin": formatted.get("gtin")})
+                if pending:
+                    log(f"   poll: в обработке {len(pending)} из {len(feeds)} фидов")
+                    time.sleep(PIPELINE["poll_interval"])
+
+        records = self.run.read("poll")
+        accepted = sum(1 for record in records if record["status"] == STATUS_ACCEPTED)
+        stats = {"in": len(feeds), "out": accepted, "errors": len(records) - accepted, "pending": len(pending)}
+        return stats, not pending
+
+    def _restore_poll(self, records):
+        pass
+
+    def _write_back(self, item_id):
+        job = self._gtin_jobs[item_id]
+        result = self.tenant.api.update_product_gtin(item_id, job["gtin"], job["item_type"] == "variant")
+        if not result.get("success"):
+            return {"id": item_id, "gtin": job["gtin"], "error": result.get("error") or "GTIN не записан"}
+        self.tenant.ledger.mark_gtin_written(item_id, job["gtin"])
+        return {"id": item_id, "gtin": job["gtin"]}
+
+    def _stage_write_back(self):
+        self._gtin_jobs = {job["item_id"]: job for job in self.tenant.ledger.gtin_pending() if job["item_id"] in self.items}
+        stats = self._per_item("write_back", list(self._gtin_jobs), self._write_back, lambda record: None)
+        # Пока не все фиды обработаны, GTIN могут еще появиться
+        return stats, self.run.done("poll") and not stats["errors"]
+
+    def _restore_write_back(self, records):
+        pass
+
+    # ------------------------------------------------------------------
+    # Сводка
+    # ------------------------------------------------------------------
+
+    def summary(self) -> str:
+        lines = [
+            "| этап | вход | выход | ошибки | с | строк/с | примечание |",
+            "|---|---:|---:|---:|---:|---:|---|",
+        ]
+        for stage, stats in self.stats.items():
+            seconds = stats.get("seconds", 0)
+            rate = f"{stats.get('out', 0) / seconds:.1f}" if seconds else "—"
+            notes = []
+            if stats.get("resumed") is True:
+                notes.append("из контрольной точки")
+            elif stats.get("resumed"):
+                notes.append(f"продолжен с {stats['resumed']}")
+            if stats.get("invalid_values"):
+                notes.append(f"недопустимых цветов/видов: {stats['invalid_values']}")
+            if stats.get("outcomes"):
+                notes.append(", ".join(f"{outcome}: {count}" for outcome, count in sorted(stats["outcomes"].items())))
+            if stats.get("pending"):
+                notes.append(f"в обработке: {stats['pending']}")
+            if not self.run.done(stage):
+                notes.append("не завершен")
+            lines.append(f"| {stage} | {stats.get('in', 0)} | {stats.get('out', 0)} | {stats.get('errors', 0)} "
+                         f"| {seconds:.1f} | {rate} | {'; '.join(notes)} |")
+        return "\n".join(lines)
+
+
+def parse_concurrency(value: str) -> dict:
+    concurrency = dict(PIPELINE["concurrency"])
+    for part in filter(None, (value or "").split(",")):
+        stage, _, workers = part.partition("=")
+        if stage not in STAGES or not workers.isdigit() or int(workers) < 1:
+            raise argparse.ArgumentTypeError(f"Неверное значение: {part} (ожидается этап=потоков)")
+        concurrency[stage] = int(workers)
+    return concurrency
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resume", metavar="RUN_DIR", help="продолжить запуск из каталога контрольных точек")
+    parser.add_argument("--run-dir", help=f"каталог нового запуска (по умолчанию {PIPELINE['dir']}/<время>)")
+    parser.add_argument("--dry-run", action="store_true", help="до карточек включительно, без отправки в НК")
+    parser.add_argument("--until", choices=STAGES, default=STAGES[-1], help="последний выполняемый этап")
+    parser.add_argument("--limit", type=int, help="обработать только первые N строк каталога")
+    parser.add_argument("--concurrency", type=parse_concurrency, default=dict(PIPELINE["concurrency"]),
+                        help="потоков на этап, например send=8,categorize=4")
+    parser.add_argument("--quiet", action="store_true", help="не выводить подробный лог этапов")
+    parser.add_argument("--tenant", help=f"аккаунт из TENANTS_FILE (по умолчанию {tenants.default.name})")
+    args = parser.parse_args(argv)
+
+    if args.resume:
+        if not os.path.exists(os.path.join(args.resume, "state.json")):
+            parser.error(f"В {args.resume} нет state.json")
+        run = RunState(args.resume)
+    else:
+        path = args.run_dir or os.path.join(PIPELINE["dir"], datetime.now().strftime("%Y%m%d-%H%M%S"))
+        until = "build" if args.dry_run else args.until
+        run = RunState(path, {"dry_run": args.dry_run, "until": until, "limit": args.limit,
+                              "tenant": args.tenant or tenants.default.name})
+    try:
+        tenant = tenants.get(run.options.get("tenant"))
+    except LookupError as e:
+        parser.error(f"{e} (доступны: {', '.join(tenants.names())})")
+    log(f"📁 Запуск: {run.path} (аккаунт {tenant.name})")
+
+    pipeline = Pipeline(run, args.concurrency, tenant)
+    output = open(os.devnull, "w") if args.quiet else sys.stdout
+    try:
+        with contextlib.redirect_stdout(output), use_tenant(tenant):
+            pipeline.execute(run.options["until"])
+    except Exception as e:
+        log(f"❌ Конвейер остановлен: {e}")
+        log(f"   Продолжить: python pipeline.py --resume {run.path}")
+        log(pipeline.summary())
+        return 2
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    summary = pipeline.summary()
+    with open(os.path.join(run.path, "summary.json"), "wb") as f:
+        f.write(dumps({"run": run.path, "stages": pipeline.stats}))
+    log(summary)
+    if run.options.get("dry_run"):
+        log(f"📝 Карточки: {run.file('build')}")
+    return 1 if any(stats.get("errors") for stats in pipeline.stats.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+"""
+Профилирование отдельных запросов по требованию
+
+Профилировщик выборочный: фоновый поток каждые PROFILING['interval'] секунд
+снимает стек потока, обрабатывающего запрос (sys._current_frames), — ни
+трассировки вызовов, ни замедления самого кода. Запросы к МойСклад и НК,
+идущие через планировщик (rate_limiter), добавляются в стек отдельным
+кадром «[moysklad GET /entity/assortment]» (или «… очередь», пока запрос
+ждет лимита) и перечисляются в сводке профиля со временем и статусом.
+
+Профилируется запрос:
+  - с заголовком PROFILING['header'] (X-Profile), равным ADMIN_TOKEN;
+  - любой, если PROFILE_REQUESTS=1 (PROFILING['enabled']).
+
+Профиль сохраняется в PROFILING['directory'] тремя файлами: сводка .json,
+свернутые стеки .collapsed (flamegraph.pl, speedscope, inferno) и
+.speedscope.json (https://www.speedscope.app). Последние профили —
+на /admin/profiles.
+
+Если профилирование выключено и ADMIN_TOKEN не задан, install_profiling
+ничего не устанавливает: ни обертки WSGI, ни наблюдателя в планировщике.
+"""
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+from werkzeug.wsgi import ClosingIterator
+
+from config import PROFILING
+
+load_dotenv()
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Профиль потока, который сейчас профилируется: thread id -> RequestProfile
+_active = {}
+
+
+def profiling_available() -> bool:
+    return bool(PROFILING["enabled"] or ADMIN_TOKEN)
+
+
+def verify_admin_token(token: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(str(token), ADMIN_TOKEN)
+
+
+def admin_allowed(token: Optional[str], remote_addr: Optional[str]) -> bool:
+    """Доступ к /admin/*: по ADMIN_TOKEN, а если он не задан — только локально"""
+    if ADMIN_TOKEN:
+        return verify_admin_token(token)
+    return remote_addr in ("127.0.0.1", "::1")
+
+
+def _frame_name(code) -> str:
+    return getattr(code, "co_qualname", code.co_name)
+
+
+class UpstreamCall:
+    """Один запрос к внешнему сервису внутри профилируемого запроса"""
+
+    def __init__(self, profile: "RequestProfile", upstream: str, method: str, url: str):
+        self.profile = profile
+        self.upstream = upstream
+        self.method = method
+        self.path = urlsplit(url).path
+        self.started = time.perf_counter()
+        self.waited = 0.0
+        self.attempts = 0
+        profile.label = f"[{upstream} {method} {self.path} очередь]"
+
+    def sent(self, waited: float) -> None:
+        """Лимит пройден, запрос уходит (для повторов после 429 — снова)"""
+        self.waited += waited
+        self.attempts += 1
+        self.profile.label = f"[{self.upstream} {self.method} {self.path}]"
+
+    def finish(self, status=None, error: Optional[BaseException] = None) -> None:
+        profile = self.profile
+        profile.label = None
+        profile.upstream_calls.append({
+            "upstream": self.upstream,
+            "method": self.method,
+            "path": self.path,
+            "status": status,
+            "error": repr(error) if error is not None else None,
+            "attempts": self.attempts,
+            "wait": round(self.waited, 4),
+            "duration": round(time.perf_counter() - self.started, 4),
+            "offset": round(self.started - profile.started, 4),
+        })
+
+
+class RequestProfile:
+    """Выборка стеков одного потока на время одного запроса"""
+
+    def __init__(self, method: str, path: str, interval: float = PROFILING["interval"],
+                 max_samples: int = PROFILING["max_samples"]):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.max_samples = max_samples
+        self.thread_id = threading.get_ident()
+        self.samples: List[tuple] = []     # (стек от корня к листу, вес в секундах)
+        self.upstream_calls: List[dict] = []
+        self.label: Optional[str] = None   # текущий запрос к upstream
+        self.status = None
+        self.started = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name=f"profiler-{self.id}", daemon=True)
+
+    def start(self) -> "RequestProfile":
+        self.started = time.perf_counter()
+        _active[self.thread_id] = self
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.duration = time.perf_counter() - self.started
+        _active.pop(self.thread_id, None)
+        self._thread.join()
+
+    def _stack(self, frame) -> tuple:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((_frame_name(code), code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        label = self.label
+        if label:
+            stack.append((label, "", 0))
+        return tuple(stack)
+
+    def _sample(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is not None and len(self.samples) < self.max_samples:
+                self.samples.append((self._stack(frame), now - last))
+            last = now
+
+    # --- форматы -----------------------------------------------------------
+
+    def collapsed(self) -> str:
+        """Свернутые стеки: «кадр;кадр;кадр микросекунды» на строку"""
+        totals = Counter()
+        for stack, weight in self.samples:
+            key = ";".join(
+                f"{name} ({Path(filename).name}:{line})" if filename else name
+                for name, filename, line in stack
+            )
+            totals[key] += weight
+        return "".join(f"{key} {round(weight * 1e6)}\n" for key, weight in totals.most_common())
+
+    def speedscope(self) -> dict:
+        frames = []
+        index = {}
+        samples = []
+        weights = []
+        for stack, weight in self.samples:
+            sample = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    name, filename, line = frame
+                    frames.append({"name": name, "file": filename, "line": line} if filename else {"name": name})
+                sample.append(index[frame])
+            samples.append(sample)
+            weights.append(weight)
+        title = f"{self.method} {self.path}"
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": title,
+            "exporter": "nk-profiling",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": title,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+    def summary(self) -> dict:
+        upstream_time = sum(call["duration"] for call in self.upstream_calls)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration": round(self.duration, 4),
+            "interval": self.interval,
+            "samples": len(self.samples),
+            "upstream_time": round(upstream_time, 4),
+            "upstream_calls": self.upstream_calls,
+        }
+
+
+class ProfileStore:
+    """Каталог с профилями; хранит не больше keep последних"""
+
+    def __init__(self, directory: str = PROFILING["directory"], keep: int = PROFILING["keep"]):
+        self.directory = Path(directory)
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def save(self, profile: RequestProfile) -> dict:
+        summary = profile.summary()
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            base = self.directory / profile.id
+            Path(f"{base}.collapsed").write_text(profile.collapsed(), encoding="utf-8")
+            Path(f"{base}.speedscope.json").write_text(json.dumps(profile.speedscope()), encoding="utf-8")
+            Path(f"{base}.json").write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+            self._prune()
+        print(f"🔬 Профиль {profile.id}: {profile.method} {profile.path} — {profile.duration * 1000:.0f} мс, "
+              f"{len(profile.samples)} выборок, {len(profile.upstream_calls)} запросов к API")
+        return summary
+
+    def _summaries(self) -> List[Path]:
+        """Сводки профилей от старых к новым (id начинается с времени)"""
+        return sorted(
+            (p for p in self.directory.glob("*.json") if not p.name.endswith(".speedscope.json")),
+            key=lambda p: p.name,
+        )
+
+    def _prune(self) -> None:
+        summaries = self._summaries()
+        for stale in summaries[:-self.keep] if self.keep else []:
+            profile_id = stale.name[:-len(".json")]
+            for suffix in (".json", ".collapsed", ".speedscope.json"):
+                (self.directory / f"{profile_id}{suffix}").unlink(missing_ok=True)
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        if not self.directory.exists():
+            return []
+        result = []
+        for path in self._summaries()[::-1][:limit]:
+            try:
+                summary = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            summary["upstream_calls"] = len(summary.get("upstream_calls", []))
+            result.append(summary)
+        return result
+
+    def path(self, profile_id: str, kind: str) -> Optional[Path]:
+        """Файл профиля: kind — json, collapsed или speedscope"""
+        suffix = {"json": ".json", "collapsed": ".collapsed", "speedscope": ".speedscope.json"}.get(kind)
+        if not suffix or Path(profile_id).name != profile_id:
+            return None
+        path = self.directory / f"{profile_id}{suffix}"
+        return path if path.exists() else None
+
+
+profile_store = ProfileStore()
+
+
+def observe_upstream_call(upstream: str, method: str, url: str) -> Optional[UpstreamCall]:
+    """Наблюдатель планировщика: запись вызова, если поток профилируется"""
+    profile = _active.get(threading.get_ident())
+    if profile is None:
+        return None
+    return UpstreamCall(profile, upstream, method, url)
+
+
+class ProfilingMiddleware:
+    """WSGI-обертка: профилирует запрос целиком, включая отдачу тела ответа"""
+
+    def __init__(self, wsgi_app, store: ProfileStore = profile_store, settings: dict = PROFILING):
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.settings = settings
+        self.header_key = "HTTP_" + settings["header"].upper().replace("-", "_")
+
+    def _wanted(self, environ) -> bool:
+        if environ.get("PATH_INFO", "").startswith("/admin/profiles"):
+            return False
+        if self.settings["enabled"]:
+            return True
+        return verify_admin_token(environ.get(self.header_key))
+
+    def __call__(self, environ, start_response):
+        if not self._wanted(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profile = RequestProfile(environ.get("REQUEST_METHOD", ""), environ.get("PATH_INFO", "")).start()
+
+        def profiled_start_response(status, headers, exc_info=None):
+            profile.status = int(status.split(" ", 1)[0])
+            headers = list(headers) + [("X-Profile-Id", profile.id)]
+            return start_response(status, headers, exc_info)
+
+        def finish():
+            profile.stop()
+            try:
+                self.store.save(profile)
+            except OSError as e:
+                print(f"❌ Не удалось сохранить профиль {profile.id}: {e}")
+
+        try:
+            body = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(body, [finish])
+
+
+def install_profiling(app, scheduler) -> bool:
+    """Подключает профилирование к Flask-приложению, если оно разрешено"""
+    if not profiling_available():
+        return False
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+    scheduler.observer = observe_upstream_call
+    return True
@@ -0,0 +1,261 @@
+"""
+Поток событий об отправках в НК для страницы таблицы (SSE / long-poll)
+
+EventHub хранит последние события с возрастающими номерами: подписчик
+/events получает все события после Last-Event-ID и ждет новые, а
+/events/poll отдает то же самое обычным JSON-запросом.
+
+ProgressPoller — серверный опрос вместо опроса из браузера по строкам:
+пока в журнале есть фиды в обработке (или GTIN, еще не записанные в
+МойСклад) либо открыт хотя бы один поток событий, он раз в
+PROGRESS['poll_interval'] секунд пакетно проверяет статусы
+(feed_status_service, приоритет опроса в планировщике) и публикует:
+  - sent          — карточка отправлена (из /send_to_nk);
+  - feed_status   — статус фида или GTIN изменился;
+  - gtin_written  — результат записи GTIN в МойСклад;
+  - job           — прогресс фоновой задачи (job_queue, из app.py).
+
+Фид, статус которого не меняется, опрашивается все реже (до
+PROGRESS['max_poll_interval']), а через PROGRESS['feed_timeout'] — больше
+не опрашивается. Неудачная запись GTIN повторяется с удвоением паузы не
+больше PROGRESS['write_attempts'] раз; об одной и той же ошибке записи
+сообщается один раз, о последней попытке — с final=True.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+from config import PROGRESS
+from feed_status import FeedStatusService, feed_status_service
+from nk_api import format_status_response
+from rate_limiter import PRIORITY_POLLING, request_priority
+from send_ledger import FINAL_STATUSES, SendLedger, send_ledger, ledger_status
+
+EVENT_SENT = "sent"
+EVENT_FEED_STATUS = "feed_status"
+EVENT_GTIN_WRITTEN = "gtin_written"
+EVENT_JOB = "job"
+# Подписчик отстал больше, чем хранит буфер: нужно заново взять снимок
+EVENT_RESYNC = "resync"
+
+
+class EventHub:
+    def __init__(self, max_events: int = PROGRESS["max_events"]):
+        self._events = deque(maxlen=max_events)   # (id, тип, данные)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self.subscribers = 0
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event_type: str, data: dict) -> int:
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, event_type, data))
+            self._cond.notify_all()
+            return self._last_id
+
+    def _since(self, after_id: int) -> List[Tuple[int, str, dict]]:
+        if self._events and after_id < self._events[0][0] - 1:
+            return [(self._last_id, EVENT_RESYNC, {"last_id": self._last_id})]
+        return [event for event in self._events if event[0] > after_id]
+
+    def wait(self, after_id: int, timeout: float) -> List[Tuple[int, str, dict]]:
+        """События после after_id; если их нет — ждет не дольше timeout секунд"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id > after_id, timeout)
+            return self._since(after_id)
+
+    @contextmanager
+    def subscription(self):
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+
+def outstanding_jobs(ledger: SendLedger = send_ledger) -> List[dict]:
+    """Снимок незавершенных отправок для нового подписчика"""
+    jobs = ledger.in_flight() + ledger.gtin_pending()
+    return [
+        {"item_id": job["item_id"], "feed_id": job["feed_id"], "status": job["status"],
+         "gtin": job["gtin"], "gtin_written": bool(job["gtin_written"])}
+        for job in jobs
+    ]
+
+
+class ProgressPoller:
+    """
+    Фоновый опрос фидов и запись GTIN.
+    write_gtin(item_id, gtin, is_variant) -> {'success', 'message'|'error'}.
+    ledger и feed_status — журнал и статусы фидов одного аккаунта.
+    """
+
+    def __init__(self, hub: EventHub, write_gtin: Optional[Callable] = None, settings: dict = PROGRESS,
+                 ledger: SendLedger = send_ledger, feed_status: FeedStatusService = feed_status_service):
+        self.hub = hub
+        self.write_gtin = write_gtin
+        self.settings = settings
+        self.ledger = ledger
+        self.feed_status = feed_status
+        self._seen = {}                  # feed_id -> (статус, GTIN), о которых уже сообщили
+        self._feeds = {}                 # feed_id -> расписание опроса: since, interval, next_at, stopped
+        self._write_failures = {}        # item_id -> неудачная запись GTIN: gtin, attempts, retry_at, error
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_running(self) -> None:
+        """Запускает опрос (или будит уже запущенный)"""
+        with self._lock:
+            self._wake.set()
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="progress-poller", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Останавливает опрос после текущего цикла; ensure_running запускает его снова"""
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+            self._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                with request_priority(PRIORITY_POLLING):
+                    busy = self.poll_once()
+            except Exception as e:
+                print(f"❌ Ошибка опроса фидов: {e}")
+                busy = True
+            with self._lock:
+                if self._stopping or (not busy and not self.hub.subscribers and not self._wake.is_set()):
+                    self._thread = None
+                    return
+            self._wake.wait(self.settings["poll_interval"])
+        with self._lock:
+            self._thread = None
+
+    def poll_once(self) -> bool:
+        """Один цикл опроса; True — остались незавершенные задачи"""
+        jobs = defaultdict(list)
+        for job in self.ledger.in_flight():
+            jobs[job["feed_id"]].append(job["item_id"])
+        for feed_id in set(self._feeds) - set(jobs):
+            del self._feeds[feed_id]
+
+        now = time.monotonic()
+        due = [feed_id for feed_id in jobs if self._feed_due(feed_id, now)]
+        if due:
+            results = self.feed_status.lookup_many(due)
+            for feed_id in due:
+                feed_info = results.get(feed_id, {})
+                changed = feed_info.get("success") and self._report_feed(feed_id, jobs[feed_id], feed_info)
+                self._reschedule(feed_id, changed)
+
+        pending = self.ledger.gtin_pending() if self.settings["write_back_gtin"] and self.write_gtin else []
+        for job in pending:
+            self._write_back(job)
+        polling = [feed_id for feed_id in jobs if not self._feeds[feed_id].get("stopped")]
+        writing = [job for job in pending if not self._write_exhausted(job)]
+        return bool(polling or writing)
+
+    def _feed_due(self, feed_id: str, now: float) -> bool:
+        schedule = self._feeds.setdefault(
+            feed_id, {"since": now, "interval": self.settings["poll_interval"], "next_at": now}
+        )
+        if schedule.get("stopped"):
+            return False
+        if now - schedule["since"] > self.settings["feed_timeout"]:
+            schedule["stopped"] = True
+            print(f"⚠️  Фид {feed_id} не получил финальный статус за "
+                  f"{self.settings['feed_timeout']:.0f} с, опрос остановлен")
+            return False
+        return now >= schedule["next_at"]
+
+    def _reschedule(self, feed_id: str, changed: bool) -> None:
+        """Пока статус фида не меняется, интервал его опроса удваивается"""
+        schedule = self._feeds[feed_id]
+        if changed:
+            schedule["interval"] = self.settings["poll_interval"]
+        else:
+            schedule["interval"] = min(schedule["interval"] * 2, self.settings["max_poll_interval"])
+        schedule["next_at"] = time.monotonic() + schedule["interval"]
+
+    def _report_feed(self, feed_id: str, item_ids: List[str], feed_info: dict) -> bool:
+        """Публикует статус фида; False — с прошлого опроса ничего не изменилось"""
+        formatted = format_status_response(feed_info)
+        status = ledger_status(formatted)
+        gtin = formatted.get("gtin")
+        if self._seen.get(feed_id) == (status, gtin):
+            return False
+        if status in FINAL_STATUSES:
+            # Фид больше не попадет в опрос
+            self._seen.pop(feed_id, None)
+        else:
+            self._seen[feed_id] = (status, gtin)
+        self.ledger.update_feed(feed_id, status, gtin)
+        self.hub.publish(EVENT_FEED_STATUS, {
+            "feed_id": feed_id,
+            "item_ids": item_ids,
+            "status": status,
+            "nk_status": formatted.get("status"),
+            "gtin": gtin,
+            "errors": formatted.get("errors", []),
+        })
+        return True
+
+    def _write_failure(self, job: dict) -> Optional[dict]:
+        failure = self._write_failures.get(job["item_id"])
+        # Новый GTIN товара — попытки считаются заново
+        return failure if failure and failure["gtin"] == job["gtin"] else None
+
+    def _write_exhausted(self, job: dict) -> bool:
+        failure = self._write_failure(job)
+        return bool(failure) and failure["attempts"] >= self.settings["write_attempts"]
+
+    def _write_back(self, job: dict) -> None:
+        item_id = job["item_id"]
+        failure = self._write_failure(job)
+        if failure and (self._write_exhausted(job) or failure["retry_at"] > time.monotonic()):
+            return
+        result = self.write_gtin(item_id, job["gtin"], job["item_type"] == "variant")
+        message = result.get("message") or result.get("error")
+        if result.get("success"):
+            self.ledger.mark_gtin_written(item_id, job["gtin"])
+            self._write_failures.pop(item_id, None)
+            self.hub.publish(EVENT_GTIN_WRITTEN, {
+                "item_id": item_id, "gtin": job["gtin"], "success": True, "message": message,
+            })
+            return
+
+        attempts = failure["attempts"] + 1 if failure else 1
+        self._write_failures[item_id] = {
+            "gtin": job["gtin"],
+            "attempts": attempts,
+            "retry_at": time.monotonic() + self.settings["write_retry"] * 2 ** (attempts - 1),
+            "error": message,
+        }
+        final = attempts >= self.settings["write_attempts"]
+        if final:
+            print(f"⚠️  GTIN {job['gtin']} не записан в МойСклад после {attempts} попыток: {message}")
+        # О той же ошибке повторно не сообщаем, о последней попытке — обязательно
+        if failure is None or failure["error"] != message or final:
+            self.hub.publish(EVENT_GTIN_WRITTEN, {
+                "item_id": item_id, "gtin": job["gtin"], "success": False, "message": message, "final": final,
+            })
+
+
+progress_hub = EventHub()
@@ -0,0 +1,271 @@
+"""
+Общий планировщик исходящих запросов к МойСклад и НК
+
+На каждый внешний сервис (upstream) — корзина токенов (запросов в секунду
+с запасом на всплеск), ограничение числа параллельных запросов и очередь
+с приоритетами: интерактивные запросы пользователя обслуживаются раньше
+опроса фидов, а опрос — раньше фоновой синхронизации.
+
+Скорость подстраивается под ответы: 429 и заголовки лимитов (Retry-After,
+X-Lognex-Retry-After, X-RateLimit-Remaining/X-Lognex-Reset) приостанавливают
+upstream и вдвое снижают скорость, успешные ответы постепенно ее восстанавливают.
+
+Запросы планировщика идут через его собственную requests.Session: у каждого
+планировщика (аккаунта, см. tenants.py) свой пул соединений и свои лимиты.
+"""
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import RATE_LIMITS
+
+# Приоритеты очереди: меньше — раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_POLLING = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_POLLING: "polling",
+    PRIORITY_BACKGROUND: "background",
+}
+
+_current_priority: ContextVar[int] = ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority: int):
+    """Приоритет всех запросов внутри блока (для фоновых потоков и задач)"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def _header_seconds(headers, name: str, scale: float = 1.0) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value) * scale)
+    except (TypeError, ValueError):
+        return None
+
+
+class Upstream:
+    """Лимиты одного внешнего сервиса"""
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int,
+                 min_rate: float = 0.5, recovery: float = 0.05):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.recovery = recovery
+        self.burst = float(burst)
+        self.concurrency = concurrency
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+
+        self._cond = threading.Condition()
+        self._waiters = []            # куча (приоритет, порядковый номер)
+        self._seq = itertools.count()
+        self.metrics = {
+            "requests": 0,
+            "throttled": 0,           # ответы 429
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "waiting": {name: 0 for name in PRIORITY_NAMES.values()},
+        }
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, now: float) -> float:
+        """Сколько ждать до возможности отправить запрос (0 — можно сейчас)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.concurrency:
+            return 1.0                # разбудит release()
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0.0
+
+    def acquire(self, priority: int) -> float:
+        """Ждет своей очереди; возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        lane = PRIORITY_NAMES.get(priority, str(priority))
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            self.metrics["waiting"][lane] = self.metrics["waiting"].get(lane, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(now)
+                    if self._waiters[0] == entry and delay == 0:
+                        break
+                    self._cond.wait(timeout=delay or None)
+                heapq.heappop(self._waiters)
+                self.tokens -= 1
+                self.in_flight += 1
+            except BaseException:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                raise
+            finally:
+                self.metrics["waiting"][lane] -= 1
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            self.metrics["requests"] += 1
+            self.metrics["wait_total"] += waited
+            self.metrics["wait_max"] = max(self.metrics["wait_max"], waited)
+        return waited
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, response: requests.Response) -> Optional[float]:
+        """
+        Подстраивает скорость по ответу. Возвращает паузу перед повтором
+        для 429 (None — ответ не требует повтора).
+        """
+        headers = response.headers
+        now = time.monotonic()
+        with self._cond:
+            if response.status_code == 429:
+                self.metrics["throttled"] += 1
+                pause = (_header_seconds(headers, "X-Lognex-Retry-After", 0.001)
+                         or _header_seconds(headers, "Retry-After")
+                         or 1.0 / self.rate)
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.blocked_until = max(self.blocked_until, now + pause)
+                self._cond.notify_all()
+                return pause
+
+            remaining = headers.get("X-RateLimit-Remaining")
+            if remaining is not None and remaining.strip() == "0":
+                reset = (_header_seconds(headers, "X-Lognex-Reset", 0.001)
+                         or _header_seconds(headers, "Retry-After"))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+        return None
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            requests_total = self.metrics["requests"]
+            return {
+                "rate": round(self.rate, 3),
+                "max_rate": self.max_rate,
+                "tokens": round(self.tokens, 2),
+                "in_flight": self.in_flight,
+                "concurrency": self.concurrency,
+                "queue_depth": len(self._waiters),
+                "waiting": dict(self.metrics["waiting"]),
+                "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+                "requests": requests_total,
+                "throttled": self.metrics["throttled"],
+                "wait_avg": round(self.metrics["wait_total"] / requests_total, 4) if requests_total else 0.0,
+                "wait_max": round(self.metrics["wait_max"], 4),
+            }
+
+
+class RequestScheduler:
+    def __init__(self, limits: Dict[str, dict] = RATE_LIMITS, max_retries: int = 3):
+        self.upstreams = {name: Upstream(name, **spec) for name, spec in limits.items()}
+        self.max_retries = max_retries
+        # Пул соединений не меньше числа параллельных запросов к upstream
+        pool_size = max((spec["concurrency"] for spec in limits.values()), default=10)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(limits) or 1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # observer(upstream, method, url) -> запись вызова или None (profiling.py)
+        self.observer = None
+
+    def request(self, upstream: str, method: str, url: str,
+                priority: Optional[int] = None, **kwargs) -> requests.Response:
+        """
+        requests.request через лимиты upstream. Ответ 429 повторяется после
+        паузы (до max_retries раз), затем возвращается как есть.
+        При stream=True слот параллельности занят до response.close().
+        """
+        limiter = self.upstreams[upstream]
+        if priority is None:
+            priority = _current_priority.get()
+        stream = kwargs.get("stream", False)
+        observer = self.observer
+        call = observer(upstream, method, url) if observer is not None else None
+
+        for attempt in range(self.max_retries + 1):
+            waited = limiter.acquire(priority)
+            if call is not None:
+                call.sent(waited)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except BaseException as e:
+                limiter.release()
+                if call is not None:
+                    call.finish(error=e)
+                raise
+            pause = limiter.observe(response)
+            if pause is None or attempt == self.max_retries:
+                break
+            response.close()
+            limiter.release()
+            print(f"⏳ {upstream}: 429, повтор через {pause:.2f} с")
+
+        if call is not None:
+            call.finish(response.status_code)
+
+        if stream:
+            close = response.close
+            released = []
+
+            def close_and_release():
+                try:
+                    close()
+                finally:
+                    if not released:
+                        released.append(True)
+                        limiter.release()
+
+            response.close = close_and_release
+        else:
+            limiter.release()
+        return response
+
+    def get(self, upstream: str, url: str, **kwargs) -> requests.Response:
+        return self.request(upstream, "GET", url, **kwargs)
+
+    def post(self, upstream: str, url: str, **kwargs) -> requests.Response:
+        return self.request(upstream, "POST", url, **kwargs)
+
+    def put(self, upstream: str, url: str, **kwargs) -> requests.Response:
+        return self.request(upstream, "PUT", url, **kwargs)
+
+    def delete(self, upstream: str, url: str, **kwargs) -> requests.Response:
+        return self.request(upstream, "DELETE", url, **kwargs)
+
+    def metrics(self) -> dict:
+        return {name: limiter.snapshot() for name, limiter in self.upstreams.items()}
+
+
+scheduler = RequestScheduler()
@@ -0,0 +1,240 @@
+"""
+Сверка товаров МойСклад с карточками Национального каталога
+
+Товар, у которого уже есть карточка в НК (созданная нами раньше или
+поставщиком), без сверки отправляется снова — новым черновиком с
+техническим GTIN. NKProductIndex загружает список карточек аккаунта
+(/v4/product-list постранично; артикул и размер — из /v3/product) и
+индексирует его по GTIN, артикулу и наименованию. Список кешируется на
+RECONCILE['ttl'].
+
+reconcile() сопоставляет строки каталога:
+  linked    — GTIN из штрихкодов МойСклад уже есть в НК;
+  matched   — ровно одна карточка с тем же артикулом (и размером) или наименованием;
+  ambiguous — подходит несколько карточек или одна карточка нескольким товарам;
+  unmatched — карточки нет.
+GTIN сопоставленных товаров дописываются в штрихкоды МойСклад массовым
+обновлением (link_writes); после этого товары становятся linked и не
+отправляются в НК повторно (RECONCILE['skip_carded']).
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from config import RECONCILE
+from nk_api import NKClient, nk_client
+
+# Атрибуты карточки НК (см. create_card_data)
+ATTR_FIELDS = {"13914": "article", "35": "size"}
+
+STATUS_LINKED = "linked"
+STATUS_MATCHED = "matched"
+STATUS_AMBIGUOUS = "ambiguous"
+STATUS_UNMATCHED = "unmatched"
+STATUSES = (STATUS_LINKED, STATUS_MATCHED, STATUS_AMBIGUOUS, STATUS_UNMATCHED)
+
+# Типы штрихкодов МойСклад, которые могут быть GTIN карточки НК
+BARCODE_TYPES = ("gtin", "ean13")
+
+
+def normalize_gtin(value) -> str:
+    """GTIN из 14 цифр, как его хранит МойСклад; пустая строка — не GTIN"""
+    digits = "".join(filter(str.isdigit, str(value or "")))
+    return digits.zfill(14) if 8 <= len(digits) <= 14 else ""
+
+
+def _normalize_text(value) -> str:
+    return " ".join(str(value or "").replace("ё", "е").replace("Ё", "Е").split()).casefold()
+
+
+def item_gtins(item) -> List[str]:
+    """GTIN из штрихкодов строки МойСклад"""
+    gtins = []
+    for barcode in item.get("barcodes") or ():
+        for barcode_type in BARCODE_TYPES:
+            gtin = normalize_gtin(barcode.get(barcode_type))
+            if gtin:
+                gtins.append(gtin)
+    return gtins
+
+
+def _good(entry) -> dict:
+    """Карточка НК из ответа /v4/product-list или /v3/product"""
+    gtin = entry.get("gtin") or next(
+        (ident.get("value") for ident in entry.get("identified_by") or () if ident.get("type") == "gtin"), ""
+    )
+    return {
+        "gtin": normalize_gtin(gtin),
+        "good_id": entry.get("good_id"),
+        "name": entry.get("good_name", ""),
+        "status": entry.get("good_status"),
+        "article": "",
+        "size": "",
+    }
+
+
+def _candidate(good) -> dict:
+    return {field: good[field] for field in ("gtin", "good_id", "name", "article", "size")}
+
+
+class NKProductIndex:
+    """Список карточек НК аккаунта с индексами по GTIN, артикулу и наименованию"""
+
+    def __init__(self, settings: dict = RECONCILE, nk: NKClient = nk_client):
+        self.settings = settings
+        self.nk = nk
+        self._lock = threading.Lock()
+        self.goods: Dict[str, dict] = {}              # GTIN -> карточка
+        self.by_article: Dict[str, List[dict]] = {}
+        self.by_name: Dict[str, List[dict]] = {}
+        self.loaded_at: Optional[float] = None
+        self.stats = {"loads": 0, "goods": 0, "load_seconds": 0.0}
+
+    @property
+    def fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.settings["ttl"]
+
+    def ensure(self) -> "NKProductIndex":
+        """Загружает список карточек, если его нет или он устарел (ошибка — исключение requests)"""
+        if not self.fresh:
+            with self._lock:
+                if not self.fresh:
+                    self._load()
+        return self
+
+    def refresh(self) -> "NKProductIndex":
+        with self._lock:
+            self._load()
+        return self
+
+    def _load(self) -> None:
+        started = time.monotonic()
+        goods = {}
+        for entry in self.nk.iter_product_list(self.settings["page_size"]):
+            good = _good(entry)
+            if good["gtin"]:
+                goods[good["gtin"]] = good
+
+        if self.settings["details"] and goods:
+            for product in self.nk.get_products(goods, self.settings["details_batch"]):
+                good = goods.get(_good(product)["gtin"])
+                if good is None:
+                    continue
+                for attr in product.get("good_attrs") or ():
+                    field = ATTR_FIELDS.get(str(attr.get("attr_id")))
+                    if field:
+                        good[field] = str(attr.get("attr_value") or "")
+
+        by_article, by_name = defaultdict(list), defaultdict(list)
+        for good in goods.values():
+            if good["article"]:
+                by_article[_normalize_text(good["article"])].append(good)
+            if good["name"]:
+                by_name[_normalize_text(good["name"])].append(good)
+
+        # Индексы заменяются целиком: параллельные читатели видят старый или новый список
+        self.goods, self.by_article, self.by_name = goods, dict(by_article), dict(by_name)
+        self.loaded_at = time.monotonic()
+        elapsed = time.monotonic() - started
+        self.stats.update(loads=self.stats["loads"] + 1, goods=len(goods), load_seconds=round(elapsed, 3))
+        print(f"📚 Карточки НК загружены: {len(goods)} за {elapsed:.1f} с")
+
+    def carded_gtin(self, item) -> Optional[str]:
+        """
+        GTIN строки МойСклад, карточка которого уже есть в НК.
+        Смотрит только в загруженный список (без запросов); None — не найден или списка нет.
+        """
+        if not self.fresh:
+            return None
+        return next((gtin for gtin in item_gtins(item) if gtin in self.goods), None)
+
+    def candidates(self, data, match_by) -> tuple:
+        """(карточки, признак) для полей товара: сначала артикул (с размером), затем наименование"""
+        if "article" in match_by and data.get("article"):
+            # Карточка с размером подходит только строке того же размера (вариант, а не общий товар)
+            size = _normalize_text(data.get("size"))
+            found = [
+                good for good in self.by_article.get(_normalize_text(data["article"]), [])
+                if not good["size"] or _normalize_text(good["size"]) == size
+            ]
+            if found:
+                return found, "article"
+        if "name" in match_by and data.get("name"):
+            found = self.by_name.get(_normalize_text(data["name"]), [])
+            if found:
+                return found, "name"
+        return [], None
+
+
+def reconcile(api, items: Iterable[dict], index: NKProductIndex, match_by=None) -> dict:
+    """
+    Сопоставление строк каталога (товар, затем его варианты) с карточками НК.
+    Возвращает {'items': [...], 'summary': {статус: количество}}.
+    """
+    match_by = match_by or index.settings["match_by"]
+    results = []
+    claims = defaultdict(list)  # GTIN -> строки, которым он достался
+
+    for position, item in enumerate(items):
+        data = api._extract_item_fields(item)
+        result = {
+            "id": item.get("id"),
+            "product_index": position,
+            "name": data["name"],
+            "article": data["article"],
+            "size": data["size"],
+            "item_type": data["item_type"],
+            "status": STATUS_UNMATCHED,
+            "gtin": None,
+            "match_by": None,
+            "candidates": [],
+        }
+        linked = next((gtin for gtin in item_gtins(item) if gtin in index.goods), None) \
+            if "gtin" in match_by else None
+        if linked:
+            result.update(status=STATUS_LINKED, gtin=linked, match_by="gtin")
+        else:
+            found, how = index.candidates(data, match_by)
+            result["match_by"] = how
+            if len(found) == 1:
+                result.update(status=STATUS_MATCHED, gtin=found[0]["gtin"], candidates=[_candidate(found[0])])
+            elif found:
+                result.update(status=STATUS_AMBIGUOUS, candidates=[_candidate(good) for good in found[:10]])
+        if result["gtin"]:
+            claims[result["gtin"]].append(result)
+        results.append(result)
+
+    # Одна карточка НК — одному товару: спорные совпадения отдаются на ручной выбор
+    for gtin, claimants in claims.items():
+        if len(claimants) > 1:
+            for result in claimants:
+                if result["status"] == STATUS_MATCHED:
+                    result.update(status=STATUS_AMBIGUOUS, gtin=None)
+
+    counts = Counter(result["status"] for result in results)
+    return {"items": results, "summary": {status: counts.get(status, 0) for status in STATUSES}}
+
+
+def link_writes(links: Iterable[dict], items_by_id: Dict[str, dict]) -> List[dict]:
+    """
+    Записи массового обновления (см. BulkCorrections.write): GTIN карточки НК
+    дописывается к штрихкодам строки. links — [{'id', 'gtin'}].
+    Без штрихкодов в строке (ASSORTMENT_FETCH['fields']) body=None: такой
+    GTIN записывается отдельным запросом, чтобы не затереть имеющиеся штрихкоды.
+    """
+    writes = []
+    for link in links:
+        item = items_by_id.get(link.get("id"))
+        gtin = normalize_gtin(link.get("gtin"))
+        if item is None or not gtin or gtin in item_gtins(item):
+            continue
+        write = {"entity": item["meta"]["type"], "id": item["id"], "name": item.get("name", ""),
+                 "gtin": gtin, "body": None}
+        if "barcodes" in item:
+            write["body"] = {"meta": item["meta"], "barcodes": list(item["barcodes"]) + [{"gtin": gtin}]}
+        writes.append(write)
+    return writes
+
+
+nk_product_index = NKProductIndex()
@@ -0,0 +1,269 @@
+"""
+Журнал отправленных в НК карточек (SQLite)
+
+item_id → хеш содержимого → feed_id → статус → GTIN.
+Позволяет не отправлять повторно неизмененные карточки, продолжать
+опрос фидов «в обработке» и находить товары, требующие переотправки.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import SEND_LEDGER_FILE
+from json_backend import dumps_str, loads
+from nk_api import is_feed_accepted
+
+# Статусы записи журнала
+STATUS_SENDING = "Sending"        # запрос в НК отправляется прямо сейчас
+STATUS_ACCEPTED = "Accepted"      # фид принят / GTIN получен
+STATUS_REJECTED = "Rejected"      # фид отклонен
+STATUS_FAILED = "Failed"          # ошибка отправки, feed_id нет
+# Все остальные статусы НК (Received, Processing, ...) считаются «в обработке»
+FINAL_STATUSES = {STATUS_ACCEPTED, STATUS_REJECTED, STATUS_FAILED}
+
+# Резерв «Sending» старше этого срока считается брошенным (процесс упал)
+SENDING_STALE_SECONDS = 600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    item_id     TEXT NOT NULL,
+    card_hash   TEXT NOT NULL,
+    item_type   TEXT,
+    feed_id     TEXT,
+    status      TEXT NOT NULL,
+    gtin        TEXT,
+    gtin_written INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    fingerprint TEXT,
+    fields      TEXT,
+    base_hash   TEXT,
+    user_changes TEXT,
+    created_at  TEXT NOT NULL,
+    updated_at  TEXT NOT NULL,
+    PRIMARY KEY (item_id, card_hash)
+);
+CREATE INDEX IF NOT EXISTS submissions_feed ON submissions (feed_id);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status);
+"""
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class SendLedger:
+    def __init__(self, path: str = SEND_LEDGER_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # Колонки, добавленные после первой версии журнала
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(submissions)")}
+            for column in ("fingerprint", "fields", "base_hash", "user_changes"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE submissions ADD COLUMN {column} TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Чтение
+    # ------------------------------------------------------------------
+
+    def get(self, item_id: str, card_hash: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM submissions WHERE item_id = ? AND card_hash = ?",
+                (item_id, card_hash),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def by_feed(self, feed_id) -> List[dict]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM submissions WHERE feed_id = ?", (str(feed_id),)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def accepted_fingerprints(self) -> Dict[str, dict]:
+        """
+        Отпечаток NK-полей последней принятой отправки каждого товара:
+        {item_id: {"fingerprint": ..., "fields": {...}}}. Последняя — по времени
+        отправки (created_at): updated_at меняют повторные проверки фида и запись GTIN.
+        """
+        result: Dict[str, dict] = {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT item_id, fingerprint, fields FROM submissions "
+                "WHERE status = ? AND fingerprint IS NOT NULL ORDER BY created_at, rowid",
+                (STATUS_ACCEPTED,),
+            )
+            for row in rows:
+                result[row["item_id"]] = {
+                    "fingerprint": row["fingerprint"],
+                    "fields": loads(row["fields"] or "{}"),
+                }
+        return result
+
+    def in_flight(self) -> List[dict]:
+        """Отправки с feed_id, по которым еще нет окончательного статуса"""
+        marks = ",".join("?" * len(FINAL_STATUSES))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM submissions WHERE feed_id IS NOT NULL "
+                f"AND status NOT IN ({marks}) ORDER BY updated_at",
+                tuple(FINAL_STATUSES),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def gtin_pending(self) -> List[dict]:
+        """Принятые отправки с GTIN, который еще не записан в МойСклад"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM submissions WHERE status = ? AND gtin IS NOT NULL "
+                "AND gtin_written = 0 ORDER BY updated_at",
+                (STATUS_ACCEPTED,),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def last_accepted(self) -> Dict[str, dict]:
+        """
+        Последняя принятая отправка каждого товара:
+        {item_id: {"base_hash": ..., "user_changes": {...}}}.
+        base_hash — хеш данных товара без пользовательских изменений; в записях
+        до его появления — card_hash (совпадает, если правок не было).
+        """
+        # Порядок — по времени отправки: updated_at меняют и повторная проверка
+        # старого фида, и запись GTIN
+        result: Dict[str, dict] = {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT item_id, card_hash, base_hash, user_changes FROM submissions "
+                "WHERE status = ? ORDER BY created_at, rowid",
+                (STATUS_ACCEPTED,),
+            )
+            for row in rows:
+                result[row["item_id"]] = {
+                    "base_hash": row["base_hash"] or row["card_hash"],
+                    "user_changes": loads(row["user_changes"] or "{}"),
+                }
+        return result
+
+    def needs_resend(self, current_hashes: Dict[str, str]) -> List[str]:
+        """
+        Товары, которые нужно (пере)отправить: данные товара изменились с
+        последней принятой отправки (или ее нет) и по товару нет отправки
+        в обработке. Сравниваются данные без пользовательских изменений,
+        поэтому отправка с правками из превью не считается устаревшей.
+        current_hashes: {item_id: card_content_hash(данные товара)}
+        """
+        pending = {r["item_id"] for r in self.in_flight()}
+        accepted = self.last_accepted()
+        return [
+            item_id for item_id, base_hash in current_hashes.items()
+            if item_id not in pending
+            and (item_id not in accepted or accepted[item_id]["base_hash"] != base_hash)
+        ]
+
+    # ------------------------------------------------------------------
+    # Запись
+    # ------------------------------------------------------------------
+
+    def reserve(self, item_id: str, card_hash: str, item_type: str = None,
+                fingerprint: str = None, fields: dict = None,
+                base_hash: str = None, user_changes: dict = None) -> Optional[dict]:
+        """
+        Резервирует отправку (item_id, card_hash).
+        fingerprint/fields — отпечаток NK-полей товара (см. delta_sync),
+        base_hash/user_changes — хеш данных без правок и сами правки
+        (см. needs_resend).
+        Возвращает None, если можно отправлять, иначе существующую запись
+        (принятую, в обработке или отправляемую параллельным запросом).
+        Отклоненные и неудачные отправки можно повторять.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM submissions WHERE item_id = ? AND card_hash = ?",
+                (item_id, card_hash),
+            ).fetchone()
+            if row and row["status"] not in (STATUS_REJECTED, STATUS_FAILED):
+                stale = (
+                    row["status"] == STATUS_SENDING
+                    and (datetime.now() - datetime.fromisoformat(row["updated_at"])).total_seconds()
+                    > SENDING_STALE_SECONDS
+                )
+                if not stale:
+                    return dict(row)
+            now = _now()
+            conn.execute(
+                "INSERT OR REPLACE INTO submissions "
+                "(item_id, card_hash, item_type, feed_id, status, gtin, gtin_written, error, "
+                "fingerprint, fields, base_hash, user_changes, created_at, updated_at) "
+                "VALUES (?, ?, ?, NULL, ?, NULL, 0, NULL, ?, ?, ?, ?, ?, ?)",
+                (item_id, card_hash, item_type, STATUS_SENDING, fingerprint,
+                 dumps_str(fields) if fields is not None else None, base_hash,
+                 dumps_str(user_changes) if user_changes else None, now, now),
+            )
+        return None
+
+    def record_sent(self, item_id: str, card_hash: str, feed_id, status: str,
+                    gtin: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE submissions SET feed_id = ?, status = ?, gtin = ?, error = NULL, updated_at = ? "
+                "WHERE item_id = ? AND card_hash = ?",
+                (str(feed_id), status, gtin, _now(), item_id, card_hash),
+            )
+
+    def record_failed(self, item_id: str, card_hash: str, error: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE submissions SET status = ?, error = ?, updated_at = ? "
+                "WHERE item_id = ? AND card_hash = ?",
+                (STATUS_FAILED, error, _now(), item_id, card_hash),
+            )
+
+    def update_feed(self, feed_id, status: str, gtin: Optional[str] = None) -> None:
+        """
+        Обновляет статус всех записей фида (GTIN не затирается пустым значением).
+        Промежуточный или неизвестный статус не понижает окончательный:
+        ответ без итога (сбой опроса) не снимает отметку Accepted.
+        """
+        query = "UPDATE submissions SET status = ?, gtin = COALESCE(?, gtin), updated_at = ? WHERE feed_id = ?"
+        args = [status, gtin, _now(), str(feed_id)]
+        if status not in FINAL_STATUSES:
+            query += f" AND status NOT IN ({','.join('?' * len(FINAL_STATUSES))})"
+            args += sorted(FINAL_STATUSES)
+        with self._connect() as conn:
+            conn.execute(query, args)
+
+    def mark_gtin_written(self, item_id: str, gtin: str) -> None:
+        """Отмечает, что GTIN принятой отправки записан в МойСклад"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE submissions SET gtin_written = 1, gtin = COALESCE(gtin, ?), updated_at = ? "
+                "WHERE item_id = ? AND status = ?",
+                (gtin, _now(), item_id, STATUS_ACCEPTED),
+            )
+
+
+def ledger_status(status_response: dict) -> str:
+    """Статус журнала по ответу format_status_response"""
+    if is_feed_accepted(status_response):
+        return STATUS_ACCEPTED
+    if status_response.get("status") == "Rejected":
+        return STATUS_REJECTED
+    return status_response.get("status") or "Unknown"
+
+
+send_ledger = SendLedger()
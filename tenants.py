@@ -0,0 +1,209 @@
+"""
+Несколько юрлиц (аккаунтов МойСклад и НК) в одном процессе
+
+Tenant — все, что принадлежит одному аккаунту: планировщик запросов (свои
+лимиты и пул соединений), клиент НК со своим apikey, зеркало ассортимента,
+журнал отправок, статусы фидов, список карточек НК, кеш ответов
+/api/products и поток событий. Клиент МойСклад и зависящие от него службы
+(исправления, вебхуки, фоновый опрос) подключает app.py.
+
+Справочники НК (категории, атрибуты, пресеты цветов и видов, сопоставление
+ТН ВЭД) от аккаунта не зависят: они кешируются в nk_api на уровне процесса
+и общие для всех аккаунтов, как и кеш карточек (card_cache, по хешу
+содержимого). Запрашиваются они ключом NC_API_KEY, а без него — ключом
+первого аккаунта из файла.
+
+Аккаунт по умолчанию (TENANTS['default']) настраивается через .env и
+использует объекты модулей (scheduler, assortment_mirror, send_ledger, ...).
+Остальные перечисляются в JSON-файле TENANTS['file']:
+
+    {
+      "acme": {
+        "ms_token_env": "MS_TOKEN_ACME",
+        "nk_api_key_env": "NC_API_KEY_ACME",
+        "webhook_secret_env": "MS_WEBHOOK_SECRET_ACME",
+        "send_ledger_file": "send_ledger_acme.sqlite3",
+        "rate_limits": {"moysklad": {"rate": 10}}
+      }
+    }
+
+Секреты можно задать и значением (ms_token, nk_api_key, webhook_secret).
+
+Текущий аккаунт — ContextVar, как приоритет запросов в rate_limiter:
+use_tenant() задает его для блока (запрос Flask, фоновая задача),
+current_tenant() возвращает его (вне блока — аккаунт по умолчанию).
+"""
+import os
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+import nk_api
+from assortment_mirror import AssortmentMirror, assortment_mirror
+from config import RATE_LIMITS, TENANTS, WEBHOOKS
+from feed_status import FeedStatusService, feed_status_service
+from http_cache import ResponseCache, response_cache
+from json_backend import loads
+from nk_api import NKClient, nk_client
+from progress_events import EventHub, progress_hub
+from rate_limiter import RequestScheduler, scheduler
+from reconciliation import NKProductIndex, nk_product_index
+from send_ledger import SendLedger, send_ledger
+from webhooks import WEBHOOK_SECRET
+
+# Имя аккаунта попадает в путь вебхука и имя файла журнала
+TENANT_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _rate_limits(overrides: Optional[dict]) -> Dict[str, dict]:
+    """RATE_LIMITS с поправками аккаунта ({"moysklad": {"rate": 10}})"""
+    overrides = overrides or {}
+    return {upstream: dict(spec, **(overrides.get(upstream) or {})) for upstream, spec in RATE_LIMITS.items()}
+
+
+def _secret(spec: dict, key: str) -> Optional[str]:
+    """Значение spec[key] или переменная окружения spec[key + '_env']"""
+    if spec.get(key):
+        return str(spec[key])
+    env = spec.get(f"{key}_env")
+    return os.getenv(env) if env else None
+
+
+class Tenant:
+    """
+    Клиенты и хранилища одного аккаунта. from_env — аккаунт по умолчанию
+    на объектах модулей (токены из .env).
+    """
+
+    def __init__(self, name: str, ms_token: Optional[str] = None, nk_api_key: Optional[str] = None,
+                 webhook_secret: Optional[str] = None, ledger_file: Optional[str] = None,
+                 rate_limits: Optional[dict] = None, from_env: bool = False):
+        self.name = name
+        self.default = from_env
+        self.ms_token = ms_token
+        self.webhook_secret = webhook_secret
+        if from_env:
+            self.scheduler = scheduler
+            self.nk = nk_client
+            self.mirror = assortment_mirror
+            self.ledger = send_ledger
+            self.feed_status = feed_status_service
+            self.nk_index = nk_product_index
+            self.response_cache = response_cache
+            self.hub = progress_hub
+        else:
+            self.scheduler = RequestScheduler(_rate_limits(rate_limits))
+            self.nk = NKClient(nk_api_key, scheduler=self.scheduler)
+            self.mirror = AssortmentMirror()
+            self.ledger = SendLedger(ledger_file or TENANTS["ledger_file"].format(name=name))
+            self.feed_status = FeedStatusService(nk=self.nk)
+            self.nk_index = NKProductIndex(nk=self.nk)
+            self.response_cache = ResponseCache()
+            self.hub = EventHub()
+        # Подключаются в app.py (attach_tenant_services)
+        self.api = None
+        self.corrections = None
+        self.webhook_batcher = None
+        self.progress_poller = None
+
+    @property
+    def webhook_path(self) -> str:
+        """Путь приема вебхуков аккаунта (секрет у каждого аккаунта свой)"""
+        return WEBHOOKS["path"] if self.default else f"{WEBHOOKS['path']}/{self.name}"
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "default": self.default,
+            "moysklad": bool(self.ms_token),
+            "nk": bool(self.nk.api_key),
+            "webhooks": bool(self.webhook_secret),
+            "webhook_path": self.webhook_path,
+            "send_ledger": self.ledger.path,
+            "mirror_loaded": self.mirror.loaded,
+        }
+
+
+class TenantRegistry:
+    def __init__(self, settings: dict = TENANTS):
+        self.settings = settings
+        self.default = Tenant(settings["default"], os.getenv("MS_TOKEN"), nk_client.api_key,
+                              WEBHOOK_SECRET, from_env=True)
+        self._tenants: Dict[str, Tenant] = {self.default.name: self.default}
+        if settings["file"]:
+            self._load(settings["file"])
+
+    def _load(self, path: str) -> None:
+        with open(path, "rb") as f:
+            specs = loads(f.read())
+        if not isinstance(specs, dict):
+            raise ValueError(f"{path}: ожидается объект {{имя аккаунта: настройки}}")
+        for name, spec in specs.items():
+            if not TENANT_NAME.match(name):
+                raise ValueError(f"{path}: недопустимое имя аккаунта {name!r} (латиница, цифры, _ и -)")
+            if name in self._tenants:
+                raise ValueError(f"{path}: аккаунт {name} уже задан (аккаунт по умолчанию — из .env)")
+            if not _secret(spec, "ms_token"):
+                raise ValueError(f"{path}: у аккаунта {name} не задан токен МойСклад (ms_token или ms_token_env)")
+            self._tenants[name] = Tenant(
+                name,
+                ms_token=_secret(spec, "ms_token"),
+                nk_api_key=_secret(spec, "nk_api_key"),
+                webhook_secret=_secret(spec, "webhook_secret"),
+                ledger_file=spec.get("send_ledger_file"),
+                rate_limits=spec.get("rate_limits"),
+            )
+        print(f"🏢 Аккаунты: {', '.join(self._tenants)}")
+
+        # Справочники НК общие: без NC_API_KEY запрашиваются ключом первого аккаунта
+        if not nk_api.reference_client.api_key:
+            keyed = next((tenant for tenant in self._tenants.values() if tenant.nk.api_key), None)
+            if keyed is not None:
+                nk_api.use_reference_client(keyed.nk)
+
+    def get(self, name: Optional[str] = None) -> Tenant:
+        """Аккаунт по имени (без имени — по умолчанию); LookupError — неизвестное имя"""
+        if not name:
+            return self.default
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            raise LookupError(f"Неизвестный аккаунт: {name}")
+        return tenant
+
+    def names(self):
+        return list(self._tenants)
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(list(self._tenants.values()))
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+
+tenants = TenantRegistry()
+
+_current_tenant: ContextVar[Optional[Tenant]] = ContextVar("tenant", default=None)
+
+
+def current_tenant() -> Tenant:
+    return _current_tenant.get() or tenants.default
+
+
+def activate_tenant(tenant: Tenant):
+    """Делает аккаунт текущим; вернуть прежний — deactivate_tenant(результат)"""
+    return _current_tenant.set(tenant)
+
+
+def deactivate_tenant(token) -> None:
+    _current_tenant.reset(token)
+
+
+@contextmanager
+def use_tenant(tenant: Tenant):
+    """Аккаунт для всех обращений к объектам текущего аккаунта внутри блока"""
+    token = activate_tenant(tenant)
+    try:
+        yield tenant
+    finally:
+        deactivate_tenant(token)
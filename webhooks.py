@@ -0,0 +1,244 @@
+"""
+Вебхуки МойСклад: прием событий product/variant и обновление зеркала ассортимента
+
+События копятся и схлопываются (по одному действию на сущность), а после
+паузы WEBHOOKS['debounce'] (но не позже WEBHOOKS['max_delay'] от первого
+события) измененные сущности загружаются пачками по id. Массовая правка
+2000 товаров превращается в несколько запросов вместо 2000.
+
+МойСклад не подписывает запросы вебхуков, поэтому секрет передается
+в URL вебхука (?token=...) и сверяется при приеме. Секрет и путь — свои
+у каждого аккаунта (tenants.py); по умолчанию MS_WEBHOOK_SECRET и WEBHOOKS['path'].
+"""
+import hmac
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+
+from config import WEBHOOKS
+from json_backend import response_json
+from rate_limiter import request_priority, PRIORITY_BACKGROUND
+
+load_dotenv()
+
+WEBHOOK_SECRET = os.getenv("MS_WEBHOOK_SECRET")
+
+ACTION_UPSERT = "UPSERT"
+ACTION_DELETE = "DELETE"
+
+
+def webhooks_enabled(secret: Optional[str] = WEBHOOK_SECRET) -> bool:
+    return bool(secret)
+
+
+def verify_token(token: Optional[str], secret: Optional[str] = WEBHOOK_SECRET) -> bool:
+    """Сверяет секрет из URL вебхука"""
+    if not secret or not token:
+        return False
+    return hmac.compare_digest(str(token), secret)
+
+
+def parse_events(payload) -> List[Tuple[str, str, str]]:
+    """
+    События из тела вебхука: [(тип сущности, id, UPSERT|DELETE)].
+    Чужие типы, действия и события без ссылки на сущность отбрасываются.
+    """
+    events = []
+    if not isinstance(payload, dict):
+        return events
+    for event in payload.get("events") or []:
+        if not isinstance(event, dict):
+            continue
+        meta = event.get("meta") or {}
+        entity_type = meta.get("type")
+        action = event.get("action")
+        entity_id = (meta.get("href") or "").rstrip("/").split("/")[-1]
+        if entity_type not in WEBHOOKS["entity_types"] or action not in WEBHOOKS["actions"] or not entity_id:
+            continue
+        events.append((entity_type, entity_id, ACTION_DELETE if action == "DELETE" else ACTION_UPSERT))
+    return events
+
+
+class WebhookBatcher:
+    """
+    Копит события и применяет их к зеркалу ассортимента пачками.
+    api — MoySkladAPI (fetch_entities, iter_assortment), mirror — AssortmentMirror.
+    """
+
+    def __init__(self, api, mirror, settings: dict = WEBHOOKS):
+        self.api = api
+        self.mirror = mirror
+        self.settings = settings
+        self._pending: Dict[Tuple[str, str], str] = {}   # (тип, id) -> действие
+        self._first_at: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+        # События, пришедшие без зеркала или во время его полной загрузки:
+        # снимок может быть старше них, поэтому они применяются после загрузки
+        self._deferred: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.stats = {"events": 0, "flushes": 0, "fetches": 0, "full_reloads": 0, "errors": 0, "deferred": 0}
+        mirror.on_reloaded(self._replay_deferred)
+
+    def add(self, events: Iterable[Tuple[str, str, str]]) -> int:
+        """Ставит события в очередь; последнее действие по сущности побеждает"""
+        count = 0
+        with self._lock:
+            for entity_type, entity_id, action in events:
+                self._pending[(entity_type, entity_id)] = action
+                count += 1
+            if not count:
+                return 0
+            self.stats["events"] += count
+            self._schedule()
+        return count
+
+    def _schedule(self) -> None:
+        """Перезапускает таймер применения (вызывается под self._lock)"""
+        now = time.monotonic()
+        if self._first_at is None:
+            self._first_at = now
+        delay = min(self.settings["debounce"],
+                    max(0.0, self._first_at + self.settings["max_delay"] - now))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _replay_deferred(self) -> None:
+        """После полной загрузки зеркала — в очередь отложенные события"""
+        with self._lock:
+            if not self._deferred:
+                return
+            for key, action in self._deferred.items():
+                # Более новое действие из очереди побеждает
+                self._pending.setdefault(key, action)
+            print(f"🔁 Вебхуки: {len(self._deferred)} событий, пришедших во время загрузки зеркала")
+            self._deferred = {}
+            self._schedule()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending) + len(self._deferred)
+
+    def flush(self) -> None:
+        """Применяет накопленные события (вызывается таймером или вручную)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._first_at = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return
+
+        with self._flush_lock:
+            self.stats["flushes"] += 1
+            with self._lock:
+                # Зеркала нет или оно загружается: снимок может не учесть событие —
+                # откладываем до конца загрузки (_replay_deferred)
+                if not self.mirror.loaded or self.mirror.reloading_now:
+                    for key, action in pending.items():
+                        self._deferred[key] = action
+                    self.stats["deferred"] += len(pending)
+                    return
+            try:
+                with request_priority(PRIORITY_BACKGROUND):
+                    self._apply(pending)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.stats["errors"] += 1
+                print(f"❌ Ошибка применения вебхуков ({len(pending)} событий): {e}")
+                # Непримененные изменения не теряем: следующее чтение перезагрузит ассортимент
+                self.mirror.invalidate()
+
+    def _apply(self, pending: Dict[Tuple[str, str], str]) -> None:
+        deleted = [entity_id for (_, entity_id), action in pending.items() if action == ACTION_DELETE]
+        upserts: Dict[str, List[str]] = {}
+        for (entity_type, entity_id), action in pending.items():
+            if action == ACTION_UPSERT:
+                upserts.setdefault(entity_type, []).append(entity_id)
+
+        total = sum(len(ids) for ids in upserts.values())
+        if total > self.settings["full_reload_threshold"]:
+            stats = {}
+            with self.mirror.reloading():
+                rows = list(self.api.iter_assortment(stats))
+                if stats.get("error"):
+                    raise ValueError(stats["error"])
+                self.stats["full_reloads"] += 1
+                self.mirror.load(rows)
+            print(f"🔄 Вебхуки: {total} изменений — ассортимент перезагружен целиком ({len(rows)} строк)")
+            return
+
+        removed = self.mirror.remove(deleted)
+        updated = 0
+        batch_size = self.settings["batch_size"]
+        for entity_type, ids in upserts.items():
+            for start in range(0, len(ids), batch_size):
+                chunk = ids[start:start + batch_size]
+                rows = self.api.fetch_entities(entity_type, chunk)
+                self.stats["fetches"] += 1
+                updated += self.mirror.upsert(rows)
+                # Сущность, которой уже нет в ответе, удалена после события
+                found = {row.get("id") for row in rows}
+                removed += self.mirror.remove(entity_id for entity_id in chunk if entity_id not in found)
+        print(f"🔄 Вебхуки: обновлено {updated}, удалено {removed}, версия зеркала {self.mirror.version}")
+
+
+# ---------------------------------------------------------------------------
+# Регистрация вебхуков (см. manage_webhooks.py)
+# ---------------------------------------------------------------------------
+
+def webhook_url(public_url: str, secret: str, path: str = WEBHOOKS["path"]) -> str:
+    return f"{public_url.rstrip('/')}{path}?token={secret}"
+
+
+def list_webhooks(api) -> List[dict]:
+    resp = api.scheduler.get('moysklad', f"{api.base_url}/entity/webhook", headers=api.headers, timeout=api.timeout)
+    resp.raise_for_status()
+    return response_json(resp).get("rows", [])
+
+
+def _is_ours(hook: dict, public_url: str, path: str) -> bool:
+    return hook.get("url", "").startswith(f"{public_url.rstrip('/')}{path}")
+
+
+def register_webhooks(api, public_url: str, path: str = WEBHOOKS["path"]) -> List[dict]:
+    """Создает недостающие вебхуки для всех пар (тип сущности, действие)"""
+    if not api.webhook_secret:
+        raise ValueError("Секрет вебхуков аккаунта не задан (MS_WEBHOOK_SECRET)")
+    url = webhook_url(public_url, api.webhook_secret, path)
+    existing = {
+        (hook.get("entityType"), hook.get("action"))
+        for hook in list_webhooks(api)
+        if hook.get("url") == url
+    }
+    created = []
+    for entity_type in WEBHOOKS["entity_types"]:
+        for action in WEBHOOKS["actions"]:
+            if (entity_type, action) in existing:
+                continue
+            payload = {"url": url, "action": action, "entityType": entity_type}
+            resp = api.scheduler.post('moysklad', f"{api.base_url}/entity/webhook", headers=api.headers,
+                                     json=payload, timeout=api.timeout)
+            resp.raise_for_status()
+            created.append(response_json(resp))
+    return created
+
+
+def unregister_webhooks(api, public_url: str, path: str = WEBHOOKS["path"]) -> List[dict]:
+    """Удаляет вебхуки, указывающие на этот сервер"""
+    removed = []
+    for hook in list_webhooks(api):
+        if not _is_ours(hook, public_url, path):
+            continue
+        resp = api.scheduler.delete('moysklad', f"{api.base_url}/entity/webhook/{hook.get('id')}",
+                                   headers=api.headers, timeout=api.timeout)
+        resp.raise_for_status()
+        removed.append(hook)
+    return removed